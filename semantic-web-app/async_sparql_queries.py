@@ -0,0 +1,195 @@
+"""
+async_sparql_queries.py
+
+Asyncio SPARQL client running the queries of SPARQLQueries concurrently.
+
+Independent queries, such as the ones needed by a restaurant page, are sent at the
+same time over a pool of keep-alive connections, so the page costs the latency of
+its slowest query instead of the sum of all of them. Every query has its own
+timeout and can be cancelled.
+"""
+
+import time
+import asyncio
+import threading
+import aiohttp
+import query_log
+from sparql_queries import SPARQLQueries
+from query_log import bind_params
+from instrumentation import span, count
+
+
+class AsyncSPARQLQueries:
+    """
+    Asyncio client for the queries of SPARQLQueries.
+
+    Usage:
+        async with AsyncSPARQLQueries("http://localhost:3030/webproject/query") as client:
+            details, hours = await client.gather(
+                client.get_restaurant_data_by_name("Aida"),
+                client.get_restaurant_opening_hours("Aida"))
+    """
+
+    def __init__(self, sparql_endpoint, max_connections=10, timeout=30.0):
+        self.sparql_endpoint = sparql_endpoint
+        self.max_connections = max_connections
+        self.timeout = timeout
+        # The query builders and result formatters of the synchronous client
+        self.queries = SPARQLQueries(sparql_endpoint)
+        self._session = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def open(self):
+        """
+        Open the pool of connections to the SPARQL endpoint.
+        """
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            self._session = aiohttp.ClientSession(connector=connector)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def execute_query(self, query, timeout=None):
+        """
+        Execute a given SPARQL query and return the results.
+
+        Args:
+            query (str): The SPARQL query.
+            timeout (float): Timeout of this query in seconds, the client timeout if omitted.
+
+        Raises:
+            asyncio.TimeoutError: If the query did not complete in time.
+        """
+        await self.open()
+        client_timeout = aiohttp.ClientTimeout(total=timeout or self.timeout)
+        with span("sparql.async_execute_query"):
+            async with self._session.post(self.sparql_endpoint,
+                                          data={"query": query},
+                                          headers={"Accept": "application/sparql-results+json"},
+                                          timeout=client_timeout) as response:
+                response.raise_for_status()
+                results = await response.json(content_type=None)
+        bindings = results["results"]["bindings"]
+        count("sparql.rows", len(bindings))
+        return bindings
+
+    async def run(self, method, *args, timeout=None):
+        """
+        Run one of the SPARQLQueries methods, e.g. run('get_restaurant_data_by_name', 'Aida').
+        """
+        query, formatter = self._query_and_formatter(method, *args)
+        start = time.perf_counter()
+        results = formatter(await self.execute_query(query, timeout))
+        if query_log.QUERY_LOG is not None:
+            query_log.QUERY_LOG.record(method, bind_params(getattr(SPARQLQueries, method), args, {}),
+                                       time.perf_counter() - start, len(results),
+                                       {'queries': [query], 'bytes': None, 'error': None}, self)
+        return results
+
+    def _query_and_formatter(self, method, *args):
+        return self.queries.build_query(method, *args), getattr(self.queries, QUERY_FORMATTERS[method])
+
+    async def gather(self, *queries, timeout=None, return_exceptions=False):
+        """
+        Run independent queries concurrently.
+
+        Args:
+            *queries: Coroutines, e.g. client.get_delivery_services().
+            timeout (float): Timeout for the whole group; pending queries are cancelled
+                when it expires.
+            return_exceptions (bool): Return the exception of a failed query in its slot
+                instead of cancelling the other queries.
+
+        Returns:
+            list: The results, in the order of the queries.
+        """
+        with span("sparql.gather"):
+            return await asyncio.wait_for(asyncio.gather(*queries, return_exceptions=return_exceptions), timeout)
+
+    async def get_restaurant_page(self, restaurant_name, timeout=None):
+        """
+        Fetches everything shown on a restaurant page with concurrent queries: details,
+        opening hours, menu with prices and delivery services.
+        """
+        details, opening_hours, menu, delivery_services = await self.gather(
+            self.get_restaurant_data_by_name(restaurant_name),
+            self.get_restaurant_opening_hours(restaurant_name),
+            self.get_restaurant_menu(restaurant_name),
+            self.get_delivery_services(),
+            timeout=timeout)
+        return {
+            'details': details,
+            'opening_hours': opening_hours,
+            'menu': menu,
+            'delivery_services': delivery_services
+        }
+
+    def __getattr__(self, method):
+        # Async versions of the SPARQLQueries methods, e.g. await client.get_restaurant_data()
+        if method not in QUERY_FORMATTERS:
+            raise AttributeError(method)
+
+        async def query_method(*args, timeout=None):
+            return await self.run(method, *args, timeout=timeout)
+        return query_method
+
+
+# SPARQLQueries methods available on the asyncio client, with their result formatter
+QUERY_FORMATTERS = {
+    'get_restaurant_data': 'format_restaurant_data',
+    'get_restaurant_data_by_name': 'format_restaurant_data',
+    'get_restaurant_summaries': 'format_restaurant_summary_data',
+    'get_restaurant_opening_hours': 'format_open_hours_data',
+    'get_restaurants_by_day_and_time': 'format_open_hours_data',
+    'get_restaurants_in_area': 'format_geographical_data',
+    'get_restaurant_menu': 'format_price_range_data',
+    'get_restaurants_by_price_range': 'format_price_range_data',
+    'get_delivery_services': 'format_delivery_service_data',
+    'query_restaurants_based_on_combined_preferences': 'format_combined_preferences_data',
+}
+
+
+class SyncSPARQLQueries:
+    """
+    Synchronous facade of AsyncSPARQLQueries, with the same methods as SPARQLQueries.
+
+    The asyncio client runs on its own event loop in a background thread, so the
+    facade can be called from any thread and keeps its connection pool between calls.
+    """
+
+    def __init__(self, sparql_endpoint, **kwargs):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self.client = AsyncSPARQLQueries(sparql_endpoint, **kwargs)
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def execute_query(self, query, timeout=None):
+        return self._call(self.client.execute_query(query, timeout))
+
+    def get_restaurant_page(self, restaurant_name, timeout=None):
+        return self._call(self.client.get_restaurant_page(restaurant_name, timeout))
+
+    def close(self):
+        self._call(self.client.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def __getattr__(self, method):
+        if method not in QUERY_FORMATTERS:
+            raise AttributeError(method)
+
+        def query_method(*args, timeout=None):
+            return self._call(self.client.run(method, *args, timeout=timeout))
+        return query_method
@@ -0,0 +1,331 @@
+"""
+columnar_export.py
+
+Export of query results and of the whole corpus as typed columnar files, Parquet
+(.parquet) or Arrow IPC (.arrow), for analytical scans with vectorized tooling
+(pandas, polars, DuckDB, ...) instead of repeated SPARQL queries.
+
+The results of any SPARQLQueries method are exported with one column per query
+variable, typed from the datatypes of its values: numbers as int64 or float64,
+xsd:time as time32, xsd:date as date32, xsd:dateTime as timestamps and the rest
+as strings. The names of restaurants and services, repeated on many rows, are
+dictionary-encoded.
+
+The corpus export reads data/ttl one restaurant at a time (see
+iter_restaurant_graphs) into three flat tables, restaurants, menu_items and
+opening_hours, written by batches of rows, so that memory does not grow with the
+corpus.
+
+Requires the optional pyarrow package.
+"""
+
+import os
+from datetime import date, datetime, time as day_time
+from rdflib.namespace import RDF
+from instrumentation import timed, span, count
+from literal_normalization import parse_price_amount
+from restaurant_summary import (SCHEMA, WEEK, iter_restaurant_graphs, load_services, first_value,
+                                restaurant_service)
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+XSD = "http://www.w3.org/2001/XMLSchema#"
+
+INTEGER_DATATYPES = {XSD + name for name in ["integer", "int", "long", "short", "byte", "nonNegativeInteger",
+                                             "positiveInteger", "negativeInteger", "nonPositiveInteger"]}
+FLOAT_DATATYPES = {XSD + name for name in ["decimal", "double", "float"]}
+
+# Columns of restaurant and service names, dictionary-encoded
+DICTIONARY_COLUMNS = {'restaurant', 'restaurantName', 'restaurant_name', 'service', 'serviceName', 'service_name',
+                      'section', 'currency', 'day', 'openDay'}
+
+EXTENSIONS = {'.parquet': 'parquet', '.arrow': 'arrow', '.ipc': 'arrow', '.feather': 'arrow'}
+
+BATCH_SIZE = 10000
+
+
+def require_pyarrow():
+    if pyarrow is None:
+        raise ValueError("Columnar export requires the pyarrow package")
+
+
+def file_format(output_file):
+    """
+    Format of an output file from its extension, 'parquet' or 'arrow'.
+    """
+    extension = os.path.splitext(output_file)[1].lower()
+    if extension not in EXTENSIONS:
+        raise ValueError(f"Unsupported export file {output_file}, use .parquet or .arrow")
+    return EXTENSIONS[extension]
+
+
+class TableWriter:
+    """
+    Writer of a Parquet or Arrow IPC file by batches of rows.
+
+    Usage:
+        with TableWriter('menu_items.parquet', corpus_schemas()['menu_items']) as writer:
+            writer.append({'name': 'Falafel', 'price': 6.5, ...})
+    """
+
+    def __init__(self, output_file, schema, batch_size=BATCH_SIZE):
+        require_pyarrow()
+        self.output_file = output_file
+        self.schema = schema
+        self.batch_size = batch_size
+        self.columns = {name: [] for name in schema.names}
+        # One dictionary per dictionary-encoded column, growing across the batches
+        self.dictionaries = {field.name: {} for field in schema if pyarrow.types.is_dictionary(field.type)}
+        self.rows = 0
+        os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+        if file_format(output_file) == 'parquet':
+            self.writer = pyarrow.parquet.ParquetWriter(output_file, schema, compression='zstd')
+        else:
+            # IPC files cannot replace a dictionary, each batch only adds the new values
+            self.writer = pyarrow.ipc.new_file(output_file, schema,
+                                               options=pyarrow.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, row):
+        for name, values in self.columns.items():
+            values.append(row.get(name))
+        self.rows += 1
+        if len(values) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.columns[self.schema.names[0]]:
+            return
+        with span("columnar_export.write_batch"):
+            batch = pyarrow.record_batch([self.column_array(field) for field in self.schema], schema=self.schema)
+            self.writer.write_batch(batch)
+        for values in self.columns.values():
+            values.clear()
+
+    def column_array(self, field):
+        values = self.columns[field.name]
+        if field.name not in self.dictionaries:
+            return pyarrow.array(values, field.type)
+        dictionary = self.dictionaries[field.name]
+        indices = [dictionary.setdefault(value, len(dictionary)) if value is not None else None for value in values]
+        return pyarrow.DictionaryArray.from_arrays(pyarrow.array(indices, field.type.index_type),
+                                                   pyarrow.array(list(dictionary), field.type.value_type))
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        count("columnar_export.rows", self.rows)
+
+
+"""
+FUNCTIONS TO EXPORT QUERY RESULTS
+"""
+def parse_time(value):
+    return day_time.fromisoformat(value[:8])
+
+
+def column_type(name, bindings):
+    """
+    Arrow type of a query variable and the converter of its lexical values, from the
+    datatypes of its values.
+    """
+    string_type = pyarrow.dictionary(pyarrow.int32(), pyarrow.string()) if name in DICTIONARY_COLUMNS \
+        else pyarrow.string()
+    datatypes = {binding.get('datatype') for binding in bindings}
+    if not datatypes or None in datatypes:
+        return string_type, str
+    if datatypes <= INTEGER_DATATYPES:
+        return pyarrow.int64(), int
+    if datatypes <= INTEGER_DATATYPES | FLOAT_DATATYPES:
+        return pyarrow.float64(), float
+    if datatypes == {XSD + "boolean"}:
+        return pyarrow.bool_(), lambda value: value in ('true', '1')
+    if datatypes == {XSD + "time"}:
+        return pyarrow.time32('s'), parse_time
+    if datatypes == {XSD + "date"}:
+        return pyarrow.date32(), date.fromisoformat
+    if datatypes == {XSD + "dateTime"}:
+        return pyarrow.timestamp('us'), datetime.fromisoformat
+    return string_type, str
+
+
+def bindings_to_table(bindings, variables=None):
+    """
+    Convert the bindings of a query (in the SPARQL JSON results format) to a typed
+    Arrow table, with one column per variable. Values which cannot be converted to
+    the type of their column make it a string column.
+
+    Args:
+        bindings (list): The bindings, e.g. from SPARQLQueries.execute_query.
+        variables (list): The columns, in order, the variables of the bindings if omitted.
+    """
+    require_pyarrow()
+    if variables is None:
+        variables = list(dict.fromkeys(variable for row in bindings for variable in row))
+    columns = {}
+    for variable in variables:
+        values = [row.get(variable) for row in bindings]
+        arrow_type, convert = column_type(variable, [value for value in values if value is not None])
+        try:
+            data = [convert(value['value']) if value is not None else None for value in values]
+        except ValueError:
+            arrow_type = pyarrow.string()
+            data = [value['value'] if value is not None else None for value in values]
+        columns[variable] = pyarrow.array(data, arrow_type)
+    return pyarrow.table(columns)
+
+
+def write_table(table, output_file):
+    """
+    Write an Arrow table as Parquet or Arrow IPC, after the extension of the file.
+    """
+    require_pyarrow()
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    if file_format(output_file) == 'parquet':
+        pyarrow.parquet.write_table(table, output_file, compression='zstd')
+    else:
+        with pyarrow.ipc.new_file(output_file, table.schema) as writer:
+            writer.write_table(table)
+
+
+@timed("export_query_results")
+def export_query_results(sparql_queries, method, args, output_file):
+    """
+    Export the results of a SPARQLQueries method as a Parquet or Arrow IPC file.
+
+    Args:
+        sparql_queries (SPARQLQueries): The client, e.g. LocalSPARQLQueries.
+        method (str): The method, e.g. 'get_restaurants_by_price_range'.
+        args (list): Arguments of the method, e.g. [20.0].
+        output_file (str): The .parquet or .arrow file.
+
+    Returns:
+        pyarrow.Table: The exported table.
+    """
+    query = sparql_queries.build_query(method, *args)
+    table = bindings_to_table(sparql_queries.execute_query(query))
+    write_table(table, output_file)
+    return table
+
+
+"""
+FUNCTIONS TO EXPORT THE CORPUS
+"""
+def corpus_schemas():
+    """
+    Schemas of the restaurants, menu_items and opening_hours tables.
+    """
+    require_pyarrow()
+    name = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    return {
+        'restaurants': pyarrow.schema([
+            ('restaurant', pyarrow.string()), ('restaurant_name', name), ('service', name), ('service_name', name),
+            ('description', pyarrow.string()), ('image', pyarrow.string()), ('address', pyarrow.string()),
+            ('telephone', pyarrow.string()), ('latitude', pyarrow.float64()), ('longitude', pyarrow.float64()),
+            ('menu_items', pyarrow.int32())]),
+        'menu_items': pyarrow.schema([
+            ('restaurant', name), ('restaurant_name', name), ('service_name', name), ('section', name),
+            ('name', pyarrow.string()), ('description', pyarrow.string()), ('image', pyarrow.string()),
+            ('price', pyarrow.float64()), ('currency', name), ('allergens', pyarrow.list_(pyarrow.string()))]),
+        'opening_hours': pyarrow.schema([
+            ('restaurant', name), ('restaurant_name', name), ('day', name), ('opens', pyarrow.time32('s')),
+            ('closes', pyarrow.time32('s'))]),
+    }
+
+
+def restaurant_rows(graph, restaurant, service_url, service_name):
+    """
+    Rows of a restaurant in the restaurants, menu_items and opening_hours tables.
+
+    Returns:
+        tuple: The restaurant row, and the lists of menu item and opening hours rows.
+    """
+    def value(subject, predicate):
+        found = first_value(graph, subject, predicate) if subject is not None else None
+        return str(found) if found is not None else None
+
+    restaurant_name = value(restaurant, SCHEMA.name)
+    keys = {'restaurant': str(restaurant), 'restaurant_name': restaurant_name}
+
+    menu_items = []
+    for menu in graph.objects(restaurant, SCHEMA.hasMenu):
+        for section in graph.objects(menu, SCHEMA.hasMenuSection):
+            section_name = value(section, SCHEMA.name)
+            for menu_item in graph.objects(section, SCHEMA.hasMenuItem):
+                offer = graph.value(menu_item, SCHEMA.offers)
+                price = graph.value(offer, SCHEMA.price) if offer is not None else None
+                menu_items.append(dict(keys, service_name=service_name, section=section_name,
+                                       name=value(menu_item, SCHEMA.name),
+                                       description=value(menu_item, SCHEMA.description),
+                                       image=value(menu_item, SCHEMA.image),
+                                       price=parse_price_amount(price) if price is not None else None,
+                                       currency=value(offer, SCHEMA.priceCurrency),
+                                       allergens=sorted(str(label) for label in
+                                                        graph.objects(menu_item, SCHEMA.nutrition))))
+
+    opening_hours = []
+    for ohs in graph.objects(restaurant, SCHEMA.openingHoursSpecification):
+        opens, closes = graph.value(ohs, SCHEMA.opens), graph.value(ohs, SCHEMA.closes)
+        if opens is None or closes is None:
+            continue
+        for day in graph.objects(ohs, SCHEMA.dayOfWeek):
+            day_name = str(day).split('/')[-1]
+            if day_name in WEEK:
+                opening_hours.append(dict(keys, day=day_name, opens=parse_time(str(opens)),
+                                          closes=parse_time(str(closes))))
+
+    address = graph.value(restaurant, SCHEMA.address)
+    geo = graph.value(restaurant, SCHEMA.geo)
+    row = dict(keys, service=service_url, service_name=service_name,
+               description=value(restaurant, SCHEMA.description), image=value(restaurant, SCHEMA.image),
+               address=value(address, SCHEMA.streetAddress), telephone=value(address, SCHEMA.telephone),
+               latitude=float(graph.value(geo, SCHEMA.latitude)) if geo is not None else None,
+               longitude=float(graph.value(geo, SCHEMA.longitude)) if geo is not None else None,
+               menu_items=len(menu_items))
+    return row, menu_items, opening_hours
+
+
+@timed("export_corpus")
+def export_corpus(ttl_folder='data/ttl', output_folder='data/export', table_format='parquet',
+                  batch_size=BATCH_SIZE):
+    """
+    Export the corpus as the flat restaurants, menu_items and opening_hours tables,
+    streaming one restaurant at a time.
+
+    Args:
+        ttl_folder (str): Folder of Turtle files, e.g. data/ttl.
+        output_folder (str): Folder of the tables, {table}.parquet or {table}.arrow.
+        table_format (str): 'parquet' or 'arrow'.
+        batch_size (int): Rows per written batch (and Parquet row group).
+
+    Returns:
+        dict: Table name -> number of rows.
+    """
+    services = load_services(os.path.join(ttl_folder, 'service'))
+    extension = '.parquet' if table_format == 'parquet' else '.arrow'
+    writers = {table: TableWriter(os.path.join(output_folder, table + extension), schema, batch_size)
+               for table, schema in corpus_schemas().items()}
+    try:
+        for g in iter_restaurant_graphs(ttl_folder):
+            for restaurant in sorted(g.subjects(RDF.type, SCHEMA.Restaurant)):
+                row, menu_items, opening_hours = restaurant_rows(g, restaurant,
+                                                                 *restaurant_service(restaurant, services))
+                writers['restaurants'].append(row)
+                for menu_item in menu_items:
+                    writers['menu_items'].append(menu_item)
+                for opening_hour in opening_hours:
+                    writers['opening_hours'].append(opening_hour)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return {table: writer.rows for table, writer in writers.items()}
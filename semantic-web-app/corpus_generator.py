@@ -0,0 +1,342 @@
+"""
+corpus_generator.py
+
+This script generates a synthetic CoopCycle corpus (delivery services, restaurants
+and their offers) shaped like the data crawled by jsonld_parser.py, so that the
+converter and the SPARQL queries can be exercised at any scale.
+
+The distributions (menu size, prices, opening hours, restaurants per service and
+geo spread around the service city) are fitted on the crawled data in data/ttl.
+"""
+
+import os
+import json
+import math
+import random
+from jsonld_parser import save_json
+from crawl_archive import CrawlArchive
+from jsonld_to_rdf_converter import slugify, jsonld_to_graph as parse_jsonld
+from literal_normalization import normalize_graph
+
+"""
+DISTRIBUTIONS FITTED ON THE CRAWLED CORPUS
+"""
+# Log-normal parameters (mu, sigma) of the number of restaurants per service,
+# menu sections per menu, menu items per menu and item price in EUR.
+RESTAURANTS_PER_SERVICE = (math.log(7), 1.86)
+SECTIONS_PER_MENU = (math.log(6), 0.54)
+ITEMS_PER_MENU = (math.log(32), 0.76)
+ITEM_PRICE = (math.log(7.6), 0.74)
+
+# Standard deviation (in degrees) of restaurant coordinates around the service city.
+GEO_SPREAD = 0.008
+
+# Most frequent (opens, closes) pairs for lunch and dinner services.
+LUNCH_HOURS = [("11:30", "14:00"), ("11:45", "13:45"), ("12:00", "14:00"), ("11:50", "14:00"),
+               ("12:00", "13:45"), ("11:30", "13:40"), ("11:30", "13:30"), ("13:00", "15:30")]
+DINNER_HOURS = [("17:00", "21:40"), ("18:50", "22:00"), ("19:00", "22:00"), ("18:45", "21:30"),
+                ("19:00", "21:30"), ("18:30", "21:30"), ("18:45", "21:40")]
+
+WEEK = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+OPENING_DAYS = [WEEK[:5], WEEK[:6], WEEK[1:6], WEEK[1:], WEEK]
+
+# Share of menu items with a description, an image or allergens.
+ITEM_DESCRIPTION_RATE = 0.6
+ITEM_IMAGE_RATE = 0.3
+ITEM_ALLERGENS_RATE = 0.15
+
+ALLERGENS = [("Cereals containing gluten", 1292), ("Milk", 293), ("Eggs", 258), ("Fish", 135),
+             ("Celery", 124), ("Crustaceans", 66), ("Sulphur dioxide and sulphites", 61),
+             ("Sesame seeds", 56), ("Soybeans", 51), ("Mustard", 39), ("Peanuts", 35),
+             ("Tree nuts", 30), ("Lupin", 8), ("Molluscs", 7)]
+
+SECTION_NAMES = ["Entrées", "Plats", "Desserts", "Boissons", "Pizzas", "Burgers", "Salades",
+                 "Antipasti", "Primi", "Secondi", "Bowls", "Sandwiches", "Formules", "Apéritifs",
+                 "Menu enfant", "Vins", "Bières", "Accompagnements", "Sushis", "Végétarien"]
+
+DISHES = ["Pizza", "Burger", "Salade", "Risotto", "Lasagne", "Tiramisu", "Falafel", "Houmous",
+          "Poke bowl", "Curry", "Pad thaï", "Gyozas", "Sushi", "Tartare", "Quiche", "Focaccia",
+          "Bagel", "Croque", "Soupe", "Tarte", "Cookie", "Limonade", "Kombucha", "Panna cotta"]
+
+DISH_QUALIFIERS = ["maison", "du jour", "végétarienne", "au poulet", "aux légumes", "au saumon",
+                   "al tartufo", "della nonna", "au chocolat", "bio", "épicé", "au fromage"]
+
+RESTAURANT_WORDS = ["Chez", "La Table", "Le Comptoir", "L'Atelier", "Osteria", "Trattoria",
+                    "La Cantine", "Le Bistrot", "Pizzeria", "Maison", "Le Petit", "La Fabrique"]
+
+RESTAURANT_NAMES = ["Rosa", "Mario", "du Marché", "des Amis", "Sud", "Bella", "du Coin",
+                    "Verde", "Nomade", "Saveurs", "Gourmande", "Lumière", "Marcel", "Giulia"]
+
+DESCRIPTION_SENTENCES = ["Cuisine faite maison avec des produits frais et de saison.",
+                         "Livraison à vélo par notre coopérative locale.",
+                         "Des recettes traditionnelles revisitées chaque semaine.",
+                         "Produits locaux, circuits courts et emballages consignés.",
+                         "Cucina italiana autentica, ingredienti di qualità."]
+
+
+"""
+FUNCTIONS TO GENERATE JSON-LD RECORDS
+"""
+def lognormal_count(rng, params, minimum=1):
+    """
+    Draw a positive integer from a log-normal distribution.
+    """
+    mu, sigma = params
+    return max(minimum, int(round(rng.lognormvariate(mu, sigma))))
+
+
+def load_service_cities(coopcycle_file='data/coopcycle.json'):
+    """
+    Load the (city, country, latitude, longitude) of the crawled services, used as
+    centres for the synthetic services.
+
+    Returns:
+        list: The service cities, or a single default city if the file is missing.
+    """
+    if not os.path.exists(coopcycle_file):
+        return [("Saint-Étienne", "fr", 45.4397, 4.3872)]
+
+    with open(coopcycle_file, 'r', encoding='utf-8') as file:
+        services = json.load(file)
+    return [(service["city"], service.get("country", "fr"), service["latitude"], service["longitude"])
+            for service in services if "latitude" in service and "longitude" in service]
+
+
+def generate_service_jsonld(rng, index, city):
+    """
+    Generate the JSON-LD of a delivery service, as written by get_service_jsonld.
+
+    Returns:
+        tuple: The service slug, its URL, its coordinates and the JSON-LD data.
+    """
+    city_name, country, latitude, longitude = city
+    service = f"{slugify(city_name)}-{index}"
+    service_url = f"https://{service}.coopcycle.org"
+
+    item = {
+        "@context": "http://schema.org/",
+        "@id": service_url,
+        "@type": "Service",
+        "name": f"{city_name} Coursiers {index}",
+        "provider": {"@type": "Organization", "name": "CoopCycle"},
+        "serviceType": "DeliveryService",
+        "areaServed": {
+            "@type": "Place",
+            "address": {"@type": "PostalAddress", "addressLocality": city_name, "addressCountry": country},
+            "geo": {"@type": "GeoCoordinates", "latitude": latitude, "longitude": longitude}
+        },
+        "sameAs": [],
+        "url": service_url,
+        "description": [{"@type": "Text", "@value": f"Livraison éthique et écologique à {city_name}.", "@language": "fr"}],
+    }
+    return service, service_url, (latitude, longitude), [item]
+
+
+def generate_opening_hours(rng):
+    """
+    Generate the openingHoursSpecification of a restaurant: a lunch service, a dinner
+    service or both, on one of the usual sets of days.
+    """
+    days = rng.choice(OPENING_DAYS)
+    services = rng.choices([[LUNCH_HOURS], [DINNER_HOURS], [LUNCH_HOURS, DINNER_HOURS]], weights=[3, 2, 5])[0]
+    return [{"@type": "OpeningHoursSpecification", "dayOfWeek": days, "opens": opens, "closes": closes}
+            for opens, closes in (rng.choice(hours) for hours in services)]
+
+
+def generate_restaurant_jsonld(rng, service_url, center, restaurant_id, address_id):
+    """
+    Generate the JSON-LD of a restaurant, as written by get_restaurant_jsonld.
+
+    Returns:
+        tuple: The restaurant slug and the JSON-LD data.
+    """
+    name = f"{rng.choice(RESTAURANT_WORDS)} {rng.choice(RESTAURANT_NAMES)}"
+    slug = slugify(name)
+    restaurant_url = f"{service_url}/en/restaurant/{restaurant_id}-{slug}"
+    image_hash = f"{rng.getrandbits(48):012x}"
+
+    restaurant = {
+        "@context": "http://schema.org",
+        "@type": "Restaurant",
+        "@id": f"{service_url}/api/restaurants/{restaurant_id}",
+        "name": name,
+        "description": " ".join(rng.sample(DESCRIPTION_SENTENCES, rng.randint(1, 3))),
+        "image": f"{service_url}/media/cache/restaurant_thumbnail/{image_hash[:2]}/{image_hash[2:4]}/{image_hash}.jpg",
+        "address": {
+            "@id": f"{service_url}/api/addresses/{address_id}",
+            "@type": "PostalAddress",
+            "name": name,
+            "streetAddress": f"{rng.randint(1, 120)} Rue {rng.choice(RESTAURANT_NAMES)}",
+            "telephone": f"+33{rng.randint(100000000, 999999999)}"
+        },
+        "geo": {
+            "@type": "GeoCoordinates",
+            "latitude": round(rng.gauss(center[0], GEO_SPREAD), 6),
+            "longitude": round(rng.gauss(center[1], GEO_SPREAD), 6)
+        },
+        "openingHoursSpecification": generate_opening_hours(rng),
+        "sameAs": restaurant_url,
+        "url": restaurant_url
+    }
+    return slug, [restaurant, {"@id": service_url, "areaServed": {"@id": restaurant_url}}]
+
+
+def generate_menu_item(rng, service_url):
+    """
+    Generate a MenuItem with its Offer, as extracted by extract_offer_jsonld.
+    """
+    price = round(rng.lognormvariate(*ITEM_PRICE), 1)
+    item = {
+        "@type": "MenuItem",
+        "name": f"{rng.choice(DISHES)} {rng.choice(DISH_QUALIFIERS)}",
+        "offers": {"@type": "Offer", "price": f"€{price:.2f}"}
+    }
+    if rng.random() < ITEM_DESCRIPTION_RATE:
+        item["description"] = rng.choice(DESCRIPTION_SENTENCES)
+    if rng.random() < ITEM_IMAGE_RATE:
+        image_hash = f"{rng.getrandbits(48):012x}"
+        item["image"] = f"{service_url}/media/cache/product_thumbnail/{image_hash[:2]}/{image_hash[2:4]}/{image_hash}.jpeg"
+    if rng.random() < ITEM_ALLERGENS_RATE:
+        names, weights = zip(*ALLERGENS)
+        item["nutrition"] = sorted(set(rng.choices(names, weights=weights, k=rng.randint(1, 3))))
+    return item
+
+
+def generate_offer_jsonld(rng, service_url, restaurant_id, slug):
+    """
+    Generate the JSON-LD of a restaurant menu, as written by get_offer_jsonld.
+    """
+    restaurant_url = f"{service_url}/en/restaurant/{restaurant_id}-{slug}"
+    section_count = lognormal_count(rng, SECTIONS_PER_MENU)
+    item_count = max(section_count, lognormal_count(rng, ITEMS_PER_MENU))
+
+    # Spread the items over the sections, every section holding at least one item
+    cuts = sorted(rng.sample(range(1, item_count), section_count - 1)) if section_count > 1 else []
+    sizes = [end - start for start, end in zip([0] + cuts, cuts + [item_count])]
+
+    section_names = rng.sample(SECTION_NAMES, len(SECTION_NAMES))
+    menu_data = {
+        "@context": "http://schema.org",
+        "@type": "Menu",
+        "@id": f"{restaurant_url}#menu",
+        "hasMenuSection": [
+            {
+                "@type": "MenuSection",
+                "name": section_names[j % len(section_names)],
+                "hasMenuItem": [generate_menu_item(rng, service_url) for _ in range(size)]
+            }
+            for j, size in enumerate(sizes)
+        ]
+    }
+    restaurant_data = {
+        "@context": "http://schema.org",
+        "@id": f"{service_url}/api/restaurants/{restaurant_id}",
+        "hasMenu": {"@id": f"{restaurant_url}#menu"}
+    }
+    return [restaurant_data, menu_data]
+
+
+def generate_corpus(services=50, restaurants=400, seed=0, coopcycle_file='data/coopcycle.json'):
+    """
+    Generate a synthetic corpus, record by record.
+
+    Args:
+        services (int): Number of delivery services.
+        restaurants (int): Total number of restaurants, spread over the services.
+        seed (int): Seed of the random generator, the same seed gives the same corpus.
+        coopcycle_file (str): coopcycle.json file whose cities are used as service centres.
+
+    Yields:
+        tuple: (kind, relative path, JSON-LD data) with kind in 'service', 'restaurant', 'offer'.
+    """
+    rng = random.Random(seed)
+    cities = load_service_cities(coopcycle_file)
+
+    # Skewed number of restaurants per service, scaled to the requested total
+    weights = [rng.lognormvariate(*RESTAURANTS_PER_SERVICE) for _ in range(services)]
+    total_weight = sum(weights)
+    counts = [int(restaurants * weight / total_weight) for weight in weights]
+    for i in rng.sample(range(services), restaurants - sum(counts)):
+        counts[i] += 1
+
+    address_id = 0
+    for i, count in enumerate(counts):
+        service, service_url, center, service_jsonld = generate_service_jsonld(rng, i, cities[i % len(cities)])
+        yield 'service', f'{i}-{service}.json', service_jsonld
+
+        for restaurant_id in range(1, count + 1):
+            address_id += 1
+            slug, restaurant_jsonld = generate_restaurant_jsonld(rng, service_url, center, restaurant_id, address_id)
+            yield 'restaurant', f'{i}-{service}/{restaurant_id}-{slug}.json', restaurant_jsonld
+            yield 'offer', f'{i}-{service}/{restaurant_id}-{slug}.json', generate_offer_jsonld(rng, service_url, restaurant_id, slug)
+
+
+"""
+FUNCTIONS TO WRITE THE CORPUS
+"""
+def jsonld_to_graph(jsonld_data):
+    """
+    Parse a generated JSON-LD record into an RDF graph with the local schema.org context,
+    with the same typed literals as the converted crawl (see normalize_graph).
+    """
+    g = parse_jsonld(jsonld_data)
+    normalize_graph(g)
+    return g
+
+
+def write_corpus(output_folder, output_format='jsonld', **kwargs):
+    """
+    Generate a synthetic corpus and write it to disk.
+
+    Args:
+        output_folder (str): Folder in which the corpus is written.
+        output_format (str): 'jsonld' writes {output_folder}/jsonld/{kind}/... files ready for
+            convert_jsonld, 'archive' writes a compressed crawl archive in {output_folder}/archive,
+            'turtle' writes the same layout as data/ttl and 'nquads' writes a single corpus.nq
+            file with one named graph per record.
+        **kwargs: Arguments forwarded to generate_corpus.
+
+    Returns:
+        int: Number of records written.
+    """
+    if output_format not in ('jsonld', 'archive', 'turtle', 'nquads'):
+        raise ValueError(f"Unsupported output format: {output_format}")
+
+    nquads_file = None
+    archive = CrawlArchive(os.path.join(output_folder, 'archive')) if output_format == 'archive' else None
+    if output_format == 'nquads':
+        os.makedirs(output_folder, exist_ok=True)
+        nquads_file = open(os.path.join(output_folder, 'corpus.nq'), 'w', encoding='utf-8')
+
+    records = 0
+    try:
+        for kind, path, jsonld_data in generate_corpus(**kwargs):
+            records += 1
+            if output_format == 'jsonld':
+                save_json(os.path.join(output_folder, 'jsonld', kind, path), jsonld_data)
+                continue
+            if archive:
+                folder, _, name = path[:-len('.json')].rpartition('/')
+                archive.append(kind, folder or name, name, jsonld_data)
+                continue
+
+            g = jsonld_to_graph(jsonld_data)
+            if output_format == 'turtle':
+                output_file = os.path.join(output_folder, 'ttl', kind, path.replace('.json', '.ttl'))
+                os.makedirs(os.path.dirname(output_file), exist_ok=True)
+                with open(output_file, 'w', encoding='utf-8') as f:
+                    f.write(g.serialize(format='turtle'))
+            else:
+                # One named graph per record, keyed like the crawled files
+                graph_uri = f"urn:coopcycle:{kind}:{path.replace('.json', '')}"
+                for line in g.serialize(format='nt').splitlines():
+                    if line:
+                        nquads_file.write(f"{line[:-2]} <{graph_uri}> .\n")
+    finally:
+        if nquads_file:
+            nquads_file.close()
+        if archive:
+            archive.close()
+
+    print(f"{records} records written into {output_folder} ({output_format})")
+    return records
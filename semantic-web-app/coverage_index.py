@@ -0,0 +1,231 @@
+"""
+coverage_index.py
+
+Delivery coverage index, linking locations to the delivery services (cooperatives)
+and the restaurants that can deliver there.
+
+The area of a service is a circle around the point of its schema:areaServed (in
+data/ttl/service), or the median of its restaurants when it has none, with the
+radius of its farthest restaurant plus a delivery margin. Restaurants farther than
+MAX_RADIUS_KM from that point (e.g. a demo instance listing restaurants of another
+country) are outliers, left out of the area but still indexed by their coordinates.
+
+The circles and the restaurant coordinates are bucketed in a grid of GRID_DEGREES
+cells, so that the services delivering to a point, or the restaurants in a box, are
+found from one or a few cells in microseconds.
+
+SPARQLQueries pre-filters the area and combined-preferences queries with the
+candidate restaurants of the index when one is set on the client (coverage_index).
+The location of a user is not indexed: it is queried on every call, so that it
+follows the profiles stored on the server.
+"""
+
+import os
+import json
+import math
+import statistics
+from rdflib import Graph, Namespace
+from rdflib.namespace import RDF
+from instrumentation import timed, span, count
+from service_shards import service_files
+
+SCHEMA = Namespace("http://schema.org/")
+
+# Size of the grid cells, in degrees of latitude and longitude
+GRID_DEGREES = 0.25
+
+# Bounds of the radius of a service area, and margin around its farthest restaurant, in km
+MIN_RADIUS_KM = 5.0
+MAX_RADIUS_KM = 30.0
+MARGIN_KM = 2.0
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def distance_km(lat1, long1, lat2, long2):
+    """
+    Great-circle (haversine) distance between two points, in km.
+    """
+    lat1, long1, lat2, long2 = map(math.radians, (lat1, long1, lat2, long2))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((long2 - long1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(h))
+
+
+def cell(lat, long):
+    return math.floor(lat / GRID_DEGREES), math.floor(long / GRID_DEGREES)
+
+
+def cells_in_box(min_lat, max_lat, min_long, max_long):
+    """
+    Grid cells intersecting a box.
+    """
+    (low_row, low_column), (high_row, high_column) = cell(min_lat, min_long), cell(max_lat, max_long)
+    return [(row, column) for row in range(low_row, high_row + 1) for column in range(low_column, high_column + 1)]
+
+
+def coordinates(graph, node):
+    """
+    Latitude and longitude of the schema:geo of a node, or None.
+    """
+    for geo in graph.objects(node, SCHEMA.geo):
+        latitude, longitude = graph.value(geo, SCHEMA.latitude), graph.value(geo, SCHEMA.longitude)
+        try:
+            return float(latitude), float(longitude)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+class CoverageIndex:
+    """
+    Grid index of the service areas and of the restaurant coordinates.
+
+    Attributes:
+        services (dict): Service name -> {'iri', 'locality', 'center' [lat, long],
+            'radius_km', 'restaurants' (numbers of the restaurants in its area), 'outliers'}.
+        restaurants (list): Indexed restaurants as [IRI, name, latitude, longitude, service].
+        source (list): [path, modification time] of the file it was loaded from, or None.
+    """
+
+    def __init__(self, services=None, restaurants=None):
+        self.services = services or {}
+        self.restaurants = restaurants or []
+        self.source = None
+        self._prepare()
+
+    def _prepare(self):
+        # Services by the cells their circle intersects, restaurants by their cell
+        self.service_cells = {}
+        for service, area in self.services.items():
+            lat, long = area['center']
+            lat_range = area['radius_km'] / KM_PER_DEGREE
+            long_range = lat_range / max(math.cos(math.radians(lat)), 0.01)
+            for key in cells_in_box(lat - lat_range, lat + lat_range, long - long_range, long + long_range):
+                self.service_cells.setdefault(key, []).append(service)
+        self.restaurant_cells = {}
+        for number, (_, _, lat, long, _) in enumerate(self.restaurants):
+            self.restaurant_cells.setdefault(cell(lat, long), []).append(number)
+        self.restaurant_services = {restaurant[0]: restaurant[4] for restaurant in self.restaurants}
+
+    def add_service(self, service, iri, locality, center, restaurants):
+        """
+        Add a service, its area being derived from its center and its restaurants.
+
+        Args:
+            center (tuple): Latitude and longitude of its areaServed, or None.
+            restaurants (list): (IRI, name, latitude, longitude) of its restaurants.
+        """
+        if center is None and restaurants:
+            center = (statistics.median(restaurant[2] for restaurant in restaurants),
+                      statistics.median(restaurant[3] for restaurant in restaurants))
+        if center is None:
+            return
+        numbers, farthest, outliers = [], 0.0, 0
+        for restaurant_iri, name, lat, long in restaurants:
+            distance = distance_km(center[0], center[1], lat, long)
+            if distance > MAX_RADIUS_KM:
+                # Still found by the area queries, from its own coordinates
+                outliers += 1
+            else:
+                farthest = max(farthest, distance)
+                numbers.append(len(self.restaurants))
+            self.restaurants.append([restaurant_iri, name, lat, long, service])
+        self.services[service] = {
+            'iri': iri,
+            'locality': locality,
+            'center': list(center),
+            'radius_km': round(max(MIN_RADIUS_KM, farthest + MARGIN_KM), 3),
+            'restaurants': numbers,
+            'outliers': outliers,
+        }
+
+    def services_delivering_to(self, lat, long):
+        """
+        Services whose area contains a point, nearest first.
+
+        Returns:
+            list: (service name, distance to the center of its area in km).
+        """
+        found = []
+        for service in self.service_cells.get(cell(lat, long), ()):
+            area = self.services[service]
+            distance = distance_km(lat, long, *area['center'])
+            if distance <= area['radius_km']:
+                found.append((service, distance))
+        found.sort(key=lambda item: item[1])
+        return found
+
+    def restaurants_delivering_to(self, lat, long):
+        """
+        IRIs of the restaurants of the services delivering to a point.
+        """
+        return [self.restaurants[number][0] for service, _ in self.services_delivering_to(lat, long)
+                for number in self.services[service]['restaurants']]
+
+    def restaurants_in_box(self, min_lat, max_lat, min_long, max_long):
+        """
+        IRIs of the restaurants in a geographical box.
+        """
+        (low_row, low_column), (high_row, high_column) = cell(min_lat, min_long), cell(max_lat, max_long)
+        # Large boxes: scanning the restaurants is cheaper than the cells
+        if (high_row - low_row + 1) * (high_column - low_column + 1) > len(self.restaurant_cells):
+            numbers = range(len(self.restaurants))
+        else:
+            numbers = [number for key in cells_in_box(min_lat, max_lat, min_long, max_long)
+                       for number in self.restaurant_cells.get(key, ())]
+        return [self.restaurants[number][0] for number in numbers
+                if min_lat <= self.restaurants[number][2] <= max_lat
+                and min_long <= self.restaurants[number][3] <= max_long]
+
+    def save(self, output_file):
+        os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump({'services': self.services, 'restaurants': self.restaurants}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, input_file):
+        with open(input_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        index = cls(data['services'], data['restaurants'])
+        index.source = [os.path.abspath(input_file), os.path.getmtime(input_file)]
+        return index
+
+
+@timed("build_coverage_index")
+def build_coverage_index(ttl_folder='data/ttl'):
+    """
+    Build the coverage index of the service and restaurant Turtle files.
+
+    Args:
+        ttl_folder (str): Folder of Turtle files, e.g. data/ttl.
+
+    Returns:
+        CoverageIndex: The index.
+    """
+    index = CoverageIndex()
+    offer_folder = os.path.join(ttl_folder, 'offer') + os.sep
+    for service, files in service_files(ttl_folder).items():
+        # The menus are not needed, only the service and restaurant files are read
+        g = Graph()
+        for file in files:
+            if not file.startswith(offer_folder):
+                with span("graph.parse"):
+                    g.parse(file, format='turtle')
+        service_iri = next(g.subjects(RDF.type, SCHEMA.Service), None)
+        center, locality = None, None
+        for place in g.objects(service_iri, SCHEMA.areaServed) if service_iri else ():
+            center = coordinates(g, place)
+            locality = g.value(g.value(place, SCHEMA.address), SCHEMA.addressLocality)
+        restaurants = []
+        for restaurant in sorted(g.subjects(RDF.type, SCHEMA.Restaurant)):
+            location = coordinates(g, restaurant)
+            if location:
+                restaurants.append((str(restaurant), str(g.value(restaurant, SCHEMA.name) or ""), *location))
+        index.add_service(service, str(service_iri) if service_iri else None,
+                          str(locality) if locality else None, center, restaurants)
+
+    index._prepare()
+    count("coverage_index.services", len(index.services))
+    count("coverage_index.restaurants", len(index.restaurants))
+    return index
@@ -0,0 +1,294 @@
+"""
+crawl_archive.py
+
+Compressed archives of the crawl: CrawlArchive holds the crawled JSON-LD records and
+HtmlArchive the raw pages they were extracted from.
+
+CrawlArchive is a JSON-lines alternative to one indented JSON file per service,
+restaurant and offer.
+
+The archive is a folder holding one file per delivery service, {service}.jsonl.gz
+(or .jsonl.zst with the optional zstandard package), to which each crawled record
+is appended as one JSON line:
+
+    {"kind": "offer", "folder": "0-a2roo", "name": "11-dz-envies", "jsonld": [...]}
+
+Each line is compressed as its own gzip member (or zstd frame), so that the file is
+still a valid stream for zcat, and a record can be read alone from its offset.
+index.json maps every service, kind and restaurant ID to the offset and length of
+its latest record.
+
+HtmlArchive is a WARC-like capture of the raw responses: one {host}.html.gz file per
+host, holding one gzip member per response (a JSON header line with the URL, fetch
+time, status and content type, followed by the body), and an index.json of the
+fetches of every URL, so that the extraction can be replayed without network.
+"""
+
+import io
+import os
+import gzip
+import json
+import time
+from urllib.parse import urlsplit
+from instrumentation import timed, span, count
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+INDEX_FILE = 'index.json'
+
+EXTENSIONS = {'gzip': '.jsonl.gz', 'zstd': '.jsonl.zst'}
+
+
+def compress(data, compression):
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def decompress(data, compression):
+    if compression == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return gzip.decompress(data)
+
+
+def record_id(name):
+    """
+    Restaurant ID of a record name, e.g. "11-dz-envies" -> "11".
+    """
+    return name.split('-', 1)[0]
+
+
+class CrawlArchive:
+    """
+    Compressed JSON-lines archive of crawled records, partitioned by service.
+
+    Usage:
+        with CrawlArchive('data/archive') as archive:
+            archive.append('restaurant', '0-a2roo', '11-dz-envies', jsonld_data)
+        record = CrawlArchive('data/archive').get('a2roo', '11', 'offer')
+    """
+
+    def __init__(self, folder, compression='gzip'):
+        if compression not in EXTENSIONS:
+            raise ValueError(f"Unsupported compression: {compression}")
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        self.folder = folder
+        self.compression = compression
+        self.files = {}
+        self.index = {}
+        index_file = os.path.join(folder, INDEX_FILE)
+        if os.path.exists(index_file):
+            with open(index_file, 'r', encoding='utf-8') as f:
+                self.index = json.load(f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def service_file(self, service, compression=None):
+        return os.path.join(self.folder, service + EXTENSIONS[compression or self.compression])
+
+    @timed("crawl_archive.append")
+    def append(self, kind, folder, name, jsonld_data):
+        """
+        Append a record to the file of its service and index it.
+
+        Args:
+            kind (str): 'service', 'restaurant' or 'offer'.
+            folder (str): Service folder of the record, e.g. "0-a2roo".
+            name (str): Name of the record, e.g. "11-dz-envies" for a restaurant or
+                "0-a2roo" for a service.
+            jsonld_data (list): The JSON-LD of the record.
+        """
+        service = folder.split('-', 1)[-1]
+        f = self.files.get(service)
+        if f is None:
+            os.makedirs(self.folder, exist_ok=True)
+            f = self.files[service] = open(self.service_file(service), 'ab')
+        line = json.dumps({'kind': kind, 'folder': folder, 'name': name, 'jsonld': jsonld_data},
+                          ensure_ascii=False, separators=(',', ':')) + '\n'
+        with span("crawl_archive.compress"):
+            data = compress(line.encode('utf-8'), self.compression)
+        offset = f.tell()
+        f.write(data)
+        # A record written again, e.g. by a later crawl, replaces the indexed one
+        self.index.setdefault(service, {}).setdefault(kind, {})[record_id(name)] = [self.compression, offset, len(data)]
+        count("crawl_archive.records")
+        count("crawl_archive.bytes", len(data))
+
+    def get(self, service, restaurant_id, kind='restaurant'):
+        """
+        Read the latest record of a restaurant (or of a service, with kind='service'
+        and its folder number as restaurant_id) from its offset.
+
+        Returns:
+            dict: The record, with its kind, folder, name and jsonld, or None if not archived.
+        """
+        entry = self.index.get(service, {}).get(kind, {}).get(str(restaurant_id))
+        if entry is None:
+            return None
+        compression, offset, length = entry
+        # The records appended since the archive was opened are not flushed yet
+        if service in self.files:
+            self.files[service].flush()
+        with open(self.service_file(service, compression), 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        return json.loads(decompress(data, compression))
+
+    def latest_records(self):
+        """
+        Generator over the latest record of every service, restaurant and offer of the
+        index, service by service, each file being read once in the order of the offsets.
+        """
+        for f in self.files.values():
+            f.flush()
+        for service in sorted(self.index):
+            entries = sorted((compression, offset, length) for kind in self.index[service].values()
+                             for compression, offset, length in kind.values())
+            files = {}
+            try:
+                for compression, offset, length in entries:
+                    if compression not in files:
+                        files[compression] = open(self.service_file(service, compression), 'rb')
+                    files[compression].seek(offset)
+                    yield json.loads(decompress(files[compression].read(length), compression))
+            finally:
+                for f in files.values():
+                    f.close()
+
+    def records(self):
+        """
+        Generator over every record of the archive, service by service, in the order
+        they were appended, including the records replaced by a later one.
+        """
+        for f in self.files.values():
+            f.flush()
+        for file in sorted(os.listdir(self.folder)) if os.path.isdir(self.folder) else []:
+            path = os.path.join(self.folder, file)
+            if file.endswith(EXTENSIONS['gzip']):
+                stream = gzip.open(path, 'rt', encoding='utf-8')
+            elif file.endswith(EXTENSIONS['zstd']):
+                if zstandard is None:
+                    raise ValueError(f"Reading {path} requires the zstandard package")
+                # One frame per record, read across the frames
+                reader = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True,
+                                                                    closefd=True)
+                stream = io.TextIOWrapper(reader, encoding='utf-8')
+            else:
+                continue
+            with stream:
+                for line in stream:
+                    if line.strip():
+                        yield json.loads(line)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        if self.index:
+            os.makedirs(self.folder, exist_ok=True)
+            with open(os.path.join(self.folder, INDEX_FILE), 'w', encoding='utf-8') as f:
+                json.dump(self.index, f)
+
+
+class HtmlArchive:
+    """
+    Compressed archive of raw HTTP responses, keyed by URL and fetch time.
+
+    Usage:
+        with HtmlArchive('data/html') as html_archive:
+            html_archive.append(url, html, 200, 'text/html')
+        html = HtmlArchive('data/html').get(url)
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.files = {}
+        self.index = {}
+        index_file = os.path.join(folder, INDEX_FILE)
+        if os.path.exists(index_file):
+            with open(index_file, 'r', encoding='utf-8') as f:
+                self.index = json.load(f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @timed("html_archive.append")
+    def append(self, url, body, status=200, content_type=None, fetched_at=None):
+        """
+        Append a response to the file of its host and index it.
+        """
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        file = (urlsplit(url).hostname or 'unknown') + '.html.gz'
+        f = self.files.get(file)
+        if f is None:
+            os.makedirs(self.folder, exist_ok=True)
+            f = self.files[file] = open(os.path.join(self.folder, file), 'ab')
+        header = json.dumps({'url': url, 'fetched_at': fetched_at, 'status': status, 'content_type': content_type})
+        with span("crawl_archive.compress"):
+            data = gzip.compress((header + '\n' + body).encode('utf-8'), compresslevel=6)
+        offset = f.tell()
+        f.write(data)
+        self.index.setdefault(url, []).append([fetched_at, file, offset, len(data)])
+        count("html_archive.responses")
+        count("html_archive.bytes", len(data))
+
+    def entry(self, url, fetched_at=None):
+        """
+        Index entry [fetch time, file, offset, length] of the latest fetch of a URL, or
+        of its latest fetch at or before a time.
+        """
+        entries = [entry for entry in self.index.get(url, []) if fetched_at is None or entry[0] <= fetched_at]
+        return max(entries, key=lambda entry: entry[0]) if entries else None
+
+    def latest_entries(self):
+        """
+        Generator over the URLs of the archive and the index entry of their latest fetch.
+        """
+        for url in self.index:
+            yield url, self.entry(url)
+
+    def get(self, url, fetched_at=None):
+        """
+        Body of the latest fetch of a URL (at or before fetched_at if given), or None.
+        """
+        entry = self.entry(url, fetched_at)
+        if entry is None:
+            return None
+        for f in self.files.values():
+            f.flush()
+        return read_html_entry(self.folder, entry)[1]
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        if self.index:
+            os.makedirs(self.folder, exist_ok=True)
+            with open(os.path.join(self.folder, INDEX_FILE), 'w', encoding='utf-8') as f:
+                json.dump(self.index, f)
+
+
+def read_html_entry(folder, entry):
+    """
+    Read a response of an HtmlArchive from its index entry.
+
+    Returns:
+        tuple: The header (url, fetched_at, status, content_type) and the body.
+    """
+    _, file, offset, length = entry
+    with open(os.path.join(folder, file), 'rb') as f:
+        f.seek(offset)
+        data = gzip.decompress(f.read(length)).decode('utf-8')
+    header, _, body = data.partition('\n')
+    return json.loads(header), body
@@ -0,0 +1,284 @@
+"""
+crawl_frontier.py
+
+Persistent crawl frontier of the restaurant pages, with adaptive refresh scheduling.
+
+The frontier is a SQLite database (data/crawl/frontier.sqlite) of every restaurant
+page found in the shops lists of the services. URLs are normalized, so that a page
+linked several times, or from several services, is crawled once.
+
+Each fetch records a hash of the JSON-LD extracted from the page, so the change
+history of every page is known. The refresh interval of a page is halved when its
+data changed since the last fetch and grows by half when it did not, between
+MIN_INTERVAL and MAX_INTERVAL: volatile menus are refreshed often and static ones
+rarely. A run fetches the most overdue pages first, within a request budget.
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+from urllib.parse import urljoin, urlsplit, urlunsplit
+from instrumentation import timed, span, count
+from jsonld_parser import (extract_coopcycle_service_urls, extract_restaurant_urls, scrape_html,
+                           parse_jsonld_scripts, parse_offer_jsonld, correct_restaurant_jsonld, save_record)
+
+DAY = 24 * 3600
+
+# Bounds of the refresh interval of a page, in seconds
+INITIAL_INTERVAL = DAY
+MIN_INTERVAL = 6 * 3600
+MAX_INTERVAL = 30 * DAY
+
+# Factors applied to the interval after a fetch which found changed or unchanged data
+CHANGED_FACTOR = 0.5
+UNCHANGED_FACTOR = 1.5
+
+# HTTP requests of a restaurant page: its JSON-LD and its menu are parsed from one response
+REQUESTS_PER_PAGE = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT PRIMARY KEY,
+    service_url TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    name TEXT NOT NULL,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    listed INTEGER NOT NULL DEFAULT 1,
+    last_fetched REAL,
+    last_changed REAL,
+    content_hash TEXT,
+    fetches INTEGER NOT NULL DEFAULT 0,
+    changes INTEGER NOT NULL DEFAULT 0,
+    interval REAL NOT NULL,
+    next_fetch REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pages_next_fetch ON pages (listed, next_fetch);
+CREATE TABLE IF NOT EXISTS fetches (
+    url TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    ok INTEGER NOT NULL,
+    content_hash TEXT,
+    changed INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fetches_url ON fetches (url, fetched_at);
+"""
+
+
+def normalize_url(url, base=None):
+    """
+    Normalize a page URL: absolute, lowercase scheme and host, no default port,
+    query, fragment or trailing slash, e.g. "/en/restaurant/11-dz-envies/#menu" on
+    "https://A2roo.coopcycle.org" -> "https://a2roo.coopcycle.org/en/restaurant/11-dz-envies".
+    """
+    parts = urlsplit(urljoin(base, url) if base else url)
+    host = parts.hostname or ''
+    if parts.port and (parts.scheme, parts.port) not in (('http', 80), ('https', 443)):
+        host += f":{parts.port}"
+    return urlunsplit((parts.scheme.lower(), host, parts.path.rstrip('/'), '', ''))
+
+
+def content_hash(jsonld_data):
+    """
+    Hash of the extracted JSON-LD of a page, independent of the order of its keys.
+    """
+    return hashlib.sha1(json.dumps(jsonld_data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def next_interval(interval, changed):
+    """
+    Refresh interval of a page after a fetch.
+    """
+    factor = CHANGED_FACTOR if changed else UNCHANGED_FACTOR
+    return min(MAX_INTERVAL, max(MIN_INTERVAL, interval * factor))
+
+
+class CrawlFrontier:
+    """
+    Frontier of restaurant pages stored in SQLite.
+
+    Args:
+        db_file (str): Database file, created if missing.
+    """
+
+    def __init__(self, db_file='data/crawl/frontier.sqlite'):
+        os.makedirs(os.path.dirname(db_file) or '.', exist_ok=True)
+        self.db = sqlite3.connect(db_file)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def add_page(self, url, service_url, folder, now=None):
+        """
+        Add a restaurant page found in a shops list, or mark a known one as still listed.
+
+        Returns:
+            bool: True if the page is new.
+        """
+        now = time.time() if now is None else now
+        service_url = normalize_url(service_url)
+        url = normalize_url(url, service_url)
+        name = url.rsplit('/', 1)[-1]
+        cursor = self.db.execute(
+            "UPDATE pages SET last_seen = ?, listed = 1 WHERE url = ?", (now, url))
+        if cursor.rowcount:
+            return False
+        # New pages are due at once
+        self.db.execute(
+            "INSERT INTO pages (url, service_url, folder, name, first_seen, last_seen, interval, next_fetch) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (url, service_url, folder, name, now, now, INITIAL_INTERVAL, now))
+        return True
+
+    def unlist_missing(self, service_url, since):
+        """
+        Stop scheduling the pages of a service which were not seen in its shops list since a time.
+
+        Returns:
+            int: Number of pages no longer listed.
+        """
+        cursor = self.db.execute(
+            "UPDATE pages SET listed = 0 WHERE service_url = ? AND last_seen < ? AND listed = 1",
+            (normalize_url(service_url), since))
+        return cursor.rowcount
+
+    def due_pages(self, limit, now=None):
+        """
+        Pages due for a fetch, never fetched ones first, then the most overdue relative
+        to their interval.
+        """
+        now = time.time() if now is None else now
+        return self.db.execute(
+            "SELECT * FROM pages WHERE listed = 1 AND next_fetch <= ? "
+            "ORDER BY last_fetched IS NOT NULL, (? - next_fetch) / interval DESC LIMIT ?",
+            (now, now, limit)).fetchall()
+
+    def record_fetch(self, url, jsonld_data, now=None):
+        """
+        Record the result of a fetch and schedule the next one.
+
+        Args:
+            url (str): Normalized page URL.
+            jsonld_data: Data extracted from the page, or None if the fetch failed.
+
+        Returns:
+            bool: True if the data changed since the last fetch (or is new).
+        """
+        now = time.time() if now is None else now
+        page = self.db.execute("SELECT * FROM pages WHERE url = ?", (url,)).fetchone()
+        if jsonld_data is None:
+            # Failed fetches are retried after the minimum interval, without changing the interval
+            self.db.execute("UPDATE pages SET next_fetch = ? WHERE url = ?", (now + MIN_INTERVAL, url))
+            self.db.execute("INSERT INTO fetches VALUES (?, ?, 0, NULL, 0)", (url, now))
+            return False
+
+        new_hash = content_hash(jsonld_data)
+        changed = new_hash != page['content_hash']
+        # The first fetch tells nothing about the change rate of a page
+        interval = next_interval(page['interval'], changed) if page['content_hash'] else page['interval']
+        self.db.execute(
+            "UPDATE pages SET last_fetched = ?, last_changed = CASE WHEN ? THEN ? ELSE last_changed END, "
+            "content_hash = ?, fetches = fetches + 1, changes = changes + ?, interval = ?, next_fetch = ? "
+            "WHERE url = ?",
+            (now, changed, now, new_hash, int(changed and page['content_hash'] is not None),
+             interval, now + interval, url))
+        self.db.execute("INSERT INTO fetches VALUES (?, ?, 1, ?, ?)", (url, now, new_hash, int(changed)))
+        return changed
+
+    def history(self, url):
+        """
+        Fetches of a page, oldest first, as (time, ok, content hash, changed) rows.
+        """
+        return self.db.execute("SELECT fetched_at, ok, content_hash, changed FROM fetches WHERE url = ? "
+                               "ORDER BY fetched_at", (normalize_url(url),)).fetchall()
+
+    def status(self, now=None):
+        """
+        Summary of the frontier: pages, listed pages, due pages, and the intervals.
+        """
+        now = time.time() if now is None else now
+        return dict(self.db.execute(
+            "SELECT COUNT(*) AS pages, SUM(listed) AS listed, "
+            "SUM(listed AND next_fetch <= ?) AS due, SUM(last_fetched IS NULL) AS never_fetched, "
+            "MIN(interval) / 3600.0 AS min_interval_hours, AVG(interval) / 3600.0 AS avg_interval_hours, "
+            "MAX(interval) / 3600.0 AS max_interval_hours FROM pages", (now,)).fetchone())
+
+    def commit(self):
+        self.db.commit()
+
+
+"""
+FUNCTIONS TO CRAWL WITH THE FRONTIER
+"""
+@timed("discover_restaurants")
+def discover_restaurants(frontier, service_urls=None):
+    """
+    Add the restaurant pages of the shops list of every service to the frontier.
+
+    Returns:
+        dict: Number of pages listed, new pages, and pages no longer listed.
+    """
+    service_urls = service_urls or extract_coopcycle_service_urls()
+    summary = {'listed': 0, 'new': 0, 'unlisted': 0}
+    for i, service_url in enumerate(service_urls):
+        service = service_url.split("://")[1].split(".coopcycle.org")[0]
+        started = time.time()
+        restaurant_urls = extract_restaurant_urls(service_url + '/en/shops')
+        if not restaurant_urls:
+            print(f"{i:<6}{service_url:<90}Cannot find shops-list", file=sys.stderr)
+            continue
+        for restaurant_url in restaurant_urls:
+            summary['listed'] += 1
+            summary['new'] += frontier.add_page(restaurant_url, service_url, f'{i}-{service}', started)
+        summary['unlisted'] += frontier.unlist_missing(service_url, started)
+        frontier.commit()
+    count("frontier.new_pages", summary['new'])
+    return summary
+
+
+@timed("crawl_due_pages")
+def crawl_due_pages(frontier, budget=500, archive=None):
+    """
+    Fetch the due restaurant pages within a request budget, saving the restaurant and
+    offer records of the pages whose data changed (see save_record).
+
+    Args:
+        frontier (CrawlFrontier): The frontier.
+        budget (int): Maximum number of HTTP requests of the run.
+        archive (CrawlArchive): Archive receiving the records, or None for data/jsonld files.
+
+    Returns:
+        dict: Number of pages fetched, changed, unchanged and failed, and of requests.
+    """
+    summary = {'fetched': 0, 'changed': 0, 'unchanged': 0, 'failed': 0, 'requests': 0}
+    for page in frontier.due_pages(budget // REQUESTS_PER_PAGE):
+        url, service_url = page['url'], page['service_url']
+        restaurant_url = url[len(service_url):]
+        with span("frontier.fetch"):
+            html_raw = scrape_html(url)
+        summary['requests'] += REQUESTS_PER_PAGE
+        summary['fetched'] += 1
+
+        restaurant_jsonld = parse_jsonld_scripts(html_raw) if html_raw else None
+        if not restaurant_jsonld:
+            frontier.record_fetch(url, None)
+            summary['failed'] += 1
+            continue
+        offer_jsonld = parse_offer_jsonld(html_raw, url)
+        correct_restaurant_jsonld(restaurant_jsonld, service_url, restaurant_url)
+        if frontier.record_fetch(url, [restaurant_jsonld, offer_jsonld]):
+            summary['changed'] += 1
+            save_record('restaurant', page['folder'], page['name'], restaurant_jsonld, archive)
+            if offer_jsonld:
+                save_record('offer', page['folder'], page['name'], offer_jsonld, archive)
+            print(f"{page['folder']:<40}{url:<90}changed")
+        else:
+            summary['unchanged'] += 1
+        frontier.commit()
+    count("frontier.requests", summary['requests'])
+    return summary
@@ -0,0 +1,371 @@
+"""
+facet_index.py
+
+Facet index of the menu items of data/ttl/offer, for the filters users apply the
+most: allergens, dietary needs, price and opening hours.
+
+Every menu item gets a number, and every facet (an allergen declared in
+schema:nutrition, or a dietary keyword found in the item, its section or its
+restaurant name) is stored as a bitset over the item numbers, a plain Python int.
+Combining filters is then a few AND / AND NOT operations on those ints, and a
+count is a popcount, instead of a SPARQL scan of the nested MenuItem blank nodes.
+"""
+
+import os
+import re
+import json
+import time
+import bisect
+from rdflib import Graph, Namespace
+from rdflib.namespace import RDF
+from instrumentation import timed, span, count
+from search_index import fold
+from restaurant_summary import weekly_intervals, WEEK
+from literal_normalization import parse_price_amount
+
+SCHEMA = Namespace("http://schema.org/")
+
+# Allergen labels of the crawled menus (folded), as listed by the CoopCycle shops
+ALLERGENS = {
+    'gluten': ["cereals containing gluten", "cereales contenant du gluten", "zerealak glutena dute"],
+    'milk': ["milk", "lait", "esnea"],
+    'eggs': ["eggs", "oeufs", "arrautzak"],
+    'soybeans': ["soybeans", "soja"],
+    'sesame': ["sesame seeds", "graines de sesame", "sesamo haziak"],
+    'tree_nuts': ["tree nuts", "fruits a coque"],
+    'fish': ["fish", "poisson"],
+    'mustard': ["mustard", "moutarde"],
+    'sulphites': ["sulphur dioxide and sulphites", "anhydride sulfureux et sulfites"],
+    'peanuts': ["peanuts", "arachides"],
+    'celery': ["celery", "celeri"],
+    'crustaceans': ["crustaceans", "crustaces"],
+    'lupin': ["lupin"],
+    'molluscs': ["molluscs", "mollusques"],
+}
+ALLERGEN_LABELS = {label: allergen for allergen, labels in ALLERGENS.items() for label in labels}
+
+# Dietary keywords searched in the folded item, section and restaurant names
+DIETS = {
+    'vegan': [r'\bvegan[aeo]?s?\b', r'\bvegetalien(ne)?s?\b'],
+    'vegetarian': [r'\bvegetarien(ne)?s?\b', r'\bvegetarian[aeio]?\b', r'\bveggie\b', r'\bvege\b'],
+    'gluten_free': [r'\bsans gluten\b', r'\bgluten[ -]?free\b', r'\bsenza glutine\b', r'\bsin gluten\b'],
+    'lactose_free': [r'\bsans lactose\b', r'\blactose[ -]?free\b', r'\bsenza lattosio\b', r'\bsin lactosa\b'],
+    'halal': [r'\bhalal\b'],
+    'organic': [r'\bbio\b', r'\borganic\b', r'\bbiologico\b'],
+}
+DIET_PATTERNS = {diet: re.compile('|'.join(patterns)) for diet, patterns in DIETS.items()}
+
+# Items with allergen information, to tell "declares no gluten" from "declares nothing"
+DECLARED = 'info:allergens'
+
+# Every facet name, so that a misspelt filter (e.g. allergen:glutn) is an error, not an empty facet
+FACETS = ({f"allergen:{allergen}" for allergen in list(ALLERGENS) + ['other']}
+          | {f"diet:{diet}" for diet in DIETS} | {DECLARED})
+
+# One cumulative price bitset every PRICE_STEP items, in price order
+PRICE_STEP = 256
+
+
+def item_facets(name, description, section, restaurant_name, allergens):
+    """
+    List the facets of a menu item.
+
+    Args:
+        name (str): Name of the item.
+        description (str): Description of the item.
+        section (str): Name of its menu section, e.g. "Plats végétariens".
+        restaurant_name (str): Name of its restaurant, e.g. "Santo Falafel | Cibo Siriano Vegano".
+        allergens (list): The schema:nutrition labels of the item.
+
+    Returns:
+        set: Facet names, e.g. {'allergen:milk', 'diet:vegetarian', 'info:allergens'}.
+    """
+    facets = set()
+    for label in allergens:
+        allergen = ALLERGEN_LABELS.get(fold(label).strip())
+        facets.add(f"allergen:{allergen or 'other'}")
+    if allergens:
+        facets.add(DECLARED)
+
+    text = fold(" ".join(str(part) for part in [name, description, section, restaurant_name] if part))
+    for diet, pattern in DIET_PATTERNS.items():
+        if pattern.search(text):
+            facets.add(f"diet:{diet}")
+    if 'diet:vegan' in facets:
+        facets.add('diet:vegetarian')
+    return facets
+
+
+def bits(numbers):
+    """
+    Build the bitset of a list of item numbers.
+    """
+    result = 0
+    for number in numbers:
+        result |= 1 << number
+    return result
+
+
+def minute_of_week(day, time_text):
+    """
+    Convert a day name and "HH:MM" to minutes since Monday 00:00.
+
+    Raises:
+        ValueError: If the day or the time is not valid.
+    """
+    if day.capitalize() not in WEEK:
+        raise ValueError(f"Unknown day: {day}")
+    hours, mins = (time_text.split(':') + [''])[:2]
+    if not (hours.isdigit() and mins.isdigit() and int(hours) < 24 and int(mins) < 60):
+        raise ValueError(f"Invalid time: {time_text}, expected HH:MM")
+    return WEEK.index(day.capitalize()) * 24 * 60 + int(hours) * 60 + int(mins)
+
+
+def parse_open_at(open_at):
+    """
+    Convert "now", or a day and time such as "Monday 12:30", to minutes since
+    Monday 00:00, or None if open_at is empty.
+
+    Raises:
+        ValueError: If open_at is neither "now" nor a valid day and time.
+    """
+    if not open_at:
+        return None
+    if open_at == 'now':
+        now = time.localtime()
+        return now.tm_wday * 24 * 60 + now.tm_hour * 60 + now.tm_min
+    parts = open_at.split()
+    if len(parts) != 2:
+        raise ValueError(f'Expected "now" or a day and time such as "Monday 12:30", not "{open_at}"')
+    return minute_of_week(*parts)
+
+
+class FacetIndex:
+    """
+    Bitset index of menu items by facet, price, restaurant and opening hours.
+
+    Attributes:
+        restaurants (list): Indexed restaurants as [IRI, name, weekly opening intervals].
+        items (list): Indexed menu items as [restaurant number, item name, price amount].
+        facets (dict): Facet name -> bitset of the items having it.
+        restaurant_items (list): Bitset of the items of each restaurant.
+    """
+
+    def __init__(self, restaurants=None, items=None, facets=None, restaurant_items=None):
+        self.restaurants = restaurants or []
+        self.items = items or []
+        self.facets = facets or {}
+        self.restaurant_items = restaurant_items or []
+        self._prepare()
+
+    def _prepare(self):
+        # Items sorted by price, with a cumulative bitset every PRICE_STEP items
+        self.all_items = (1 << len(self.items)) - 1
+        self.price_order = sorted((item for item, (_, _, price) in enumerate(self.items) if price is not None),
+                                  key=lambda item: self.items[item][2])
+        self.prices = [self.items[item][2] for item in self.price_order]
+        self.price_checkpoints = [0]
+        for start in range(0, len(self.price_order), PRICE_STEP):
+            chunk = bits(self.price_order[start:start + PRICE_STEP])
+            self.price_checkpoints.append(self.price_checkpoints[-1] | chunk)
+
+    def add_restaurant(self, iri, name, open_intervals):
+        self.restaurants.append([iri, name, open_intervals])
+        self.restaurant_items.append(0)
+        return len(self.restaurants) - 1
+
+    def add_item(self, restaurant, name, price, facets):
+        item = len(self.items)
+        self.items.append([restaurant, name, price])
+        self.restaurant_items[restaurant] |= 1 << item
+        for facet in facets:
+            self.facets[facet] = self.facets.get(facet, 0) | (1 << item)
+        return item
+
+    def price_at_most(self, max_price):
+        """
+        Bitset of the items costing at most max_price.
+        """
+        end = bisect.bisect_right(self.prices, max_price)
+        checkpoint = end // PRICE_STEP
+        return self.price_checkpoints[checkpoint] | bits(self.price_order[checkpoint * PRICE_STEP:end])
+
+    def open_at(self, minute):
+        """
+        Bitset of the items of the restaurants open at a minute of the week
+        (minutes since Monday 00:00).
+        """
+        week = 7 * 24 * 60
+        result = 0
+        for restaurant, (_, _, intervals) in enumerate(self.restaurants):
+            # An interval starting on Sunday evening ends after the end of the week
+            if any(start <= minute < end or start <= minute + week < end for start, end in intervals):
+                result |= self.restaurant_items[restaurant]
+        return result
+
+    @timed("facet_index.filter")
+    def filter(self, include=(), exclude=(), max_price=None, open_at=None):
+        """
+        Combine filters into the bitset of the matching items.
+
+        Args:
+            include (list): Facets the items must have, e.g. ['diet:vegan'].
+            exclude (list): Facets the items must not have, e.g. ['allergen:gluten'].
+                Items without allergen information are kept unless 'info:allergens' is included.
+            max_price (float): Maximum price of the items.
+            open_at (int): Minute of the week at which the restaurant must be open.
+
+        Raises:
+            KeyError: If a facet is not in FACETS.
+        """
+        result = self.all_items
+        for facet in include:
+            result &= self.facets[facet] if facet in self.facets else self._unknown(facet)
+        for facet in exclude:
+            result &= ~(self.facets[facet] if facet in self.facets else self._unknown(facet))
+        if max_price is not None:
+            result &= self.price_at_most(max_price)
+        if open_at is not None:
+            result &= self.open_at(open_at)
+        return result
+
+    def _unknown(self, facet):
+        # A facet of the vocabulary with no item, e.g. an allergen absent from every menu
+        if facet in FACETS:
+            return 0
+        raise KeyError(f"Unknown facet: {facet} (known facets: {', '.join(sorted(FACETS))})")
+
+    def query(self, include=(), exclude=(), max_price=None, open_at=None, limit=20):
+        """
+        Filter the items and count the results.
+
+        Returns:
+            dict: The number of matching items and restaurants, the number of matching
+                items without allergen information ('undeclared', kept by the allergen
+                exclusions), the restaurants with the most matching items (up to limit)
+                and the number of matching items for every facet.
+        """
+        result = self.filter(include, exclude, max_price, open_at)
+        restaurants = []
+        for restaurant, items in enumerate(self.restaurant_items):
+            matching = (result & items).bit_count()
+            if matching:
+                restaurants.append((matching, restaurant))
+        restaurants.sort(key=lambda entry: (-entry[0], self.restaurants[entry[1]][1]))
+
+        count("facet_index.queries")
+        return {
+            'items': result.bit_count(),
+            'restaurants': len(restaurants),
+            'undeclared': (result & ~self.facets.get(DECLARED, 0)).bit_count(),
+            'top_restaurants': [{'restaurant': self.restaurants[restaurant][0],
+                                 'name': self.restaurants[restaurant][1],
+                                 'items': matching} for matching, restaurant in restaurants[:limit]],
+            'facets': {facet: (result & facet_bits).bit_count()
+                       for facet, facet_bits in sorted(self.facets.items())},
+        }
+
+    def matching_items(self, bitset, limit=20):
+        """
+        List the first items of a bitset as (restaurant name, item name, price).
+        """
+        found = []
+        while bitset and len(found) < limit:
+            item = (bitset & -bitset).bit_length() - 1
+            restaurant, name, price = self.items[item]
+            found.append((self.restaurants[restaurant][1], name, price))
+            bitset &= bitset - 1
+        return found
+
+    def save(self, output_file):
+        """
+        Save the index as JSON, with the bitsets as hexadecimal strings.
+        """
+        os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump({'restaurants': self.restaurants, 'items': self.items,
+                       'facets': {facet: format(value, 'x') for facet, value in self.facets.items()},
+                       'restaurant_items': [format(value, 'x') for value in self.restaurant_items]},
+                      f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, input_file):
+        with open(input_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data['restaurants'], data['items'],
+                   {facet: int(value, 16) for facet, value in data['facets'].items()},
+                   [int(value, 16) for value in data['restaurant_items']])
+
+
+@timed("build_facet_index")
+def build_facet_index(ttl_folder='data/ttl'):
+    """
+    Build the facet index from the restaurant and offer Turtle files.
+
+    The restaurant file data/ttl/restaurant/{i}-{service}/{file}.ttl is read with the
+    offer file of the same name, as for the restaurant summaries.
+
+    Returns:
+        FacetIndex: The index of every menu item.
+    """
+    index = FacetIndex()
+    restaurant_folder = os.path.join(ttl_folder, 'restaurant')
+
+    for root, dirs, files in os.walk(restaurant_folder):
+        dirs.sort()
+        for file in sorted(files):
+            if not file.endswith('.ttl'):
+                continue
+            g = Graph()
+            with span("graph.parse"):
+                g.parse(os.path.join(root, file), format='turtle')
+                offer_file = os.path.join(root.replace(restaurant_folder, os.path.join(ttl_folder, 'offer'), 1), file)
+                if os.path.exists(offer_file):
+                    g.parse(offer_file, format='turtle')
+
+            for restaurant in sorted(g.subjects(RDF.type, SCHEMA.Restaurant)):
+                restaurant_name = str(g.value(restaurant, SCHEMA.name) or "")
+                number = index.add_restaurant(str(restaurant), restaurant_name, weekly_intervals(g, restaurant))
+                for menu in g.objects(restaurant, SCHEMA.hasMenu):
+                    for section in g.objects(menu, SCHEMA.hasMenuSection):
+                        section_name = g.value(section, SCHEMA.name)
+                        for menu_item in g.objects(section, SCHEMA.hasMenuItem):
+                            name = g.value(menu_item, SCHEMA.name)
+                            price = g.value(g.value(menu_item, SCHEMA.offers), SCHEMA.price)
+                            facets = item_facets(name, g.value(menu_item, SCHEMA.description), section_name,
+                                                 restaurant_name, list(g.objects(menu_item, SCHEMA.nutrition)))
+                            index.add_item(number, str(name or ""),
+                                           parse_price_amount(price) if price is not None else None, facets)
+
+    index._prepare()
+    count("facet_index.items", len(index.items))
+    return index
+
+
+def filter_menu_items(include=(), exclude=(), max_price=None, open_at=None, index_file='data/index/facets.json',
+                      ttl_folder='data/ttl', limit=20):
+    """
+    Filter the menu items, building the index first if it does not exist.
+
+    Args:
+        open_at (str): "now", or a day and time such as "Monday 12:30".
+
+    Returns:
+        tuple: The query result, the first matching items and the filter time in milliseconds.
+
+    Raises:
+        ValueError: If open_at is not valid.
+        KeyError: If a facet is not in FACETS.
+    """
+    minute = parse_open_at(open_at)
+    if os.path.exists(index_file):
+        index = FacetIndex.load(index_file)
+    else:
+        index = build_facet_index(ttl_folder)
+        index.save(index_file)
+
+    start = time.perf_counter()
+    result = index.query(include, exclude, max_price, minute, limit)
+    elapsed = (time.perf_counter() - start) * 1000
+    items = index.matching_items(index.filter(include, exclude, max_price, minute), limit)
+    return result, items, elapsed
@@ -0,0 +1,212 @@
+"""
+graph_sync.py
+
+Compute the difference between a local RDF file and a named graph of the Fuseki
+server, and push only that difference to the server.
+
+Ground triples (without blank nodes) are compared as sets. Blank nodes, such as the
+nested menu sections, items and offers, are compared as trees: every tree of blank
+nodes hanging from a named resource gets a content hash, so two trees are equal
+when they describe the same data, whatever their blank node labels. A changed menu
+item therefore replaces its menu section only, not the whole graph.
+"""
+
+import hashlib
+from collections import namedtuple
+from rdflib import Graph, BNode
+from rdflib.compare import isomorphic
+from instrumentation import span
+
+GraphDiff = namedtuple('GraphDiff', ['inserted', 'deleted', 'inserted_trees', 'deleted_trees'])
+
+
+class NotATreeError(ValueError):
+    """
+    Raised when the blank nodes of a graph are shared or cyclic, so they cannot be
+    compared tree by tree.
+    """
+
+
+def blank_node_trees(graph):
+    """
+    Split a graph into its ground triples and its trees of blank nodes.
+
+    Returns:
+        tuple: The set of ground triples, and a dict mapping the hash of each tree
+            to the list of its triples. A tree holds the triple linking its root
+            blank node to its parent (if any) and every triple below the root.
+
+    Raises:
+        NotATreeError: If a blank node is the object of more than one triple, belongs
+            to a cycle or if two trees are identical.
+    """
+    parents = {}
+    children = {}
+    ground = set()
+    for s, p, o in graph:
+        if isinstance(o, BNode):
+            if o in parents:
+                raise NotATreeError(f"Blank node {o} is shared by several triples")
+            parents[o] = (s, p)
+        if isinstance(s, BNode):
+            children.setdefault(s, []).append((s, p, o))
+        elif not isinstance(o, BNode):
+            ground.add((s, p, o))
+
+    hashes = {}
+
+    def tree_hash(node, visiting):
+        if node in hashes:
+            return hashes[node]
+        if node in visiting:
+            raise NotATreeError(f"Blank node {node} belongs to a cycle")
+        visiting.add(node)
+        parts = sorted(f"{p.n3()} {tree_hash(o, visiting) if isinstance(o, BNode) else o.n3()}"
+                       for _, p, o in children.get(node, []))
+        visiting.discard(node)
+        hashes[node] = "_:" + hashlib.sha1("\n".join(parts).encode('utf-8')).hexdigest()
+        return hashes[node]
+
+    def tree_triples(node):
+        triples = []
+        for triple in children.get(node, []):
+            triples.append(triple)
+            if isinstance(triple[2], BNode):
+                triples.extend(tree_triples(triple[2]))
+        return triples
+
+    # A tree is rooted at a blank node whose parent is a named resource, or which has no parent
+    trees = {}
+    roots = {node for node in set(children) | set(parents)
+             if node not in parents or not isinstance(parents[node][0], BNode)}
+    for root in roots:
+        key = tree_hash(root, set())
+        triples = tree_triples(root)
+        if root in parents:
+            s, p = parents[root]
+            key = hashlib.sha1(f"{s.n3()} {p.n3()} {key}".encode('utf-8')).hexdigest()
+            triples.insert(0, (s, p, root))
+        trees[key] = triples
+
+    # Triples left out are part of a cycle, or of a tree identical to another one
+    if sum(len(triples) for triples in trees.values()) + len(ground) != len(graph):
+        raise NotATreeError("Some blank nodes belong to a cycle or to duplicated trees")
+    return ground, trees
+
+
+def diff_graphs(local, remote):
+    """
+    Compute the changes turning the remote graph into the local graph.
+
+    Args:
+        local (Graph): The graph to publish.
+        remote (Graph): The graph currently on the server.
+
+    Returns:
+        GraphDiff: Ground triples to insert and delete, and lists of blank node trees
+            (lists of triples) to insert and delete.
+    """
+    with span("graph_sync.diff"):
+        local_ground, local_trees = blank_node_trees(local)
+        remote_ground, remote_trees = blank_node_trees(remote)
+        return GraphDiff(
+            inserted=local_ground - remote_ground,
+            deleted=remote_ground - local_ground,
+            inserted_trees=[triples for key, triples in local_trees.items() if key not in remote_trees],
+            deleted_trees=[triples for key, triples in remote_trees.items() if key not in local_trees],
+        )
+
+
+def matches_exactly(graph, triples):
+    """
+    Check that the pattern of a blank node tree, its blank nodes being variables as in
+    UpdateBatcher.delete_matching, matches no other triples of the graph than the tree,
+    e.g. not a section with the same name and more items.
+    """
+    variables = {}
+    patterns = []
+    for triple in triples:
+        patterns.append(" ".join(f"?b{variables.setdefault(term, len(variables))}" if isinstance(term, BNode)
+                                 else term.n3() for term in triple) + " .")
+    matched = set()
+    for row in graph.query("SELECT * WHERE {\n" + "\n".join(patterns) + "\n}"):
+        values = {bnode: row[f"b{number}"] for bnode, number in variables.items()}
+        matched.update(tuple(values.get(term, term) for term in triple) for triple in triples)
+    tree = {tuple(term for term in triple) for triple in triples}
+    return matched == tree
+
+
+def diff_size(diff):
+    """
+    Number of triples to send to apply a diff.
+    """
+    return (len(diff.inserted) + len(diff.deleted)
+            + sum(len(triples) for triples in diff.inserted_trees + diff.deleted_trees))
+
+
+def sync_graph(handler, file_path, graph_uri, dry_run=False, batch_size=5000):
+    """
+    Synchronize a named graph of the server with a local RDF file.
+
+    The difference is pushed as DELETE DATA / INSERT DATA (and DELETE WHERE for blank
+    node trees) requests. When it is larger than the local graph, when the blank
+    nodes cannot be compared as trees, or when a deleted tree is not the only match of
+    its DELETE WHERE, the whole graph is replaced with a PUT instead.
+
+    Args:
+        handler (RDFHandler): Handler of the Fuseki server.
+        file_path (str): Path of the local RDF file.
+        graph_uri (str): URI of the named graph on the server.
+        dry_run (bool): Only compute and report the difference.
+        batch_size (int): Maximum number of triples per update request.
+
+    Returns:
+        dict: Summary of the synchronization.
+    """
+    local = Graph()
+    with span("graph.parse"):
+        local.parse(file_path)
+    remote = handler.download_graph_from_server(graph_uri)
+
+    try:
+        diff = diff_graphs(local, remote)
+        size = diff_size(diff)
+        method = 'put' if size > len(local) else 'update'
+        # A DELETE WHERE matching more than its tree would delete triples to keep
+        if method == 'update' and not all(matches_exactly(remote, triples) for triples in diff.deleted_trees):
+            method = 'put'
+    except NotATreeError:
+        # Fall back on a full comparison of the graphs
+        diff = None
+        size = None
+        method = 'none' if isomorphic(local, remote) else 'put'
+
+    if diff is not None and size == 0:
+        method = 'none'
+
+    summary = {
+        'graph': graph_uri,
+        'local_triples': len(local),
+        'remote_triples': len(remote),
+        'inserted': len(diff.inserted) + sum(len(t) for t in diff.inserted_trees) if diff else None,
+        'deleted': len(diff.deleted) + sum(len(t) for t in diff.deleted_trees) if diff else None,
+        'method': method,
+        'errors': [],
+    }
+    if dry_run or method == 'none':
+        return summary
+
+    if method == 'put':
+        handler.replace_graph_on_server(handler.serialize_rdf(local), graph_uri)
+        return summary
+
+    with handler.update_batcher(max_triples=batch_size) as batcher:
+        # Deletions first, so that a changed tree is replaced rather than duplicated
+        for triples in diff.deleted_trees:
+            batcher.delete_matching(triples, graph_uri)
+        batcher.delete(diff.deleted, graph_uri)
+        for triples in diff.inserted_trees:
+            batcher.insert(triples, graph_uri, atomic=True)
+        batcher.insert(diff.inserted, graph_uri)
+    summary['errors'] = [result.error for result in batcher.results if not result.ok]
+    return summary
@@ -0,0 +1,197 @@
+"""
+instrumentation.py
+
+Lightweight timers, spans and counters for the crawler, the converter and the
+query layer. Instrumentation is disabled by default: a disabled span or counter
+costs a single flag check, so the hot paths can stay instrumented in production.
+
+Metrics can be exported in the Prometheus text format or as JSON-lines, and a whole
+command can be run under cProfile to produce a report readable by pstats, snakeviz
+or flameprof.
+"""
+
+import json
+import time
+import cProfile
+import pstats
+import functools
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+_enabled = False
+_lock = threading.Lock()
+_local = threading.local()
+
+# Aggregated timings: name -> [count, total seconds, max seconds]
+_timings = {}
+# Counters: name -> value
+_counters = {}
+# Most recent spans, kept for the JSON-lines export
+_spans = deque(maxlen=100000)
+
+
+def enable():
+    """
+    Enable the collection of timings, spans and counters.
+    """
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """
+    Disable the collection, instrumented code then runs at full speed.
+    """
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """
+    Clear every collected metric.
+    """
+    with _lock:
+        _timings.clear()
+        _counters.clear()
+        _spans.clear()
+
+
+def count(name, value=1):
+    """
+    Increment a counter, e.g. the number of HTTP requests or parsed triples.
+    """
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+@contextmanager
+def span(name, **labels):
+    """
+    Time a block of code.
+
+    Args:
+        name (str): Name of the span, e.g. 'graph.parse'.
+        **labels: Extra attributes stored with the span, e.g. the file or URL.
+    """
+    if not _enabled:
+        yield
+        return
+
+    parent = getattr(_local, 'current', None)
+    _local.current = name
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        _local.current = parent
+        with _lock:
+            timing = _timings.setdefault(name, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += duration
+            timing[2] = max(timing[2], duration)
+            _spans.append({"name": name, "parent": parent, "start": time.time() - duration,
+                           "duration": duration, **labels})
+
+
+def timed(name):
+    """
+    Decorator timing every call of a function under the given span name.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+"""
+FUNCTIONS TO EXPORT METRICS
+"""
+def _metric_name(name):
+    return "coopcycle_" + "".join(c if c.isalnum() else "_" for c in name)
+
+
+def export_prometheus():
+    """
+    Export the collected metrics in the Prometheus text exposition format.
+
+    Returns:
+        str: Timings as summaries (count and sum in seconds) with their max as a gauge,
+            and counters as counters.
+    """
+    lines = []
+    with _lock:
+        for name, (calls, total, longest) in sorted(_timings.items()):
+            metric = _metric_name(name) + "_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            lines.append(f"{metric}_count {calls}")
+            lines.append(f"{metric}_sum {total:.6f}")
+            # A summary has no max sample, the max is a gauge family of its own
+            lines.append(f"# TYPE {_metric_name(name)}_max_seconds gauge")
+            lines.append(f"{_metric_name(name)}_max_seconds {longest:.6f}")
+        for name, value in sorted(_counters.items()):
+            metric = _metric_name(name) + "_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def export_jsonl():
+    """
+    Export the collected metrics as JSON-lines: one line per span, then one line per
+    aggregated timing and per counter.
+    """
+    with _lock:
+        records = [{"type": "span", **entry} for entry in _spans]
+        records += [{"type": "timing", "name": name, "count": calls, "sum": total, "max": longest}
+                    for name, (calls, total, longest) in sorted(_timings.items())]
+        records += [{"type": "counter", "name": name, "value": value}
+                    for name, value in sorted(_counters.items())]
+    return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+
+
+def write_metrics(output_file, output_format='prometheus'):
+    """
+    Write the collected metrics to a file, in 'prometheus' or 'jsonl' format.
+    """
+    if output_format not in ('prometheus', 'jsonl'):
+        raise ValueError(f"Unsupported metrics format: {output_format}")
+    content = export_prometheus() if output_format == 'prometheus' else export_jsonl()
+    with open(output_file, 'w', encoding='utf-8') as f:
+        f.write(content)
+
+
+"""
+FUNCTIONS TO PROFILE A COMMAND
+"""
+def profile_call(output_file, func, *args, **kwargs):
+    """
+    Run a function under cProfile and dump the statistics.
+
+    The binary output file can be opened with pstats, snakeviz or turned into a
+    flamegraph with flameprof; a text summary of the slowest calls is written next
+    to it with a '.txt' extension.
+
+    Returns:
+        The result of the function.
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        profiler.dump_stats(output_file)
+        with open(output_file + '.txt', 'w', encoding='utf-8') as f:
+            stats = pstats.Stats(profiler, stream=f)
+            stats.sort_stats('cumulative').print_stats(50)
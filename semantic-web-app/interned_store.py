@@ -0,0 +1,270 @@
+"""
+interned_store.py
+
+Compact in-memory rdflib store for loading the whole data/ttl corpus in process.
+
+The default rdflib store keeps every triple in three levels of nested dicts per
+index, holding a reference to the term objects at each level. The crawled data
+repeats the same terms heavily (schema.org predicates, service base URLs, image
+caches), so this store interns each term once in a term dictionary and keeps the
+triples as integer IDs, packed three per 64-bit integer, in sorted arrays:
+
+- SPO, POS and OSP permutations, each an array('Q') of packed keys, so any triple
+  pattern is a binary search for a key prefix followed by a contiguous scan.
+- Added triples wait in a small pending set, scanned by the lookups, and are
+  merged into the arrays in bulk; removed triples are skipped until the next merge.
+
+Usage:
+    import interned_store
+    g = Graph(store='Interned')
+"""
+
+import os
+import heapq
+from array import array
+from bisect import bisect_left
+from rdflib import Graph, plugin
+from rdflib.store import Store
+from instrumentation import timed, span, count
+
+# Bits of each term ID in a packed key, so at most 2**21 distinct terms
+ID_BITS = 21
+ID_MASK = (1 << ID_BITS) - 1
+MAX_TERMS = 1 << ID_BITS
+
+# Positions of subject (0), predicate (1) and object (2) in each permutation
+PERMUTATIONS = {'spo': (0, 1, 2), 'pos': (1, 2, 0), 'osp': (2, 0, 1)}
+
+# Permutation whose key prefix holds the bound positions of a pattern
+PATTERN_PERMUTATIONS = {
+    (): 'spo', (0,): 'spo', (0, 1): 'spo', (0, 1, 2): 'spo',
+    (1,): 'pos', (1, 2): 'pos', (2,): 'osp', (0, 2): 'osp',
+}
+
+# Size of the pending additions or removals that triggers a merge into the arrays
+MIN_MERGE = 4096
+
+
+def pack(a, b, c):
+    return (a << (2 * ID_BITS)) | (b << ID_BITS) | c
+
+
+def unpack(key):
+    return key >> (2 * ID_BITS), (key >> ID_BITS) & ID_MASK, key & ID_MASK
+
+
+class InternedStore(Store):
+    """
+    rdflib store keeping interned term IDs in sorted SPO, POS and OSP arrays.
+
+    The store is not context aware: use it for a Graph, not a Dataset.
+    """
+
+    context_aware = False
+    formula_aware = False
+    transaction_aware = False
+    graph_aware = False
+
+    def __init__(self, configuration=None, identifier=None):
+        super().__init__(configuration)
+        self.identifier = identifier
+        # Term dictionary: term -> ID and ID -> term
+        self._ids = {}
+        self._terms = []
+        self._indexes = {name: array('Q') for name in PERMUTATIONS}
+        # Packed SPO keys added or removed since the last merge
+        self._pending = set()
+        self._removed = set()
+        self._namespace = {}
+        self._prefix = {}
+
+    def _intern(self, term):
+        term_id = self._ids.get(term)
+        if term_id is None:
+            term_id = len(self._terms)
+            if term_id >= MAX_TERMS:
+                raise OverflowError(f"InternedStore holds at most {MAX_TERMS} distinct terms")
+            self._ids[term] = term_id
+            self._terms.append(term)
+        return term_id
+
+    def _contains_key(self, key):
+        index = self._indexes['spo']
+        position = bisect_left(index, key)
+        return position < len(index) and index[position] == key
+
+    def add(self, triple, context, quoted=False):
+        Store.add(self, triple, context, quoted)
+        key = pack(*(self._intern(term) for term in triple))
+        if key in self._removed:
+            self._removed.discard(key)
+        elif not self._contains_key(key):
+            self._pending.add(key)
+            if len(self._pending) >= max(MIN_MERGE, len(self._indexes['spo']) // 8):
+                self._merge()
+
+    def addN(self, quads):
+        for s, p, o, context in quads:
+            self.add((s, p, o), context)
+
+    def remove(self, triple_pattern, context=None):
+        for triple, _ in list(self.triples(triple_pattern)):
+            key = pack(*(self._ids[term] for term in triple))
+            if key in self._pending:
+                self._pending.discard(key)
+            else:
+                self._removed.add(key)
+        if len(self._removed) >= max(MIN_MERGE, len(self._indexes['spo']) // 8):
+            self._merge()
+
+    @timed("interned_store.merge")
+    def _merge(self):
+        """
+        Merge the pending additions into the sorted arrays and drop the removed triples.
+        """
+        if not self._pending and not self._removed:
+            return
+        pending = sorted(self._pending)
+        removed = self._removed
+        for name, order in PERMUTATIONS.items():
+            if name == 'spo':
+                added = pending
+            else:
+                added = sorted(pack(*(ids[i] for i in order)) for ids in map(unpack, pending))
+            merged = heapq.merge(self._indexes[name], added)
+            if removed:
+                merged = (key for key in merged if self._spo_key(name, key) not in removed)
+            self._indexes[name] = array('Q', merged)
+        count("interned_store.merged", len(pending))
+        self._pending = set()
+        self._removed = set()
+
+    @staticmethod
+    def _spo_key(name, key):
+        a, b, c = unpack(key)
+        if name == 'pos':
+            return pack(c, a, b)
+        if name == 'osp':
+            return pack(b, c, a)
+        return key
+
+    def triples(self, triple_pattern, context=None):
+        """
+        Generator over the triples matching a pattern, None being a wildcard.
+        """
+        bound = []
+        ids = []
+        for position, term in enumerate(triple_pattern):
+            if term is not None:
+                term_id = self._ids.get(term)
+                if term_id is None:
+                    return
+                bound.append(position)
+                ids.append(term_id)
+
+        name = PATTERN_PERMUTATIONS[tuple(bound)]
+        order = PERMUTATIONS[name]
+        # Key range of the bound prefix in the chosen permutation
+        prefix = [ids[bound.index(position)] for position in order[:len(ids)]]
+        shift = ID_BITS * (3 - len(prefix))
+        low = 0
+        for term_id in prefix:
+            low = (low << ID_BITS) | term_id
+        low <<= shift
+        high = low + (1 << shift)
+
+        terms = self._terms
+        removed = self._removed
+        index = self._indexes[name]
+        position = bisect_left(index, low)
+        end = len(index)
+        while position < end:
+            key = index[position]
+            if key >= high:
+                break
+            position += 1
+            a, b, c = key >> (2 * ID_BITS), (key >> ID_BITS) & ID_MASK, key & ID_MASK
+            if name == 'spo':
+                s, p, o = a, b, c
+            elif name == 'pos':
+                s, p, o = c, a, b
+            else:
+                s, p, o = b, c, a
+            if removed and pack(s, p, o) in removed:
+                continue
+            yield (terms[s], terms[p], terms[o]), iter(())
+
+        # Triples added since the last merge
+        for key in list(self._pending):
+            s, p, o = unpack(key)
+            if all((s, p, o)[position] == term_id for position, term_id in zip(bound, ids)):
+                yield (terms[s], terms[p], terms[o]), iter(())
+
+    def __len__(self, context=None):
+        return len(self._indexes['spo']) + len(self._pending) - len(self._removed)
+
+    def contexts(self, triple=None):
+        return iter(())
+
+    def bind(self, prefix, namespace, override=True):
+        bound_namespace = self._namespace.get(prefix)
+        bound_prefix = self._prefix.get(namespace)
+        if override:
+            if bound_prefix is not None:
+                del self._namespace[bound_prefix]
+            if bound_namespace is not None:
+                del self._prefix[bound_namespace]
+            self._prefix[namespace] = prefix
+            self._namespace[prefix] = namespace
+        else:
+            self._prefix[bound_namespace or namespace] = bound_prefix or prefix
+            self._namespace[bound_prefix or prefix] = bound_namespace or namespace
+
+    def namespace(self, prefix):
+        return self._namespace.get(prefix)
+
+    def prefix(self, namespace):
+        return self._prefix.get(namespace)
+
+    def namespaces(self):
+        for prefix, namespace in self._namespace.items():
+            yield prefix, namespace
+
+    def compact(self):
+        """
+        Merge the pending changes into the arrays, e.g. once a bulk load is done.
+        """
+        self._merge()
+
+    def term_count(self):
+        return len(self._terms)
+
+
+plugin.register('Interned', Store, 'interned_store', 'InternedStore')
+
+
+"""
+FUNCTIONS TO LOAD THE CORPUS
+"""
+@timed("load_ttl_folder")
+def load_ttl_folder(ttl_folder='data/ttl', store='Interned'):
+    """
+    Load every Turtle file of a folder into one in-process graph.
+
+    Args:
+        ttl_folder (str): Folder of Turtle files, e.g. data/ttl.
+        store (str): rdflib store plugin, 'Interned' or e.g. 'default'.
+
+    Returns:
+        Graph: The graph of the whole folder.
+    """
+    g = Graph(store=store)
+    for root, dirs, files in os.walk(ttl_folder):
+        dirs.sort()
+        for file in sorted(files):
+            if file.endswith('.ttl'):
+                with span("graph.parse"):
+                    g.parse(os.path.join(root, file), format='turtle')
+    if isinstance(g.store, InternedStore):
+        g.store.compact()
+    return g
@@ -10,21 +10,65 @@ import sys
 import json
 import requests
 import re
+from itertools import repeat
+from urllib.parse import urlsplit
+from concurrent.futures import ProcessPoolExecutor
 from bs4 import BeautifulSoup
 from rdflib import Graph
+from instrumentation import timed, span, count
+from crawl_archive import HtmlArchive, read_html_entry
 
 """
 FUNCTIONS TO SAVE JSON
 """
+@timed("save_json")
 def save_json(output_file, jsonld_data):
     os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
     with open(output_file, 'w+', encoding='utf-8') as jsonld_file:
         json.dump(jsonld_data, jsonld_file, indent=2)
 
 
+def save_record(kind, folder, name, jsonld_data, archive=None):
+    """
+    Save a crawled record, as data/jsonld/{kind}/{folder}/{name}.json (data/jsonld/service/{name}.json
+    for a service) or appended to a crawl archive if given.
+
+    Args:
+        kind (str): 'service', 'restaurant' or 'offer'.
+        folder (str): Service folder of the record, e.g. "0-a2roo".
+        name (str): Name of the record, e.g. "11-dz-envies".
+        jsonld_data (list): The JSON-LD of the record.
+        archive (CrawlArchive): Archive receiving the record instead of a file.
+
+    Returns:
+        str: Where the record was written.
+    """
+    if archive is not None:
+        archive.append(kind, folder, name, jsonld_data)
+        return f"{archive.service_file(folder.split('-', 1)[-1])} ({kind} {name})"
+    if kind == 'service':
+        output_file = f'data/jsonld/service/{name}.json'
+    else:
+        output_file = f'data/jsonld/{kind}/{folder}/{name}.json'
+    save_json(output_file, jsonld_data)
+    return output_file
+
+
 """
 FUNCTIONS TO SCRAPE DATA FROM WEBSITE
 """
+# HtmlArchive receiving every page fetched by scrape_html, see set_html_capture
+HTML_CAPTURE = None
+
+
+def set_html_capture(html_archive):
+    """
+    Store the raw pages fetched from now on in an HtmlArchive, or stop storing them with None.
+    """
+    global HTML_CAPTURE
+    HTML_CAPTURE = html_archive
+
+
 def scrape_json_coopcycle_services(url = "https://coopcycle.org/coopcycle.json"):
     """
     Download and save coopcycle.json containing all delivery services.
@@ -38,6 +82,7 @@ def scrape_json_coopcycle_services(url = "https://coopcycle.org/coopcycle.json")
         print(f"Failed to fetch data. Status code: {response.status_code}", file=sys.stderr)
 
 
+@timed("scrape_jsonld")
 def scrape_jsonld(url):
     """
     Scrape JSON-LD data from a given URL.
@@ -48,36 +93,15 @@ def scrape_jsonld(url):
     Returns:
         list: A list of dictionaries representing JSON-LD data found on the page.
              Each dictionary corresponds to a JSON-LD script tag.
-
-    Raises:
-        requests.exceptions.RequestException: If there is an error making the HTTP request.
+             None if the page cannot be fetched.
     """
-    try:
-        # Send an HTTP GET request to the URL
-        response = requests.get(url)
-        response.raise_for_status()  # Raise an HTTPError for bad requests
-
-        # Scrape the HTML content using BeautifulSoup
-        soup = BeautifulSoup(response.text, 'html.parser')
-
-        # Find all script tags containing JSON-LD data
-        json_ld_scripts = soup.find_all('script', {'type': 'application/ld+json'})
-
-        # Extract and scrape each JSON-LD script
-        json_ld_data = []
-        for script in json_ld_scripts:
-            try:
-                data = json.loads(script.string)
-                json_ld_data.append(data)
-            except json.JSONDecodeError as e:
-                print(f"Error decoding JSON-LD data: {e}")
-        return json_ld_data
-
-    except requests.exceptions.RequestException as e:
-        print(f"Error making the request: {e}")
+    html_raw = scrape_html(url)
+    if html_raw is None:
         return None
+    return parse_jsonld_scripts(html_raw)
 
 
+@timed("scrape_html")
 def scrape_html(url):
     """
     Scrape HTML code by 'id' element
@@ -86,9 +110,15 @@ def scrape_html(url):
     """
     try:
         # Send an HTTP GET request to the URL
-        response = requests.get(url)
+        with span("http.get"):
+            response = requests.get(url)
+        count("http.requests")
+        count("http.bytes", len(response.content))
         response.raise_for_status()  # Raise an HTTPError for bad requests
 
+        # Keep the raw response for an offline re-extraction
+        if HTML_CAPTURE is not None:
+            HTML_CAPTURE.append(url, response.text, response.status_code, response.headers.get('Content-Type'))
         return response.text
 
     except requests.exceptions.RequestException as e:
@@ -97,77 +127,69 @@ def scrape_html(url):
 
 
 """
-FUNCTIONS TO EXTRACT DATA
+FUNCTIONS TO PARSE HTML
 """
-def extract_coopcycle_service_urls(field="coopcycle_url"):
+def parse_jsonld_scripts(html_raw):
     """
-    Extract coopcycle_url of each service from coopcycle.json
+    Extract the JSON-LD script elements of an HTML page.
 
     Returns:
-        list: List of service coopcycle_url .
+        list: The decoded JSON-LD of each script element.
     """
-    # Read the contents of the file
-    with open('data/coopcycle.json', 'r', encoding='utf-8') as file:
-        json_data = file.read()
+    # Scrape the HTML content using BeautifulSoup
+    with span("beautifulsoup"):
+        soup = BeautifulSoup(html_raw, 'html.parser')
 
-    try:
-        # Extract the JSON string into a list of dictionaries
-        json_data_list = json.loads(json_data)
-    except json.JSONDecodeError as e:
-        print(f"Error decoding JSON data: {e}")
-        return []
+    # Find all script tags containing JSON-LD data
+    json_ld_scripts = soup.find_all('script', {'type': 'application/ld+json'})
 
-    coopcycle_urls = [entry.get(field) for entry in json_data_list]
-    return [url for url in coopcycle_urls if url is not None]
+    # Extract and scrape each JSON-LD script
+    json_ld_data = []
+    for script in json_ld_scripts:
+        try:
+            data = json.loads(script.string)
+            json_ld_data.append(data)
+        except json.JSONDecodeError as e:
+            print(f"Error decoding JSON-LD data: {e}")
+    return json_ld_data
 
 
-def extract_restaurant_urls(url):
+def parse_restaurant_urls(html_raw):
     """
-    Extract restaurant urls from {service}.coopcycle.org/en/shops
-
-    Args:
-        url: the restaurant url
-        id: HTML fragment id in which to look for data
+    Extract the restaurant urls of the HTML of a {service}.coopcycle.org/en/shops page.
 
-    Returns: list of restaurant urls
+    Returns: list of restaurant urls, without duplicates, in their order on the page
     """
     restaurant_urls = []
+    with span("beautifulsoup"):
+        soup = BeautifulSoup(html_raw, 'html.parser')
 
-    # Scrape the list of shops
-    html_raw = scrape_html(url)
-    soup = BeautifulSoup(html_raw, 'html.parser')
-
-    # Find html with id="shop-list"
+    # Find html with id="shops-list"
     shop_list_html = soup.find(id='shops-list')
     if shop_list_html:
-        # Find all <a> tags within the container
-        url_elements = soup.find_all('a', href=True)
+        # Find the <a> tags within the container only, not the links of the whole page
+        url_elements = shop_list_html.find_all('a', href=True)
 
         # Extract the href attribute from each <a> tag
         for url in url_elements:
             href = url.get('href', '')
-            # Check if the url starts with "/en/restaurant/"
-            if href.startswith('/en/restaurant/'):
+            # Check if the url starts with "/en/restaurant/"; a shop card links to it several times
+            if href.startswith('/en/restaurant/') and href not in restaurant_urls:
                 restaurant_urls.append(href)
+    count("restaurant_urls.extracted", len(restaurant_urls))
     return restaurant_urls
 
 
-def extract_offer_jsonld(restaurant_url: str):
+def parse_offer_jsonld(html_raw, restaurant_url):
     """
-    Scrape HTML content, extract menu items, returning in a schema.org description in JSON-LD.
-
-    Parameters:
-    - url (str): The base URL of the website.
-    - id (str): The ID fragment of the offer page.
+    Extract the menu of the HTML of a restaurant page, see extract_offer_jsonld.
 
     Returns:
-    - dict: A dictionary containing menu data in JSON-LD format.
+    - list: The restaurant and its menu in JSON-LD, or an empty dict without menu.
     """
-
-    html_raw = scrape_html(restaurant_url)
-
     # Parse HTML using BeautifulSoup
-    soup = BeautifulSoup(html_raw, 'html.parser')
+    with span("beautifulsoup"):
+        soup = BeautifulSoup(html_raw, 'html.parser')
 
     html_code = soup.find(id='menu')
     if not html_code:
@@ -249,10 +271,93 @@ def extract_offer_jsonld(restaurant_url: str):
     ]
 
 
+"""
+FUNCTIONS TO EXTRACT DATA
+"""
+def extract_coopcycle_service_urls(field="coopcycle_url"):
+    """
+    Extract coopcycle_url of each service from coopcycle.json
+
+    Returns:
+        list: List of service coopcycle_url .
+    """
+    # Read the contents of the file
+    with open('data/coopcycle.json', 'r', encoding='utf-8') as file:
+        json_data = file.read()
+
+    try:
+        # Extract the JSON string into a list of dictionaries
+        json_data_list = json.loads(json_data)
+    except json.JSONDecodeError as e:
+        print(f"Error decoding JSON data: {e}")
+        return []
+
+    coopcycle_urls = [entry.get(field) for entry in json_data_list]
+    return [url for url in coopcycle_urls if url is not None]
+
+
+def extract_restaurant_urls(url):
+    """
+    Extract restaurant urls from {service}.coopcycle.org/en/shops
+
+    Args:
+        url: the url of the shops page
+
+    Returns: list of restaurant urls, without duplicates, in their order on the page
+    """
+    # Scrape the list of shops
+    html_raw = scrape_html(url)
+    if not html_raw:
+        return []
+    return parse_restaurant_urls(html_raw)
+
+
+@timed("extract_offer_jsonld")
+def extract_offer_jsonld(restaurant_url: str):
+    """
+    Scrape HTML content, extract menu items, returning in a schema.org description in JSON-LD.
+
+    Parameters:
+    - url (str): The base URL of the website.
+    - id (str): The ID fragment of the offer page.
+
+    Returns:
+    - dict: A dictionary containing menu data in JSON-LD format.
+    """
+
+    html_raw = scrape_html(restaurant_url)
+    if not html_raw:
+        return {}
+    return parse_offer_jsonld(html_raw, restaurant_url)
+
+
+def correct_restaurant_jsonld(restaurant_jsonld, service_url, restaurant_url):
+    """
+    Correct the JSON-LD of a restaurant page in place: absolute @id, sameAs and url,
+    address @context, and the link from its service.
+
+    Args:
+        restaurant_jsonld (list): JSON-LD scraped from the restaurant page.
+        service_url (str): e.g. "https://a2roo.coopcycle.org".
+        restaurant_url (str): Path of the restaurant page, e.g. "/en/restaurant/11-dz-envies".
+    """
+    for restaurant in restaurant_jsonld:
+        # Correct restaurant @id, sameAs
+        restaurant["@id"] = service_url + restaurant["@id"]
+        restaurant["sameAs"] = {"@id": service_url + restaurant_url,
+                                "sameAs": restaurant["@id"]}
+        restaurant["url"] = service_url + restaurant_url
+        # Correct restaurant adress @context
+        restaurant["address"]["@context"] = service_url
+    # Add service reference
+    restaurant_jsonld.append({"@id": service_url, "areaServed": {"@id": service_url + restaurant_url}})
+    return restaurant_jsonld
+
+
 """
 FUNCTIONS TO RETRIEVE DATA
 """
-def get_restaurant_jsonld():
+def get_restaurant_jsonld(archive=None):
     # Retrieve the list of coopcycle services.
     service_urls = extract_coopcycle_service_urls()
 
@@ -276,24 +381,13 @@ def get_restaurant_jsonld():
                 print(f"{i:<3}{restaurant_id:<3}{service_url + restaurant_url:<90}Cannot find JSON-LD", file=sys.stderr)
                 continue
             
-            # Correct the data received
-            for restaurant in restaurant_jsonld:
-                # Correct restaurant @id, sameAs
-                restaurant["@id"] = service_url + restaurant["@id"]
-                restaurant["sameAs"] = {"@id": service_url + restaurant_url,
-                                        "sameAs": restaurant["@id"]}
-                restaurant["url"] = service_url + restaurant_url
-                # Correct restaurant adress @context
-                restaurant["address"]["@context"] = service_url
-            # Add service reference
-            restaurant_jsonld.append({"@id": service_url, "areaServed": {"@id": service_url + restaurant_url}})
-
-            output_file = f'data/jsonld/restaurant/{i}-{service}/{restaurant_id}-{restaurant_name}.json'
-            save_json(output_file, restaurant_jsonld)
+            correct_restaurant_jsonld(restaurant_jsonld, service_url, restaurant_url)
+            output_file = save_record('restaurant', f'{i}-{service}', f'{restaurant_id}-{restaurant_name}',
+                                      restaurant_jsonld, archive)
             print(f"{i:<3}{restaurant_id:<3}{service_url + restaurant_url:<90}JSON-LD written into {output_file}")
 
 
-def get_offer_jsonld():
+def get_offer_jsonld(archive=None):
     # Retrieve the list of coopcycle services.
     coopcycle_urls = extract_coopcycle_service_urls()
     # Looking at {service}.coopcycle.org/en/shops
@@ -318,12 +412,12 @@ def get_offer_jsonld():
                     file=sys.stderr)
                 continue
 
-            output_file = f'data/jsonld/offer/{i}-{service}/{restaurant_id}-{restaurant_name}.json'
-            save_json(output_file, jsonld_offer)
+            output_file = save_record('offer', f'{i}-{service}', f'{restaurant_id}-{restaurant_name}',
+                                      jsonld_offer, archive)
             print(f"{i:<3}{restaurant_id:<3}{url + restaurant_url:<90} JSON-LD written into {output_file}")
 
 
-def get_service_jsonld():
+def get_service_jsonld(archive=None):
     # Save the coopcycle.json file
     filename = 'data/coopcycle.json'
     coopcycle_data = scrape_json_coopcycle_services()
@@ -396,12 +490,85 @@ def get_service_jsonld():
 
         # Save the JSON-LD data to individual files
         service_name = item_coopcycle_url.split("://")[1].split(".coopcycle.org")[0]
-        output_file = f'data/jsonld/service/{i}-{service_name}.json'
-        save_json(output_file, jsonld_data)
+        output_file = save_record('service', f'{i}-{service_name}', f'{i}-{service_name}', jsonld_data, archive)
         print(f"{i:<6}{item_coopcycle_url:90}JSON-LD written into {output_file}")
 
 
 
+"""
+FUNCTIONS TO REPLAY A CAPTURE
+"""
+RESTAURANT_PATH = re.compile(r'^/en/restaurant/(\d+)-([^/]+)$')
+
+
+def extract_page_records(html_folder, url, entry, service_folders, kinds=('restaurant', 'offer')):
+    """
+    Extract the records of a restaurant page captured in an HtmlArchive, the same way
+    as get_restaurant_jsonld and get_offer_jsonld.
+
+    Args:
+        html_folder (str): Folder of the HtmlArchive.
+        url (str): URL of the page.
+        entry (list): Index entry of the capture.
+        service_folders (dict): Service URL -> its folder, e.g. "0-a2roo".
+        kinds (tuple): Kinds of records to extract, 'restaurant' and/or 'offer'.
+
+    Returns:
+        list: (kind, folder, name, jsonld) tuples, ready for save_record.
+    """
+    path = urlsplit(url).path
+    match = RESTAURANT_PATH.match(path)
+    service_url = url[:-len(path)] if path else url
+    if not match or service_url not in service_folders:
+        return []
+    header, html_raw = read_html_entry(html_folder, entry)
+    if header['status'] != 200:
+        return []
+
+    folder, name = service_folders[service_url], f"{match.group(1)}-{match.group(2)}"
+    records = []
+    if 'restaurant' in kinds:
+        restaurant_jsonld = parse_jsonld_scripts(html_raw)
+        if restaurant_jsonld:
+            records.append(('restaurant', folder, name, correct_restaurant_jsonld(restaurant_jsonld, service_url, path)))
+    if 'offer' in kinds:
+        offer_jsonld = parse_offer_jsonld(html_raw, url)
+        if offer_jsonld:
+            records.append(('offer', folder, name, offer_jsonld))
+    return records
+
+
+@timed("replay_html_archive")
+def replay_html_archive(html_folder, kinds=('restaurant', 'offer'), archive=None, workers=None):
+    """
+    Extract the restaurant and offer records again from the latest capture of every
+    restaurant page of an HtmlArchive, without network, in parallel processes.
+
+    Args:
+        html_folder (str): Folder of the HtmlArchive.
+        kinds (tuple): Kinds of records to extract, 'restaurant' and/or 'offer'.
+        archive (CrawlArchive): Archive receiving the records, or None for data/jsonld files.
+        workers (int): Number of processes, the number of CPUs if omitted.
+
+    Returns:
+        dict: Number of pages read and of records per kind.
+    """
+    html_archive = HtmlArchive(html_folder)
+    service_folders = {service_url: f"{i}-{service_url.split('://')[1].split('.coopcycle.org')[0]}"
+                       for i, service_url in enumerate(extract_coopcycle_service_urls())}
+    urls, entries = zip(*html_archive.latest_entries()) if html_archive.index else ((), ())
+
+    summary = {'pages': len(urls), 'restaurant': 0, 'offer': 0}
+    with ProcessPoolExecutor(workers) as executor:
+        for records in executor.map(extract_page_records, repeat(html_folder), urls, entries,
+                                    repeat(service_folders), repeat(kinds), chunksize=16):
+            for kind, folder, name, jsonld_data in records:
+                save_record(kind, folder, name, jsonld_data, archive)
+                summary[kind] += 1
+    count("replay.records", summary['restaurant'] + summary['offer'])
+    return summary
+
+
 #Uncomment to run the script as a standalone program
 
 # """
@@ -1,30 +1,335 @@
 import os
 import json
-from rdflib import Graph
+import hashlib
+import unicodedata
+from functools import lru_cache
+from urllib.parse import quote
+from rdflib import Graph, BNode, URIRef
+from rdflib.namespace import Namespace
+from rdflib.plugins.parsers.jsonld import Parser as JsonLDParser
+from rdflib.plugins.shared.jsonld.context import Context
+from instrumentation import timed, span, count
+from literal_normalization import normalize_graph
+from crawl_archive import CrawlArchive
 
-def convert_file_jsonld_to_rdf(file_path, output_filename):
+SCHEMA = Namespace("http://schema.org/")
+
+# Base of the IRIs given to blank nodes which are not attached to any named resource
+SKOLEM_BASE = "https://coopcycle.org/.well-known/genid/"
+
+# Local equivalent of the schema.org context for the terms of the crawled data, so
+# that no document triggers a fetch of the remote context
+SCHEMA_CONTEXT = {
+    "@vocab": "http://schema.org/",
+    "image": {"@type": "@id"},
+    "url": {"@type": "@id"},
+    "sameAs": {"@type": "@id"}
+}
+
+# Remote context references replaced by the local context
+SCHEMA_CONTEXT_URLS = {"http://schema.org", "http://schema.org/", "https://schema.org", "https://schema.org/"}
+
+# Size of the reads of a stream of JSON documents
+READ_SIZE = 1 << 16
+
+
+def slugify(name):
+    """
+    Turn a name into a lowercase ASCII slug, e.g. "Apéritifs" -> "aperitifs".
     """
-    Convert a JSON-LD file to a Turtle file.
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+    slug = "".join(c.lower() if c.isalnum() else "-" for c in name)
+    return "-".join(part for part in slug.split("-") if part)
+
+
+def content_hash(graph, node, visiting=None):
+    """
+    Hash the description of a blank node and of the blank nodes below it, independently
+    of their labels.
+    """
+    visiting = visiting or set()
+    visiting.add(node)
+    parts = sorted(f"{p.n3()} {content_hash(graph, o, visiting) if isinstance(o, BNode) and o not in visiting else o.n3()}"
+                   for p, o in graph.predicate_objects(node) if not isinstance(o, BNode) or o not in visiting)
+    visiting.discard(node)
+    return hashlib.sha1("\n".join(parts).encode('utf-8')).hexdigest()
+
+
+def skolem_iri(parent, segment):
+    """
+    Build the IRI of a node below its parent: the segment is appended to the fragment
+    of the parent IRI, e.g. <...28-aida#menu> -> <...28-aida#menu/aperitifs>.
+    """
+    separator = "/" if "#" in parent else "#"
+    return URIRef(f"{parent}{separator}{quote(segment)}")
+
+
+@timed("skolemize_graph")
+def skolemize_graph(graph):
+    """
+    Replace the blank nodes of a graph by stable IRIs derived from their content.
+
+    A blank node gets the IRI of its parent resource followed by:
+    - the slug of its schema.org name, e.g. a menu section or a menu item;
+    - otherwise the name of the property linking it to its parent when it is the only
+      value of that property, e.g. the 'geo' of a restaurant or the 'offers' of an item;
+    - otherwise that property name and a hash of its content, e.g. each opening hours
+      specification of a restaurant.
+
+    Converting unchanged data therefore always gives the same IRIs, and a changed
+    price keeps the IRI of its menu item.
+
+    Returns:
+        Graph: A new graph without blank nodes.
+    """
+    mapping = {}
+
+    def name_nodes(parent, nodes_by_property):
+        for predicate, nodes in sorted(nodes_by_property.items()):
+            segments = {}
+            for node in nodes:
+                name = min((str(o) for o in graph.objects(node, SCHEMA.name)), default=None)
+                local_name = predicate.split('/')[-1].split('#')[-1]
+                if name and slugify(name):
+                    segment = slugify(name)
+                elif len(nodes) == 1:
+                    segment = local_name
+                else:
+                    segment = f"{local_name}-{content_hash(graph, node)[:10]}"
+                segments.setdefault(segment, []).append(node)
+
+            for segment, same_segment_nodes in segments.items():
+                for node in same_segment_nodes:
+                    # Siblings sharing a name are told apart by their content
+                    if len(same_segment_nodes) > 1:
+                        mapping[node] = skolem_iri(parent, f"{segment}-{content_hash(graph, node)[:10]}")
+                    else:
+                        mapping[node] = skolem_iri(parent, segment)
+                    queue.append(node)
+
+    def children(subject):
+        nodes_by_property = {}
+        for predicate, o in graph.predicate_objects(subject):
+            if isinstance(o, BNode) and o not in mapping:
+                nodes_by_property.setdefault(predicate, set()).add(o)
+        return nodes_by_property
+
+    # Walk down from the named resources, then from the remaining top-level blank nodes
+    queue = []
+    for subject in sorted({s for s in graph.subjects() if not isinstance(s, BNode)}):
+        name_nodes(subject, children(subject))
+    for node in {s for s in graph.subjects() if isinstance(s, BNode)}:
+        if node not in mapping and next(graph.subjects(None, node), None) is None:
+            mapping[node] = URIRef(SKOLEM_BASE + content_hash(graph, node))
+            queue.append(node)
+    while queue:
+        node = queue.pop()
+        name_nodes(mapping[node], children(node))
+
+    skolemized = Graph()
+    for prefix, namespace in graph.namespaces():
+        skolemized.bind(prefix, namespace)
+    for s, p, o in graph:
+        skolemized.add((mapping.get(s, s), p, mapping.get(o, o)))
+    count("skolemized.blank_nodes", len(mapping))
+    return skolemized
+
+
+"""
+FUNCTIONS TO PARSE JSON-LD WITH A LOCAL CONTEXT
+"""
+@lru_cache(maxsize=None)
+def load_schema_context(context_file=None):
+    """
+    Load and process the schema.org context once.
+
+    Args:
+        context_file (str): Local copy of a JSON-LD context, e.g. the full schema.org
+            context downloaded once, or None for SCHEMA_CONTEXT.
+
+    Returns:
+        Context: The processed context, shared by every parsed document.
+    """
+    source = SCHEMA_CONTEXT
+    if context_file:
+        with open(context_file, 'r', encoding='utf-8') as f:
+            source = json.load(f)
+        source = source.get('@context', source) if isinstance(source, dict) else source
+    return Context(source)
+
+
+def strip_schema_context(document):
+    """
+    Remove the references to the remote schema.org context from the top-level nodes
+    of a document, in place, as the local context replaces them.
+    """
+    nodes = document if isinstance(document, list) else [document]
+    for node in nodes:
+        if isinstance(node, dict):
+            if isinstance(node.get('@context'), str) and node['@context'] in SCHEMA_CONTEXT_URLS:
+                del node['@context']
+            if isinstance(node.get('@graph'), list):
+                strip_schema_context(node['@graph'])
+    return document
+
+
+def jsonld_to_graph(document, context_file=None, graph=None):
+    """
+    Parse a JSON-LD document, already decoded, into a graph with the local schema.org
+    context, without serializing it again.
+
+    Args:
+        document (dict or list): The decoded JSON-LD document.
+        context_file (str): Local copy of the context, see load_schema_context.
+        graph (Graph): Graph receiving the triples, a new one if omitted.
+
+    Returns:
+        Graph: The graph of the document.
+    """
+    g = graph if graph is not None else Graph()
+    with span("graph.parse", format='json-ld'):
+        JsonLDParser().parse(strip_schema_context(document), load_schema_context(context_file), g)
+    return g
+
+
+def iter_json_documents(file):
+    """
+    Generator over the JSON documents of a stream holding one document, concatenated
+    documents or JSON lines, reading it in fixed-size chunks.
+
+    Args:
+        file (file): Text file object.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    end_of_file = False
+    while True:
+        buffer = buffer.lstrip()
+        if not buffer:
+            if end_of_file:
+                return
+            chunk = file.read(READ_SIZE)
+            end_of_file = not chunk
+            buffer += chunk
+            continue
+        try:
+            document, position = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            if end_of_file:
+                raise
+            # The document continues in the next chunk
+            chunk = file.read(READ_SIZE)
+            end_of_file = not chunk
+            buffer += chunk
+            continue
+        if position == len(buffer) and not end_of_file and isinstance(document, (int, float)):
+            # A number may continue in the next chunk
+            chunk = file.read(READ_SIZE)
+            end_of_file = not chunk
+            buffer += chunk
+            continue
+        buffer = buffer[position:]
+        yield document
+
+
+"""
+FUNCTIONS TO CONVERT FILES
+"""
+@timed("convert_file_jsonld_to_rdf")
+def convert_file_jsonld_to_rdf(file_path, output_filename, skolemize=False, context_file=None):
+    """
+    Convert a JSON-LD file to a Turtle file with canonical typed prices, coordinates
+    and opening hours (see normalize_graph), optionally replacing its blank nodes by
+    stable IRIs (see skolemize_graph).
+
+    The file is decoded once and parsed with the local schema.org context.
     """
     with open(file_path, 'r', encoding='utf-8') as json_file:
         jsonld_data = json.load(json_file)
+    convert_jsonld_to_turtle(jsonld_data, output_filename, skolemize, context_file)
+
 
-    g = Graph()
-    g.parse(data=json.dumps(jsonld_data), format='json-ld')
+def convert_jsonld_to_turtle(jsonld_data, output_filename, skolemize=False, context_file=None):
+    """
+    Convert a decoded JSON-LD document to a Turtle file, see convert_file_jsonld_to_rdf.
+    """
+    g = jsonld_to_graph(jsonld_data, context_file)
+    count("triples.converted", len(g))
+    normalize_graph(g)
+    if skolemize:
+        g = skolemize_graph(g)
 
     os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+    with span("graph.serialize", format='turtle'):
+        turtle_data = g.serialize(format='turtle')
     with open(output_filename, 'w', encoding='utf-8') as f:
-        f.write(g.serialize(format='turtle'))
+        f.write(turtle_data)
+
+
+@timed("convert_stream_jsonld_to_rdf")
+def convert_stream_jsonld_to_rdf(file_path, output_filename, skolemize=False, context_file=None):
+    """
+    Convert a stream of JSON-LD documents, concatenated or one per line as written by
+    a crawl, to an N-Triples file.
+
+    Each document is converted and written on its own, so the memory used does not
+    grow with the number of documents.
+
+    Returns:
+        int: Number of documents converted.
+    """
+    documents = 0
+    os.makedirs(os.path.dirname(output_filename) or '.', exist_ok=True)
+    with open(file_path, 'r', encoding='utf-8') as json_file, \
+            open(output_filename, 'w', encoding='utf-8') as f:
+        for document in iter_json_documents(json_file):
+            g = jsonld_to_graph(document, context_file)
+            count("triples.converted", len(g))
+            normalize_graph(g)
+            if skolemize:
+                g = skolemize_graph(g)
+            with span("graph.serialize", format='nt'):
+                f.write(g.serialize(format='nt'))
+            documents += 1
+    count("documents.converted", documents)
+    return documents
 
 
+@timed("convert_archive_jsonld_to_rdf")
+def convert_archive_jsonld_to_rdf(archive_folder, output_folder='data/ttl', skolemize=False, context_file=None):
+    """
+    Convert the latest record of every service, restaurant and offer of a crawl archive
+    (see crawl_archive.py) to Turtle files, read as a stream, in the same layout as the
+    converted JSON-LD folders: {output_folder}/service/{name}.ttl and
+    {output_folder}/{kind}/{folder}/{name}.ttl. The records replaced by a later crawl
+    are skipped.
+
+    Returns:
+        int: Number of records converted.
+    """
+    records = 0
+    for record in CrawlArchive(archive_folder).latest_records():
+        if record['kind'] == 'service':
+            output_path = os.path.join(output_folder, 'service', record['name'] + '.ttl')
+        else:
+            output_path = os.path.join(output_folder, record['kind'], record['folder'], record['name'] + '.ttl')
+        convert_jsonld_to_turtle(record['jsonld'], output_path, skolemize, context_file)
+        records += 1
+    count("documents.converted", records)
+    return records
+
 
-def process_jsonld_folders(base_folder):
+def process_jsonld_folders(base_folder, skolemize=False, context_file=None):
     """
-    Process all JSON-LD files in a directory and its subdirectories.
+    Process all JSON-LD files in a directory and its subdirectories: .json files
+    are converted to Turtle and .jsonl streams to N-Triples.
     """
     for root, dirs, files in os.walk(base_folder):
         for file in files:
+            file_path = os.path.join(root, file)
             if file.endswith('.json'):
-                file_path = os.path.join(root, file)
                 output_path = file_path.replace('jsonld', 'ttl').replace('.json', '.ttl')
-                convert_file_jsonld_to_rdf(file_path, output_path)
\ No newline at end of file
+                convert_file_jsonld_to_rdf(file_path, output_path, skolemize, context_file)
+            elif file.endswith('.jsonl'):
+                output_path = file_path.replace('jsonld', 'ttl').replace('.jsonl', '.nt')
+                convert_stream_jsonld_to_rdf(file_path, output_path, skolemize, context_file)
\ No newline at end of file
@@ -0,0 +1,290 @@
+"""
+literal_normalization.py
+
+Canonical typed literals for the numbers, prices and times of the RDF data.
+
+The crawled JSON-LD holds prices as display strings ("€5.00", "6,50 €", "MX$35.00"),
+opening hours as "HH:MM" strings, and the user preferences hold coordinates as
+"2.453"^^schema:Float and their maximum price as a plain string. Every query then
+has to cast these values at runtime. normalize_graph rewrites them once, at
+conversion time, as xsd:decimal prices with an ISO 4217 schema:priceCurrency,
+xsd:double coordinates and xsd:time opening hours.
+"""
+
+import os
+import re
+import time
+from decimal import Decimal, InvalidOperation
+from collections import Counter
+from rdflib import Graph, Literal, BNode
+from rdflib.namespace import RDF, XSD, Namespace
+from instrumentation import timed, span, count
+
+SCHEMA = Namespace("http://schema.org/")
+
+# Currency symbols of the crawled prices, longest first so that "MX$" wins over "$"
+CURRENCY_SYMBOLS = [("MX$", "MXN"), ("A$", "AUD"), ("CA$", "CAD"), ("US$", "USD"), ("CLP", "CLP"),
+                    ("€", "EUR"), ("£", "GBP"), ("$", "USD"), ("EUR", "EUR"), ("GBP", "GBP")]
+
+PRICE_PREDICATES = [SCHEMA.price, SCHEMA.minPrice, SCHEMA.maxPrice]
+DOUBLE_PREDICATES = [SCHEMA.latitude, SCHEMA.longitude, SCHEMA.geoRadius]
+TIME_PREDICATES = [SCHEMA.opens, SCHEMA.closes]
+
+
+def parse_price(price):
+    """
+    Split a crawled price into its amount and currency, e.g. "6,50 €" -> (Decimal('6.50'), 'EUR').
+
+    Both decimal separators are understood: "9,999.99" is 9999.99 and "9,99" is 9.99.
+
+    Returns:
+        tuple: The amount as a Decimal (None if the price has no number) and the
+            ISO 4217 currency code (None if the price has no currency).
+    """
+    text = str(price).replace(' ', '').replace(' ', '')
+    currency = None
+    for symbol, code in CURRENCY_SYMBOLS:
+        if symbol in text:
+            # Removing the symbol keeps the sign of "-€2.00" next to its number
+            currency, text = code, text.replace(symbol, '')
+            break
+    match = re.search(r'-?\d[\d.,]*', text)
+    if not match:
+        return None, currency
+
+    number = match.group(0).rstrip('.,')
+    if '.' in number and ',' in number:
+        # The last separator is the decimal one, e.g. "9,999.99" or "9.999,99"
+        decimal_separator = '.' if number.rfind('.') > number.rfind(',') else ','
+        thousands = ',' if decimal_separator == '.' else '.'
+        number = number.replace(thousands, '').replace(decimal_separator, '.')
+    elif ',' in number:
+        # "9,999" is a thousands separator, "9,99" a decimal comma
+        fraction = number.rpartition(',')[2]
+        number = number.replace(',', '') if len(fraction) == 3 else number.replace(',', '.')
+    try:
+        return Decimal(number), currency
+    except InvalidOperation:
+        return None, currency
+
+
+def parse_price_amount(price):
+    """
+    Extract the amount of a crawled price, e.g. "€5.00", "6,50 €" or "MX$35.00".
+
+    Returns:
+        float: The amount, or None if the price has no number.
+    """
+    amount, _ = parse_price(price)
+    return float(amount) if amount is not None else None
+
+
+def decimal_literal(value):
+    """
+    Canonical xsd:decimal literal of a number or numeric string, with two decimals.
+    """
+    return Literal(Decimal(str(value).replace(',', '.')).quantize(Decimal('0.01')), datatype=XSD.decimal)
+
+
+def double_literal(value):
+    """
+    Canonical xsd:double literal of a number or numeric string.
+    """
+    return Literal(float(str(value).replace(',', '.')), datatype=XSD.double)
+
+
+def time_literal(value):
+    """
+    Canonical xsd:time literal of "HH:MM" or "HH:MM:SS", e.g. "11:30" -> "11:30:00".
+    Midnight written "24:00" becomes "00:00:00".
+    """
+    parts = [int(part) for part in str(value).strip().split(':')] + [0, 0]
+    hours, minutes, seconds = parts[0] % 24, parts[1], parts[2]
+    return Literal(f"{hours:02d}:{minutes:02d}:{seconds:02d}", datatype=XSD.time)
+
+
+def is_canonical(literal, datatype):
+    return isinstance(literal, Literal) and literal.datatype == datatype
+
+
+@timed("normalize_graph")
+def normalize_graph(graph):
+    """
+    Rewrite the prices, coordinates and opening hours of a graph as canonical typed
+    literals, in place.
+
+    - schema:price, minPrice and maxPrice become xsd:decimal, and the currency found
+      in the price string is added as schema:priceCurrency when missing.
+    - schema:latitude, longitude and geoRadius become xsd:double.
+    - schema:opens and closes become xsd:time.
+    - A plain literal schema:priceSpecification becomes a schema:PriceSpecification
+      with a schema:maxPrice.
+
+    Values that cannot be parsed are left unchanged.
+
+    Returns:
+        Counter: Number of rewritten literals per predicate name.
+    """
+    changes = Counter()
+
+    def replace(s, p, o, new):
+        graph.remove((s, p, o))
+        graph.add((s, p, new))
+        changes[p.split('/')[-1]] += 1
+
+    for p in PRICE_PREDICATES:
+        for s, o in list(graph.subject_objects(p)):
+            if not isinstance(o, Literal) or is_canonical(o, XSD.decimal):
+                continue
+            amount, currency = parse_price(o)
+            if amount is None:
+                continue
+            replace(s, p, o, decimal_literal(amount))
+            if currency and graph.value(s, SCHEMA.priceCurrency) is None:
+                graph.add((s, SCHEMA.priceCurrency, Literal(currency)))
+
+    for p in DOUBLE_PREDICATES:
+        for s, o in list(graph.subject_objects(p)):
+            if isinstance(o, Literal) and not is_canonical(o, XSD.double):
+                try:
+                    replace(s, p, o, double_literal(o))
+                except ValueError:
+                    pass
+
+    for p in TIME_PREDICATES:
+        for s, o in list(graph.subject_objects(p)):
+            if isinstance(o, Literal) and not is_canonical(o, XSD.time):
+                try:
+                    replace(s, p, o, time_literal(o))
+                except (ValueError, IndexError):
+                    pass
+
+    for s, o in list(graph.subject_objects(SCHEMA.priceSpecification)):
+        if isinstance(o, Literal):
+            amount, currency = parse_price(o)
+            if amount is None:
+                continue
+            specification = BNode()
+            replace(s, SCHEMA.priceSpecification, o, specification)
+            graph.add((specification, RDF.type, SCHEMA.PriceSpecification))
+            graph.add((specification, SCHEMA.maxPrice, decimal_literal(amount)))
+            graph.add((specification, SCHEMA.priceCurrency, Literal(currency or "EUR")))
+
+    for name, value in changes.items():
+        count(f"literals.normalized.{name}", value)
+    return changes
+
+
+"""
+FUNCTIONS TO MIGRATE EXISTING TURTLE FILES
+"""
+@timed("migrate_ttl_folder")
+def migrate_ttl_folder(ttl_folder='data/ttl', dry_run=False):
+    """
+    Normalize the literals of every Turtle file of a folder, rewriting the files in place.
+
+    Args:
+        ttl_folder (str): Folder of Turtle files, e.g. data/ttl.
+        dry_run (bool): Only count the literals to rewrite.
+
+    Returns:
+        dict: Number of files read and changed, and of rewritten literals per predicate.
+    """
+    summary = {'files': 0, 'changed_files': 0, 'literals': Counter()}
+    for root, dirs, files in os.walk(ttl_folder):
+        dirs.sort()
+        for file in sorted(files):
+            if not file.endswith('.ttl'):
+                continue
+            path = os.path.join(root, file)
+            g = Graph()
+            with span("graph.parse"):
+                g.parse(path, format='turtle')
+            changes = normalize_graph(g)
+            summary['files'] += 1
+            if changes:
+                summary['changed_files'] += 1
+                summary['literals'].update(changes)
+                if not dry_run:
+                    with span("graph.serialize"):
+                        g.serialize(destination=path, format='turtle')
+    return summary
+
+
+# Queries casting the raw literals at runtime, as SPARQLQueries did before normalization
+RUNTIME_CAST_QUERIES = {
+    'price_range': """
+        PREFIX ns1: <http://schema.org/>
+        PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
+        SELECT DISTINCT ?restaurantName ?menuItemName ?priceLiteral WHERE {
+            ?restaurant a ns1:Restaurant ; ns1:name ?restaurantName ; ns1:hasMenu ?menu.
+            ?menu ns1:hasMenuSection ?menuSection.
+            ?menuSection ns1:hasMenuItem ?menuItem.
+            ?menuItem ns1:name ?menuItemName ; ns1:offers/ns1:price ?priceLiteral.
+            BIND(xsd:decimal(REPLACE(STR(?priceLiteral), "[^0-9.]", "")) AS ?price)
+            FILTER (?price <= 10.0)
+        }
+        ORDER BY ?restaurantName ?price
+    """,
+    'open_hours': """
+        PREFIX ns1: <http://schema.org/>
+        SELECT ?restaurantName ?openDay ?opens ?closes WHERE {
+            ?restaurant a ns1:Restaurant ; ns1:name ?restaurantName ; ns1:openingHoursSpecification ?ohs.
+            ?ohs ns1:dayOfWeek ?openDay ; ns1:opens ?opens ; ns1:closes ?closes.
+            FILTER (CONTAINS(STR(?openDay), "Monday"))
+            FILTER (STR(?opens) <= "11:30" && STR(?closes) >= "14:00")
+        }
+        ORDER BY ?restaurantName
+    """,
+}
+
+
+def compare_query_timings(ttl_folder='data/ttl', queries=None, sample=50, repeat=3):
+    """
+    Time queries on a sample of the Turtle files, before and after normalization.
+
+    The files are loaded into a local rdflib graph, so the timings compare the cost
+    of the runtime casts, not the index use of a Fuseki server.
+
+    Args:
+        ttl_folder (str): Folder of Turtle files, not normalized yet.
+        queries (dict): Query name -> (query casting the raw literals, query on the
+            typed literals), e.g. RUNTIME_CAST_QUERIES and the SPARQLQueries queries.
+        sample (int): Number of restaurant files loaded, with their offer files.
+        repeat (int): Number of runs of each query; the fastest one is reported.
+
+    Returns:
+        dict: Query name -> (milliseconds before, milliseconds after, rows before, rows after).
+    """
+    before = Graph()
+    restaurant_folder = os.path.join(ttl_folder, 'restaurant')
+    loaded = 0
+    for root, dirs, files in os.walk(restaurant_folder):
+        dirs.sort()
+        for file in sorted(files):
+            if file.endswith('.ttl') and loaded < sample:
+                before.parse(os.path.join(root, file), format='turtle')
+                offer_file = os.path.join(root.replace(restaurant_folder, os.path.join(ttl_folder, 'offer'), 1), file)
+                if os.path.exists(offer_file):
+                    before.parse(offer_file, format='turtle')
+                loaded += 1
+
+    after = Graph()
+    for triple in before:
+        after.add(triple)
+    normalize_graph(after)
+
+    def best_time(graph, query):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            rows = len(list(graph.query(query)))
+            timings.append((time.perf_counter() - start) * 1000)
+        return min(timings), rows
+
+    report = {}
+    for name, (cast_query, typed_query) in (queries or {}).items():
+        before_ms, before_rows = best_time(before, cast_query)
+        after_ms, after_rows = best_time(after, typed_query)
+        report[name] = (before_ms, after_ms, before_rows, after_rows)
+    return report
@@ -1,14 +1,41 @@
 import argparse
 from rdf_handler import RDFHandler
-from sparql_queries import SPARQLQueries
+from sparql_queries import SPARQLQueries, LocalSPARQLQueries
+from interned_store import load_ttl_folder
+from async_sparql_queries import SyncSPARQLQueries
+from sparql_results import (TabularSPARQLQueries, PRICE_RANGE_FIELDS, local_result_documents,
+                            remote_result_documents, benchmark_result_formats)
 from shacl_validation import validate_rdf_data
-from set_user_preferences import set_user_preferences
-from jsonld_to_rdf_converter import process_jsonld_folders
-from jsonld_parser import get_service_jsonld, get_restaurant_jsonld, get_offer_jsonld
+from set_user_preferences import set_user_preferences, ingest_user_profiles, user_iri, user_graph_uri
+from jsonld_to_rdf_converter import process_jsonld_folders, convert_archive_jsonld_to_rdf
+from crawl_archive import CrawlArchive, HtmlArchive
+from crawl_frontier import CrawlFrontier, discover_restaurants, crawl_due_pages
+from jsonld_parser import get_service_jsonld, get_restaurant_jsonld, get_offer_jsonld, set_html_capture, replay_html_archive
+from corpus_generator import write_corpus
+from graph_sync import sync_graph
+from literal_normalization import migrate_ttl_folder, compare_query_timings, RUNTIME_CAST_QUERIES
+from search_index import build_search_index, search_restaurants
+from facet_index import build_facet_index, filter_menu_items, parse_open_at, DECLARED
+from service_shards import ShardCatalog, ShardedSPARQLQueries, build_shards
+from coverage_index import CoverageIndex, build_coverage_index
+from query_log import QueryLog, DEFAULT_LOG_FILE, set_query_log, slow_log_file, summarize_query_log
+from columnar_export import export_query_results, export_corpus
+from result_cache import ResultCache, DEFAULT_CACHE_FILE, set_result_cache, invalidate
+from warmup import DEFAULT_WORKLOAD, load_workload, workload_from_log, warm_up
+from restaurant_summary import build_restaurant_summaries, save_summaries, load_summaries, publish_summaries
 from rdflib import Graph
+import os
+import time
+import asyncio
+import aiohttp
+import json
+import instrumentation
 
 def main():
     parser = argparse.ArgumentParser(description="Semantic Web Application")
+    parser.add_argument('--profile', type=str, help='Run the command under cProfile and dump the report to this file')
+    parser.add_argument('--metrics', type=str, help='Collect timings and counters and write them to this file')
+    parser.add_argument('--metrics_format', type=str, choices=['prometheus', 'jsonl'], default='prometheus', help='Format of the metrics file')
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
     
@@ -18,6 +45,11 @@ def main():
 
     # Subparser for JSON-LD Parsing
     jsonld_parser = subparsers.add_parser('jsonld', help='Operations related to JSON-LD parsing')
+    jsonld_parser.add_argument('--archive', type=str, help='Append the records to this compressed JSON-lines archive folder instead of data/jsonld files')
+    jsonld_parser.add_argument('--compression', type=str, choices=['gzip', 'zstd'], default='gzip', help='Compression of the archive (zstd requires the zstandard package)')
+    jsonld_parser.add_argument('--capture_html', type=str, help='Also store the raw pages fetched into this HTML archive folder')
+    jsonld_parser.add_argument('--replay', type=str, help='Extract the restaurants and offers again from this HTML archive folder, without network')
+    jsonld_parser.add_argument('--workers', type=int, help='Number of processes of --replay (number of CPUs by default)')
     jsonld_subparsers = jsonld_parser.add_subparsers(dest="jsonld_command", help="JSON-LD parsing operations")
 
     # Subparser for parsing service data
@@ -32,15 +64,56 @@ def main():
     parser_offer = jsonld_subparsers.add_parser('offer', help='Parse JSON-LD data for offers')
     parser_offer.set_defaults(func=get_offer_jsonld)
 
+    # Subparser for reading one record of an archive
+    parser_archive_get = jsonld_subparsers.add_parser('get', help='Read the record of a restaurant from a crawl archive')
+    parser_archive_get.add_argument('--service', type=str, required=True, help='Service name, e.g. a2roo')
+    parser_archive_get.add_argument('--restaurant_id', type=str, required=True, help='Restaurant ID, e.g. 11')
+    parser_archive_get.add_argument('--kind', type=str, choices=['restaurant', 'offer', 'service'], default='restaurant', help='Kind of record')
+
 
     
+    # ------------------------
+    # Crawl Frontier Section
+    # ------------------------
+    # Subparser for the incremental crawl of the restaurant pages
+    crawl_parser = subparsers.add_parser('crawl', help='Incremental crawl of the restaurant pages with a persistent frontier')
+    crawl_parser.add_argument('--db', type=str, default='data/crawl/frontier.sqlite', help='Frontier database file')
+    crawl_subparsers = crawl_parser.add_subparsers(dest="crawl_command", help="Crawl operations")
+
+    crawl_subparsers.add_parser('discover', help='Add the restaurant pages of the shops lists to the frontier')
+
+    parser_crawl_run = crawl_subparsers.add_parser('run', help='Fetch the due restaurant pages within a request budget')
+    parser_crawl_run.add_argument('--budget', type=int, default=500, help='Maximum number of HTTP requests of the run')
+    parser_crawl_run.add_argument('--archive', type=str, help='Append the changed records to this crawl archive instead of data/jsonld files')
+    parser_crawl_run.add_argument('--capture_html', type=str, help='Also store the raw pages fetched into this HTML archive folder')
+
+    crawl_subparsers.add_parser('status', help='Summarize the frontier')
+
+
     # --------------------------------
     # JSON-LD to RDF Converter Section
     # --------------------------------
     # Subparser for JSON-LD to RDF conversion
 
     parser_jsonld_to_rdf = subparsers.add_parser('convert_jsonld', help='Convert JSON-LD files to RDF format')
-    parser_jsonld_to_rdf.add_argument('--input_folder', type=str, required=True, help='Input folder containing JSON-LD files')
+    parser_jsonld_to_rdf.add_argument('--input_folder', type=str, help='Input folder containing JSON-LD files')
+    parser_jsonld_to_rdf.add_argument('--archive', type=str, help='Crawl archive folder to convert instead of JSON-LD files')
+    parser_jsonld_to_rdf.add_argument('--output_folder', type=str, default='data/ttl', help='Output folder of the Turtle files converted from an archive')
+    parser_jsonld_to_rdf.add_argument('--skolemize', action='store_true', help='Replace blank nodes by stable IRIs derived from their content')
+    parser_jsonld_to_rdf.add_argument('--context_file', type=str, help='Local copy of the schema.org JSON-LD context (built-in context if omitted)')
+
+    
+    # ------------------------
+    # Synthetic Corpus Section
+    # ------------------------
+    # Subparser for generating a synthetic corpus for scale testing
+
+    parser_generate_corpus = subparsers.add_parser('generate_corpus', help='Generate a synthetic corpus for scale testing')
+    parser_generate_corpus.add_argument('--output_folder', type=str, required=True, help='Output folder of the generated corpus')
+    parser_generate_corpus.add_argument('--services', type=int, default=50, help='Number of delivery services')
+    parser_generate_corpus.add_argument('--restaurants', type=int, default=400, help='Total number of restaurants')
+    parser_generate_corpus.add_argument('--format', type=str, choices=['jsonld', 'archive', 'turtle', 'nquads'], default='jsonld', help='Output format')
+    parser_generate_corpus.add_argument('--seed', type=int, default=0, help='Seed of the random generator')
 
     
     
@@ -53,6 +126,9 @@ def main():
     
     # RDF Data Section
     rdf_parser = subparsers.add_parser('rdf', help='Operations related to RDF data handling')
+    rdf_parser.add_argument('--no_warmup', action='store_true', help='Do not warm up the server and the result cache after a successful load')
+    rdf_parser.add_argument('--workload', type=str, default=DEFAULT_WORKLOAD, help='Workload of the warm-up after a load')
+    rdf_parser.add_argument('--cache_file', type=str, default=DEFAULT_CACHE_FILE, help='Result cache filled by the warm-up')
     rdf_subparsers = rdf_parser.add_subparsers(dest="rdf_command", help="RDF operations")
 
     # Ensure each subparser is defined once and uniquely
@@ -67,6 +143,23 @@ def main():
     parser_update = rdf_subparsers.add_parser('update', help='Update RDF data')
     parser_update.add_argument('--update_query', type=str, required=True, help='SPARQL update query string')
 
+    parser_bulk_update = rdf_subparsers.add_parser('bulk_update', help='Apply deleted and inserted triples in batched updates')
+    parser_bulk_update.add_argument('--insert', type=str, help='Path to an RDF file of triples to insert')
+    parser_bulk_update.add_argument('--delete', type=str, help='Path to an RDF file of triples to delete')
+    parser_bulk_update.add_argument('--graph_uri', type=str, help='Graph URI to update (default graph if omitted)')
+    parser_bulk_update.add_argument('--batch_size', type=int, default=5000, help='Maximum number of triples per update request')
+
+    parser_normalize = rdf_subparsers.add_parser('normalize', help='Rewrite prices, coordinates and opening hours of Turtle files as typed literals')
+    parser_normalize.add_argument('--ttl_folder', type=str, default='data/ttl', help='Folder of Turtle files rewritten in place')
+    parser_normalize.add_argument('--dry_run', action='store_true', help='Only count the literals to rewrite')
+    parser_normalize.add_argument('--sample', type=int, default=50, help='Number of restaurants loaded to compare query timings (0 to skip)')
+
+    parser_sync = rdf_subparsers.add_parser('sync', help='Push only the differences between a local file and a remote graph')
+    parser_sync.add_argument('--file', type=str, required=True, help='Path to the local RDF file')
+    parser_sync.add_argument('--graph_uri', type=str, required=True, help='Graph URI to synchronize')
+    parser_sync.add_argument('--dry_run', action='store_true', help='Only report the differences')
+    parser_sync.add_argument('--batch_size', type=int, default=5000, help='Maximum number of triples per update request')
+
     parser_delete = rdf_subparsers.add_parser('delete', help='Delete a graph')
     parser_delete.add_argument('--graph_uri', type=str, required=True, help='Graph URI to delete')
 
@@ -77,16 +170,109 @@ def main():
 
     # Subparser for user preferences
     user_pref_parser = subparsers.add_parser('set_preferences', help='Set user preferences')
-    user_pref_parser.set_defaults(func=set_user_preferences)
+    user_pref_parser.add_argument('--bulk', type=str, help='CSV or JSON-lines file of user profiles to ingest without prompting')
+    user_pref_parser.add_argument('--batch_size', type=int, default=5000, help='Maximum number of triples per update request')
+    user_pref_parser.add_argument('--dry_run', action='store_true', help='Only validate the profiles')
 
     
 
 
+    # ---------------------------
+    # Restaurant Summary Section
+    # ---------------------------
+    # Subparser for the precomputed restaurant summaries
+    summary_parser = subparsers.add_parser('summary', help='Operations related to the precomputed restaurant summaries')
+    summary_subparsers = summary_parser.add_subparsers(dest="summary_command", help="Summary operations")
+
+    parser_summary_build = summary_subparsers.add_parser('build', help='Build one summary per restaurant from the Turtle files')
+    parser_summary_build.add_argument('--ttl_folder', type=str, default='data/ttl', help='Folder containing the service, restaurant and offer Turtle files')
+    parser_summary_build.add_argument('--output', type=str, default='data/summary/restaurants.columns.json', help='Columnar JSON file of the summaries')
+    parser_summary_build.add_argument('--upload', action='store_true', help='Also replace the summary named graph on the server')
+
+    parser_summary_list = summary_subparsers.add_parser('list', help='List the summaries from the local columnar file')
+    parser_summary_list.add_argument('--input', type=str, default='data/summary/restaurants.columns.json', help='Columnar JSON file of the summaries')
+
+
+    # ------------------------
+    # Index Section
+    # ------------------------
+    # Subparser for building the local indexes
+    index_parser = subparsers.add_parser('index', help='Operations related to the local indexes')
+    index_subparsers = index_parser.add_subparsers(dest="index_command", help="Index operations")
+
+    parser_index_search = index_subparsers.add_parser('build_search', help='Build the full-text search index')
+    parser_index_search.add_argument('--ttl_folder', type=str, default='data/ttl', help='Folder containing the restaurant and offer Turtle files')
+    parser_index_search.add_argument('--output', type=str, default='data/index/search.json', help='Search index file')
+
+    parser_index_facets = index_subparsers.add_parser('build_facets', help='Build the allergen and dietary facet index')
+    parser_index_facets.add_argument('--ttl_folder', type=str, default='data/ttl', help='Folder containing the restaurant and offer Turtle files')
+    parser_index_facets.add_argument('--output', type=str, default='data/index/facets.json', help='Facet index file')
+
+    parser_index_shards = index_subparsers.add_parser('build_shards', help='Build the catalog of the service shards')
+    parser_index_shards.add_argument('--ttl_folder', type=str, default='data/ttl', help='Folder containing the service, restaurant and offer Turtle files')
+    parser_index_shards.add_argument('--output', type=str, default='data/index/shards.json', help='Shard catalog file')
+    parser_index_shards.add_argument('--upload', action='store_true', help='Also replace the named graph of every shard on the server')
+
+    parser_index_coverage = index_subparsers.add_parser('build_coverage', help='Build the delivery coverage index of the services and restaurants')
+    parser_index_coverage.add_argument('--ttl_folder', type=str, default='data/ttl', help='Folder containing the service and restaurant Turtle files')
+    parser_index_coverage.add_argument('--output', type=str, default='data/index/coverage.json', help='Coverage index file')
+
+
+    # ------------------------
+    # Export Section
+    # ------------------------
+    # Subparser for the columnar exports (requires pyarrow)
+    export_parser = subparsers.add_parser('export', help='Export query results or the corpus as Parquet or Arrow IPC files')
+    export_subparsers = export_parser.add_subparsers(dest="export_command", help="Export operations")
+
+    parser_export_query = export_subparsers.add_parser('query', help='Export the results of a SPARQLQueries method')
+    parser_export_query.add_argument('--method', type=str, required=True, help='Method, e.g. get_restaurants_by_price_range')
+    parser_export_query.add_argument('--args', type=str, nargs='*', default=[], help='Arguments of the method, e.g. 20.0')
+    parser_export_query.add_argument('--output', type=str, required=True, help='Output .parquet or .arrow file')
+    parser_export_query.add_argument('--local_ttl', type=str, help='Run the query in process on this folder of Turtle files instead of the Fuseki server')
+    parser_export_query.add_argument('--store', type=str, default='Interned', help='rdflib store of the in-process graph (Interned or default)')
+
+    parser_export_corpus = export_subparsers.add_parser('corpus', help='Export the restaurants, menu_items and opening_hours tables of the Turtle files')
+    parser_export_corpus.add_argument('--ttl_folder', type=str, default='data/ttl', help='Folder containing the service, restaurant and offer Turtle files')
+    parser_export_corpus.add_argument('--output_folder', type=str, default='data/export', help='Folder of the tables')
+    parser_export_corpus.add_argument('--format', type=str, choices=['parquet', 'arrow'], default='parquet', help='Parquet or Arrow IPC files')
+    parser_export_corpus.add_argument('--batch_size', type=int, default=10000, help='Rows per written batch')
+
+
+    # ------------------------
+    # Warm-up Section
+    # ------------------------
+    # Subparser for the warm-up of the server and the result cache
+    warmup_parser = subparsers.add_parser('warmup', help='Warm up the server and the result cache with a workload of common queries')
+    warmup_parser.add_argument('--cache_file', type=str, default=DEFAULT_CACHE_FILE, help='Result cache file')
+    warmup_subparsers = warmup_parser.add_subparsers(dest="warmup_command", help="Warm-up operations")
+
+    parser_warmup_run = warmup_subparsers.add_parser('run', help='Replay the workload once, after clearing the result cache')
+    parser_warmup_run.add_argument('--workload', type=str, default=DEFAULT_WORKLOAD, help='YAML or JSON workload file')
+    parser_warmup_run.add_argument('--from_log', type=str, help='Replay the most frequent calls of this query log instead of a workload file')
+    parser_warmup_run.add_argument('--top', type=int, default=20, help='Number of calls taken from the query log')
+    parser_warmup_run.add_argument('--local_ttl', type=str, help='Run the queries in process on this folder of Turtle files instead of the Fuseki server')
+    parser_warmup_run.add_argument('--store', type=str, default='Interned', help='rdflib store of the in-process graph (Interned or default)')
+
+    warmup_subparsers.add_parser('status', help='Report the last warm-up and the hit rates of the result cache since then')
+
+
     # ------------------------
     # SPARQL Queries Section
     # ------------------------
     # Subparser for SPARQL query operations
     sparql_parser = subparsers.add_parser('sparql', help='Operations related to SPARQL queries')
+    sparql_parser.add_argument('--local_ttl', type=str, help='Run the queries in process on this folder of Turtle files instead of the Fuseki server')
+    sparql_parser.add_argument('--store', type=str, default='Interned', help='rdflib store of the in-process graph (Interned or default)')
+    sparql_parser.add_argument('--sharded', action='store_true', help='Run the queries on the service shards, in parallel')
+    sparql_parser.add_argument('--catalog', type=str, default='data/index/shards.json', help='Shard catalog file (built with index build_shards)')
+    sparql_parser.add_argument('--locality', type=str, help='Only query the shards serving this locality, e.g. Dijon')
+    sparql_parser.add_argument('--query_log', type=str, help='Record every query in this JSON-lines log, e.g. data/log/queries.jsonl')
+    sparql_parser.add_argument('--slow_ms', type=float, default=500, help='Latency from which a query is kept in the slow-query log, in milliseconds')
+    sparql_parser.add_argument('--coverage', type=str, help='Pre-filter the area and combined preferences queries with this coverage index, e.g. data/index/coverage.json')
+    sparql_parser.add_argument('--cache', action='store_true', help='Serve the queries from the result cache filled by warmup run')
+    sparql_parser.add_argument('--cache_file', type=str, default=DEFAULT_CACHE_FILE, help='Result cache file')
+    sparql_parser.add_argument('--result_format', type=str, choices=['tsv', 'csv', 'json'], help='Negotiate this result format with gzip transfer and decode the rows straight into records')
     sparql_subparsers = sparql_parser.add_subparsers(dest="sparql_command", help="SPARQL operations")
 
     # Subparser for fetching restaurant data
@@ -99,6 +285,25 @@ def main():
     parser_restaurant_name = sparql_subparsers.add_parser('restaurant_name', help='Fetch data of a specific restaurant by name')
     parser_restaurant_name.add_argument('--name', type=str, required=True, help='Name of the restaurant to query')
 
+    parser_search = sparql_subparsers.add_parser('search', help='Search restaurants and menu items by text')
+    parser_search.add_argument('--text', type=str, required=True, help='Words to search, e.g. "falafel"')
+    parser_search.add_argument('--limit', type=int, default=20, help='Maximum number of restaurants')
+    parser_search.add_argument('--index', type=str, default='data/index/search.json', help='Search index file (built if missing)')
+
+    parser_facets = sparql_subparsers.add_parser('facets', help='Filter menu items by allergen, diet, price and opening hours')
+    parser_facets.add_argument('--include', type=str, nargs='*', default=[], help='Facets the items must have, e.g. diet:vegan')
+    parser_facets.add_argument('--exclude', type=str, nargs='*', default=[], help='Facets the items must not have, e.g. allergen:gluten (items declaring no allergens are kept unless info:allergens is included)')
+    parser_facets.add_argument('--max_price', type=float, help='Maximum price of the items')
+    parser_facets.add_argument('--open_at', type=str, help='"now", or a day and time such as "Monday 12:30"')
+    parser_facets.add_argument('--limit', type=int, default=20, help='Maximum number of restaurants and items listed')
+    parser_facets.add_argument('--index', type=str, default='data/index/facets.json', help='Facet index file (built if missing)')
+
+    sparql_subparsers.add_parser('restaurant_summary', help='Fetch the precomputed restaurant summaries')
+
+    parser_restaurant_page = sparql_subparsers.add_parser('restaurant_page', help='Fetch everything shown on a restaurant page with concurrent queries')
+    parser_restaurant_page.add_argument('--name', type=str, required=True, help='Exact name of the restaurant')
+    parser_restaurant_page.add_argument('--timeout', type=float, default=30.0, help='Timeout of the page in seconds')
+
     parser_by_day_time = sparql_subparsers.add_parser('open_by_day_time', help='Fetch restaurants open on a specific day and time')
     parser_by_day_time.add_argument('--day', type=str, required=True, help='Day of the week')
     parser_by_day_time.add_argument('--open_time', type=str, required=True, help='Opening time (HH:MM)')
@@ -113,21 +318,113 @@ def main():
     
 
     # Subparser for fetching restaurants with menu items within a specific price range
+    parser_delivers_to = sparql_subparsers.add_parser('delivers_to', help='List the services and restaurants delivering to a location')
+    parser_delivers_to.add_argument('--latitude', type=float, required=True, help='Latitude of the location')
+    parser_delivers_to.add_argument('--longitude', type=float, required=True, help='Longitude of the location')
+    parser_delivers_to.add_argument('--index', type=str, default='data/index/coverage.json', help='Coverage index file (built if missing)')
+
     parser_price_range = sparql_subparsers.add_parser('price_range', help='Fetch restaurants with menu items within a specific price range')
     parser_price_range.add_argument('--max_price', type=float, required=True, help='Maximum price for menu items')
 
+    parser_stats = sparql_subparsers.add_parser('stats', help='Summarize the hot and slow query templates of the query log')
+    parser_stats.add_argument('--top', type=int, default=10, help='Number of slow queries listed')
+    parser_stats.add_argument('--plans', action='store_true', help='Also print the plan of the slow queries run in process')
+
+    parser_result_formats = sparql_subparsers.add_parser('result_formats', help='Compare the decoding of the price range results in JSON, TSV and CSV')
+    parser_result_formats.add_argument('--max_price', type=float, default=1000.0, help='Maximum price for menu items')
+    parser_result_formats.add_argument('--repeat', type=int, default=5, help='Number of runs, the best one is kept')
+
 
     # Subparser for fetching restaurants based on combined user preferences
     parser_combined_prefs = sparql_subparsers.add_parser('combined_prefs', help='Fetch restaurants based on combined user preferences')
-    parser_combined_prefs.add_argument('--user_prefs_uri', type=str, required=True, help='URI of the user preferences graph')
+    parser_combined_prefs.add_argument('--user_prefs_uri', type=str, help='URI of the user preferences graph')
+    parser_combined_prefs.add_argument('--user_id', type=str, help='Id of a user ingested with set_preferences --bulk')
 
    
     args = parser.parse_args()
-    
 
-   
-    if hasattr(args, 'func'):
-        args.func()
+    # Collect metrics and profile the command if requested
+    if args.metrics:
+        instrumentation.enable()
+    if args.profile:
+        instrumentation.profile_call(args.profile, run_command, args, parser, rdf_parser, sparql_parser, summary_parser, index_parser, export_parser, warmup_parser, crawl_parser)
+        print(f"Profile written into {args.profile}")
+    else:
+        run_command(args, parser, rdf_parser, sparql_parser, summary_parser, index_parser, export_parser, warmup_parser, crawl_parser)
+    if args.metrics:
+        instrumentation.write_metrics(args.metrics, args.metrics_format)
+        print(f"Metrics written into {args.metrics}")
+
+
+def print_warmup(report):
+    """
+    Print the report of a warm-up.
+    """
+    for entry in report['calls']:
+        print(f"{entry['latency_ms']:>10.1f} ms{entry['rows']:>7} rows  {entry['method']} "
+              f"{json.dumps(entry['params'], ensure_ascii=False)}" + (f"  FAILED: {entry['error']}" if entry['error'] else ""))
+    print(f"Warm-up of {len(report['calls'])} queries in {report['duration']:.1f} s, {report['errors']} failed")
+
+
+def invalidate_results(args):
+    """
+    Remove the cached results of the server after a write to its data, whether or
+    not a warm-up follows.
+    """
+    invalidate("http://localhost:3030/webproject/query", getattr(args, 'cache_file', DEFAULT_CACHE_FILE))
+
+
+def warm_up_after_load(args):
+    """
+    Warm up the server and the result cache after a successful rdf load, unless
+    --no_warmup. A missing workload does not fail the load.
+    """
+    if args.no_warmup:
+        return
+    try:
+        calls = load_workload(args.workload)
+    except (OSError, ValueError) as e:
+        print(f"No warm-up: {e}")
+        return
+    result_cache = ResultCache(args.cache_file)
+    try:
+        print_warmup(warm_up(SPARQLQueries("http://localhost:3030/webproject/query"), calls, result_cache))
+    finally:
+        result_cache.close()
+
+
+def run_command(args, parser, rdf_parser, sparql_parser, summary_parser, index_parser, export_parser, warmup_parser, crawl_parser):
+    """
+    Run the command selected on the command line.
+    """
+    if args.command == 'jsonld':
+        archive = CrawlArchive(args.archive, args.compression) if args.archive else None
+        html_capture = HtmlArchive(args.capture_html) if args.capture_html else None
+        set_html_capture(html_capture)
+        try:
+            if args.replay:
+                # Only the restaurants or the offers when one of them is given
+                kinds = (args.jsonld_command,) if args.jsonld_command in ('restaurant', 'offer') else ('restaurant', 'offer')
+                start = time.perf_counter()
+                summary = replay_html_archive(args.replay, kinds, archive, args.workers)
+                print(f"{summary['pages']} pages replayed in {time.perf_counter() - start:.1f} s: "
+                      f"{summary['restaurant']} restaurants, {summary['offer']} offers")
+            elif args.jsonld_command == 'get':
+                if not archive:
+                    parser.error("jsonld get requires --archive")
+                record = archive.get(args.service, args.restaurant_id, args.kind)
+                print(json.dumps(record, indent=2, ensure_ascii=False) if record else
+                      f"No {args.kind} {args.restaurant_id} of {args.service} in {args.archive}")
+            elif hasattr(args, 'func'):
+                args.func(archive)
+            else:
+                parser.print_help()
+        finally:
+            if archive:
+                archive.close()
+            if html_capture:
+                html_capture.close()
+                set_html_capture(None)
     elif args.command == 'rdf':
         handler = RDFHandler("http://localhost:3030")
 
@@ -153,18 +450,104 @@ def main():
 
             handler.upload_data_to_server(rdf_data.serialize(format="turtle"), args.graph_uri)
             print(f"Data uploaded successfully to {args.graph_uri}")
+            invalidate_results(args)
+            warm_up_after_load(args)
         elif args.rdf_command == 'update':
             handler.update_data_on_server(args.update_query)
+            invalidate_results(args)
             print("Data updated successfully.")
+        elif args.rdf_command == 'bulk_update':
+            # Both files are parsed first, so that a parse error sends nothing
+            deleted = Graph().parse(args.delete) if args.delete else None
+            inserted = Graph().parse(args.insert) if args.insert else None
+            with handler.update_batcher(max_triples=args.batch_size) as batcher:
+                # Deletions first, so that changed triples are replaced
+                if deleted is not None:
+                    batcher.delete(deleted, args.graph_uri)
+                if inserted is not None:
+                    batcher.insert(inserted, args.graph_uri)
+            for result in batcher.results:
+                status = "OK" if result.ok else f"FAILED: {result.error}"
+                print(f"Batch {result.batch:<6}{result.triples:>8} triples{result.duration:>8.2f}s  {status}")
+            invalidate_results(args)
+            if all(result.ok for result in batcher.results):
+                warm_up_after_load(args)
+        elif args.rdf_command == 'normalize':
+            if args.sample:
+                sparql_queries = SPARQLQueries("http://localhost:3030/webproject/query")
+                timings = compare_query_timings(args.ttl_folder, {
+                    'price_range': (RUNTIME_CAST_QUERIES['price_range'],
+                                    sparql_queries.build_restaurants_by_price_range_query(10.0)),
+                    'open_hours': (RUNTIME_CAST_QUERIES['open_hours'],
+                                   sparql_queries.build_restaurants_by_day_and_time_query("Monday", "11:30", "14:00")),
+                }, sample=args.sample)
+                for name, (before_ms, after_ms, before_rows, after_rows) in timings.items():
+                    print(f"{name}: {before_ms:.1f} ms ({before_rows} rows) before, {after_ms:.1f} ms ({after_rows} rows) after")
+            summary = migrate_ttl_folder(args.ttl_folder, args.dry_run)
+            print(f"{summary['changed_files']} of {summary['files']} files {'to rewrite' if args.dry_run else 'rewritten'}: "
+                  + ", ".join(f"{value} {name}" for name, value in sorted(summary['literals'].items())))
+        elif args.rdf_command == 'sync':
+            summary = sync_graph(handler, args.file, args.graph_uri, args.dry_run, args.batch_size)
+            print(f"{summary['graph']}: {summary['local_triples']} local triples, {summary['remote_triples']} remote triples")
+            print(f"Inserted: {summary['inserted']}, deleted: {summary['deleted']}, method: {summary['method']}"
+                  + (" (dry run)" if args.dry_run else ""))
+            for error in summary['errors']:
+                print(f"Update failed: {error}")
+            if not args.dry_run:
+                invalidate_results(args)
+            if not args.dry_run and not summary['errors'] and (summary['inserted'] or summary['deleted']):
+                warm_up_after_load(args)
         elif args.rdf_command == 'delete':
             handler.delete_graph(args.graph_uri)
+            invalidate_results(args)
             print(f"Graph {args.graph_uri} deleted successfully.")
         else:
             rdf_parser.print_help()
 
+    elif args.command == 'sparql' and args.sparql_command == 'stats':
+        log_file = args.query_log or DEFAULT_LOG_FILE
+        templates, slow = summarize_query_log(log_file)
+        print(f"{'Template':<50}{'Calls':>7}{'Total s':>10}{'Mean ms':>10}{'p95 ms':>10}{'Max ms':>10}{'Rows':>9}{'KB':>9}{'Slow':>6}{'Cached':>8}")
+        for summary in templates:
+            kilobytes = f"{summary['bytes'] / 1024:.0f}" if summary['bytes'] is not None else "-"
+            print(f"{summary['template']:<50}{summary['calls']:>7}{summary['total_ms'] / 1000:>10.2f}{summary['mean_ms']:>10.1f}"
+                  f"{summary['p95_ms']:>10.1f}{summary['max_ms']:>10.1f}{summary['rows']:>9.0f}"
+                  f"{kilobytes:>9}{summary['slow']:>6}{summary['cached']:>8}")
+        if slow:
+            print(f"\nSlowest queries of {slow_log_file(log_file)}:")
+        for entry in slow[:args.top]:
+            print(f"{entry['latency_ms']:>10.1f} ms  {entry['template']} {json.dumps(entry['params'], ensure_ascii=False)}"
+                  f"  {entry['rows']} rows, {entry['backend']}")
+            for explain in entry.get('explain', []) if args.plans else []:
+                for line in explain['plan']:
+                    print(" " * 14 + line)
+
     # SPARQLQueries instance
     elif args.command == 'sparql':
-        sparql_queries = SPARQLQueries("http://localhost:3030/webproject/query")
+        if args.query_log:
+            set_query_log(QueryLog(args.query_log, args.slow_ms))
+        if args.cache:
+            set_result_cache(ResultCache(args.cache_file))
+        if args.sharded:
+            start = time.perf_counter()
+            if args.local_ttl:
+                catalog, shard_graphs = build_shards(args.local_ttl, store=args.store)
+                print(f"{len(catalog.shards)} shards loaded in {time.perf_counter() - start:.1f} s")
+            else:
+                catalog, shard_graphs = ShardCatalog.load(args.catalog), None
+            sparql_queries = ShardedSPARQLQueries("http://localhost:3030/webproject/query", catalog,
+                                                  args.locality, shard_graphs, source=args.local_ttl)
+        elif args.local_ttl:
+            start = time.perf_counter()
+            graph = load_ttl_folder(args.local_ttl, args.store)
+            print(f"{len(graph)} triples loaded in {time.perf_counter() - start:.1f} s")
+            sparql_queries = LocalSPARQLQueries(graph, args.local_ttl)
+        elif args.result_format:
+            sparql_queries = TabularSPARQLQueries("http://localhost:3030/webproject/query", args.result_format)
+        else:
+            sparql_queries = SPARQLQueries("http://localhost:3030/webproject/query")
+        if args.coverage:
+            sparql_queries.coverage_index = CoverageIndex.load(args.coverage)
 
         if args.sparql_command == 'restaurant':
             restaurant_data = sparql_queries.get_restaurant_data()
@@ -174,6 +557,50 @@ def main():
             restaurant_data = sparql_queries.get_restaurant_data_by_name(args.name)
             for restaurant in restaurant_data:
                 print(restaurant)
+        elif args.sparql_command == 'search':
+            results, elapsed = search_restaurants(args.text, args.index, limit=args.limit)
+            for result in results:
+                print(result)
+            print(f"{len(results)} restaurants found in {elapsed:.2f} ms")
+        elif args.sparql_command == 'facets':
+            try:
+                parse_open_at(args.open_at)
+            except ValueError as e:
+                sparql_parser.error(f"--open_at: {e}")
+            try:
+                result, items, elapsed = filter_menu_items(args.include, args.exclude, args.max_price, args.open_at,
+                                                           args.index, limit=args.limit)
+            except KeyError as e:
+                sparql_parser.error(e.args[0])
+            print(f"{result['items']} menu items in {result['restaurants']} restaurants ({elapsed:.2f} ms)")
+            if result['undeclared'] and any(facet.startswith('allergen:') for facet in args.exclude):
+                print(f"{result['undeclared']} of these items declare no allergens; "
+                      f"--include {DECLARED} keeps only the items declaring them")
+            for restaurant in result['top_restaurants']:
+                print(restaurant)
+            for item in items:
+                print(item)
+            print({facet: value for facet, value in result['facets'].items() if value})
+        elif args.sparql_command == 'restaurant_summary':
+            for summary in sparql_queries.get_restaurant_summaries():
+                print(summary)
+        elif args.sparql_command == 'restaurant_page':
+            client = SyncSPARQLQueries("http://localhost:3030/webproject/query")
+            try:
+                page = client.get_restaurant_page(args.name, timeout=args.timeout)
+            except asyncio.TimeoutError:
+                print(f"An error occurred: the page did not complete in {args.timeout} s")
+                page = {}
+            except aiohttp.ClientError as e:
+                # Reported as the other sparql commands do
+                print(f"An error occurred: {e}")
+                page = {}
+            finally:
+                client.close()
+            for section, entries in page.items():
+                print(f"{section}:")
+                for entry in entries:
+                    print(f"  {entry}")
         elif args.sparql_command == 'open_by_day_time':
             data = sparql_queries.get_restaurants_by_day_and_time(args.day, args.open_time, args.close_time)
             for entry in data:
@@ -182,24 +609,193 @@ def main():
             area_data = sparql_queries.get_restaurants_in_area(args.central_lat, args.central_long, args.lat_range, args.long_range)
             for entry in area_data:
                 print(entry)
+        elif args.sparql_command == 'delivers_to':
+            if os.path.exists(args.index):
+                index = CoverageIndex.load(args.index)
+            else:
+                index = build_coverage_index()
+                index.save(args.index)
+            start = time.perf_counter()
+            services = index.services_delivering_to(args.latitude, args.longitude)
+            restaurants = index.restaurants_delivering_to(args.latitude, args.longitude)
+            elapsed = (time.perf_counter() - start) * 1e6
+            for service, distance in services:
+                print(f"{service:<24}{index.services[service]['locality'] or '':<32}{distance:>6.1f} km from the center, "
+                      f"radius {index.services[service]['radius_km']:.1f} km")
+            print(f"{len(services)} services and {len(restaurants)} restaurants deliver there ({elapsed:.0f} µs)")
         elif args.sparql_command == 'price_range':
             price_range_data = sparql_queries.get_restaurants_by_price_range(args.max_price)
             for entry in price_range_data:
                 print(entry)
+        elif args.sparql_command == 'result_formats':
+            query = sparql_queries.build_restaurants_by_price_range_query(args.max_price)
+            if args.local_ttl and not args.sharded:
+                documents = local_result_documents(sparql_queries.graph, query)
+            else:
+                documents = remote_result_documents("http://localhost:3030/webproject/query", query)
+            report = benchmark_result_formats(documents, PRICE_RANGE_FIELDS, sparql_queries.format_price_range_data,
+                                              args.repeat)
+            for result_format, entry in report.items():
+                print(f"{result_format:<6}{entry['rows']:>8} rows{entry['bytes']:>12} bytes{entry['gzip_bytes']:>10} gzip"
+                      f"{entry['decode_ms']:>10.1f} ms  {'identical' if entry['identical'] else 'DIFFERENT'}")
         elif args.sparql_command == 'delivery_services':
             delivery_services_data = sparql_queries.get_delivery_services()
             for result in delivery_services_data:
                 print(result)
         elif args.sparql_command == 'combined_prefs':
-            combined_prefs_data = sparql_queries.query_restaurants_based_on_combined_preferences(args.user_prefs_uri)
+            if args.user_id:
+                combined_prefs_data = sparql_queries.query_restaurants_based_on_combined_preferences(
+                    str(user_iri(args.user_id)), user_graph_uri(args.user_id))
+            elif args.user_prefs_uri:
+                combined_prefs_data = sparql_queries.query_restaurants_based_on_combined_preferences(args.user_prefs_uri)
+            else:
+                sparql_parser.error("combined_prefs requires --user_prefs_uri or --user_id")
             for entry in combined_prefs_data:
                 print(entry)
 
         else:
             sparql_parser.print_help()
 
+    elif args.command == 'warmup':
+        if args.warmup_command == 'run':
+            calls = workload_from_log(args.from_log, args.top) if args.from_log else load_workload(args.workload)
+            if args.local_ttl:
+                start = time.perf_counter()
+                graph = load_ttl_folder(args.local_ttl, args.store)
+                print(f"{len(graph)} triples loaded in {time.perf_counter() - start:.1f} s")
+                sparql_queries = LocalSPARQLQueries(graph, args.local_ttl)
+            else:
+                sparql_queries = SPARQLQueries("http://localhost:3030/webproject/query")
+            result_cache = ResultCache(args.cache_file)
+            print_warmup(warm_up(sparql_queries, calls, result_cache))
+            result_cache.close()
+        elif args.warmup_command == 'status':
+            result_cache = ResultCache(args.cache_file)
+            status = result_cache.status()
+            result_cache.close()
+            warmup = status['warmup']
+            if warmup:
+                print(f"Last warm-up {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(warmup['started']))}: "
+                      f"{warmup['queries']} queries in {warmup['duration']:.1f} s, {warmup['errors']} failed")
+            else:
+                print("No warm-up yet")
+            print(f"{status['results']} cached results, {status['expired']} expired")
+            print(f"{'Template':<50}{'Hits':>8}{'Misses':>8}{'Hit rate':>10}")
+            for template, hits, misses in status['lookups']:
+                print(f"{template:<50}{hits:>8}{misses:>8}{hits / (hits + misses):>10.0%}")
+            hits = sum(lookup[1] for lookup in status['lookups'])
+            lookups = sum(lookup[1] + lookup[2] for lookup in status['lookups'])
+            print(f"{'Total':<50}{hits:>8}{lookups - hits:>8}{hits / lookups if lookups else 0:>10.0%}")
+        else:
+            warmup_parser.print_help()
+
+    elif args.command == 'set_preferences':
+        if args.bulk:
+            summary = ingest_user_profiles(RDFHandler("http://localhost:3030"), args.bulk, args.batch_size, args.dry_run)
+            if not args.dry_run:
+                invalidate_results(args)
+            for invalid in summary['invalid']:
+                print(f"Line {invalid['line']} ({invalid['id']}): {', '.join(invalid['errors'])}")
+            print(f"{summary['users']} users ({summary['triples']} triples) ingested, "
+                  f"{len(summary['invalid'])} invalid profiles, {len(summary['errors'])} failed batches")
+        else:
+            set_user_preferences()
+            invalidate_results(args)
+
+    elif args.command == 'crawl':
+        frontier = CrawlFrontier(args.db)
+        if args.crawl_command == 'discover':
+            summary = discover_restaurants(frontier)
+            print(f"{summary['listed']} restaurant links, {summary['new']} new pages, {summary['unlisted']} pages no longer listed")
+        elif args.crawl_command == 'run':
+            html_capture = HtmlArchive(args.capture_html) if args.capture_html else None
+            set_html_capture(html_capture)
+            try:
+                if args.archive:
+                    with CrawlArchive(args.archive) as archive:
+                        summary = crawl_due_pages(frontier, args.budget, archive)
+                else:
+                    summary = crawl_due_pages(frontier, args.budget)
+            finally:
+                if html_capture:
+                    html_capture.close()
+                    set_html_capture(None)
+            print(f"{summary['fetched']} pages fetched with {summary['requests']} requests: {summary['changed']} changed, "
+                  f"{summary['unchanged']} unchanged, {summary['failed']} failed")
+        elif args.crawl_command == 'status':
+            for key, value in frontier.status().items():
+                print(f"{key:<22}{round(value or 0, 1)}")
+        else:
+            crawl_parser.print_help()
+        frontier.close()
+
     elif args.command == 'convert_jsonld':
-        process_jsonld_folders(args.input_folder)
+        if args.archive:
+            records = convert_archive_jsonld_to_rdf(args.archive, args.output_folder, args.skolemize, args.context_file)
+            print(f"{records} records converted into {args.output_folder}")
+        elif args.input_folder:
+            process_jsonld_folders(args.input_folder, args.skolemize, args.context_file)
+        else:
+            parser.error("convert_jsonld requires --input_folder or --archive")
+
+    elif args.command == 'summary':
+        if args.summary_command == 'build':
+            summaries = build_restaurant_summaries(args.ttl_folder)
+            save_summaries(summaries, args.output)
+            print(f"{len(summaries)} restaurant summaries written into {args.output}")
+            if args.upload:
+                triples = publish_summaries(RDFHandler("http://localhost:3030"), summaries)
+                invalidate_results(args)
+                print(f"{triples} triples uploaded to the summary graph")
+        elif args.summary_command == 'list':
+            for summary in load_summaries(args.input):
+                print(summary)
+        else:
+            summary_parser.print_help()
+
+    elif args.command == 'index':
+        if args.index_command == 'build_search':
+            index = build_search_index(args.ttl_folder)
+            index.save(args.output)
+            print(f"{len(index.restaurants)} restaurants and {len(index.items)} menu items indexed into {args.output}")
+        elif args.index_command == 'build_facets':
+            index = build_facet_index(args.ttl_folder)
+            index.save(args.output)
+            print(f"{len(index.items)} menu items and {len(index.facets)} facets indexed into {args.output}")
+        elif args.index_command == 'build_shards':
+            catalog, _ = build_shards(args.ttl_folder, RDFHandler("http://localhost:3030") if args.upload else None)
+            if args.upload:
+                invalidate_results(args)
+            catalog.save(args.output)
+            print(f"{len(catalog.shards)} service shards written into {args.output}"
+                  + (" and uploaded" if args.upload else ""))
+        elif args.index_command == 'build_coverage':
+            index = build_coverage_index(args.ttl_folder)
+            index.save(args.output)
+            print(f"{len(index.services)} service areas and {len(index.restaurants)} restaurants indexed into {args.output}")
+        else:
+            index_parser.print_help()
+
+    elif args.command == 'export':
+        if args.export_command == 'query':
+            if args.local_ttl:
+                sparql_queries = LocalSPARQLQueries(load_ttl_folder(args.local_ttl, args.store), args.local_ttl)
+            else:
+                sparql_queries = SPARQLQueries("http://localhost:3030/webproject/query")
+            table = export_query_results(sparql_queries, args.method, args.args, args.output)
+            print(f"{table.num_rows} rows written into {args.output}: "
+                  + ", ".join(f"{field.name} ({field.type})" for field in table.schema))
+        elif args.export_command == 'corpus':
+            start = time.perf_counter()
+            rows = export_corpus(args.ttl_folder, args.output_folder, args.format, args.batch_size)
+            print(f"Exported into {args.output_folder} in {time.perf_counter() - start:.1f} s: "
+                  + ", ".join(f"{table} {count} rows" for table, count in rows.items()))
+        else:
+            export_parser.print_help()
+
+    elif args.command == 'generate_corpus':
+        write_corpus(args.output_folder, args.format, services=args.services,
+                     restaurants=args.restaurants, seed=args.seed)
 
     else:
         parser.print_help()
@@ -0,0 +1,238 @@
+"""
+query_log.py
+
+Log of the queries of SPARQLQueries, to find the hot and the slow query templates.
+
+Every call of an observed method (the get_* methods of SPARQLQueries and its
+subclasses) is recorded as one JSON line of the query log: its template (the method
+name, e.g. get_restaurants_by_price_range), its bound parameters, latency, number
+of result rows, response bytes when the backend reports them, and the backend.
+
+The calls slower than a threshold are also kept in a rolling slow-query log,
+{log}.slow.jsonl, holding the latest slow calls with their query text and, for
+in-process backends (LocalSPARQLQueries), the plan of each query with the
+cardinality of each triple pattern on the graph.
+
+Logging is off until a QueryLog is set with set_query_log.
+"""
+
+import os
+import json
+import math
+import time
+import inspect
+import threading
+import functools
+from collections import deque
+import result_cache
+from instrumentation import count
+
+DEFAULT_LOG_FILE = 'data/log/queries.jsonl'
+
+# Latency from which a call is logged as slow, in milliseconds
+SLOW_MS = 500
+
+# Number of slow calls kept in the slow-query log
+SLOW_LOG_SIZE = 200
+
+# Size from which the query log is rotated to {log}.1
+MAX_LOG_BYTES = 10 * 1024 * 1024
+
+QUERY_LOG = None
+
+_local = threading.local()
+
+
+def set_query_log(query_log):
+    """
+    Set the QueryLog receiving the observed calls, or None to stop logging.
+    """
+    global QUERY_LOG
+    QUERY_LOG = query_log
+
+
+def slow_log_file(log_file):
+    return os.path.splitext(log_file)[0] + '.slow.jsonl'
+
+
+def bind_params(func, args, kwargs):
+    """
+    Parameters of a call of a method, by name, without self.
+    """
+    bound = inspect.signature(func).bind(None, *args, **kwargs)
+    bound.apply_defaults()
+    return dict(list(bound.arguments.items())[1:])
+
+
+def observed_query(func):
+    """
+    Decorator of the query methods of SPARQLQueries, recording each call in the
+    query log and serving it from the result cache (see result_cache.py) when one is
+    set. Calls made from inside an observed call are part of it.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        cache = result_cache.RESULT_CACHE
+        if (QUERY_LOG is None and cache is None) or getattr(_local, 'current', None) is not None:
+            return func(self, *args, **kwargs)
+        params = bind_params(func, args, kwargs)
+        current = {'queries': [], 'bytes': None, 'error': None, 'cached': False}
+        start = time.perf_counter()
+        result = cache.get(self, func.__name__, params) if cache is not None else None
+        if result is not None:
+            current['cached'] = True
+        else:
+            _local.current = current
+            try:
+                result = func(self, *args, **kwargs)
+            finally:
+                _local.current = None
+            # Failed queries return no rows, which must not be served from the cache
+            if cache is not None and current['error'] is None:
+                cache.put(self, func.__name__, params, result)
+        _local.last = current
+        if QUERY_LOG is not None:
+            QUERY_LOG.record(func.__name__, params, time.perf_counter() - start, len(result), current, self)
+        return result
+    return wrapper
+
+
+def note_query(query, response_bytes=None, error=None):
+    """
+    Note a query executed by the current observed call, with the size of its response
+    and its error, if any. Called by the execute_query methods.
+    """
+    current = getattr(_local, 'current', None)
+    if current is None:
+        return
+    current['queries'].append(query)
+    if response_bytes is not None:
+        current['bytes'] = (current['bytes'] or 0) + response_bytes
+    if error is not None:
+        current['error'] = error
+
+
+def last_error():
+    """
+    Error of the last observed call of this thread, or None. The execute_query
+    methods return no rows on errors, so callers tell a failure apart with it.
+    """
+    last = getattr(_local, 'last', None)
+    return last['error'] if last else None
+
+
+class QueryLog:
+    """
+    JSON-lines log of the observed calls, and rolling log of the slow ones.
+
+    Args:
+        log_file (str): The query log, e.g. data/log/queries.jsonl.
+        slow_ms (float): Latency from which a call is slow, in milliseconds.
+        slow_log_size (int): Number of slow calls kept in {log}.slow.jsonl.
+        explain (bool): Capture the plan of the slow queries of in-process backends.
+    """
+
+    def __init__(self, log_file=DEFAULT_LOG_FILE, slow_ms=SLOW_MS, slow_log_size=SLOW_LOG_SIZE, explain=True):
+        self.log_file = log_file
+        self.slow_ms = slow_ms
+        self.explain = explain
+        self.lock = threading.Lock()
+        self.slow = deque(read_log(slow_log_file(log_file)), maxlen=slow_log_size)
+        os.makedirs(os.path.dirname(log_file) or '.', exist_ok=True)
+        if os.path.exists(log_file) and os.path.getsize(log_file) > MAX_LOG_BYTES:
+            os.replace(log_file, log_file + '.1')
+
+    def record(self, template, params, latency, rows, current, client):
+        """
+        Record a call.
+
+        Args:
+            template (str): The method, e.g. 'get_restaurants_by_price_range'.
+            params (dict): Its parameters by name.
+            latency (float): Duration of the call in seconds.
+            rows (int): Number of result rows.
+            current (dict): Queries, response bytes and error noted during the call.
+            client (SPARQLQueries): The client, whose explain() is used for slow queries.
+        """
+        entry = {
+            'time': time.time(),
+            'template': template,
+            'params': params,
+            'latency_ms': round(latency * 1000, 3),
+            'rows': rows,
+            'bytes': current['bytes'],
+            'backend': type(client).__name__,
+            'slow': latency * 1000 >= self.slow_ms,
+        }
+        if current.get('cached'):
+            entry['cached'] = True
+        if current['error']:
+            entry['error'] = current['error']
+        count("query_log.calls")
+        with self.lock:
+            with open(self.log_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False, default=str) + '\n')
+            if not entry['slow']:
+                return
+            count("query_log.slow_calls")
+            slow_entry = dict(entry, queries=current['queries'])
+            if self.explain and hasattr(client, 'explain'):
+                slow_entry['explain'] = [client.explain(query) for query in current['queries']]
+            self.slow.append(slow_entry)
+            # The slow log is small, rewritten with the latest slow calls only
+            with open(slow_log_file(self.log_file), 'w', encoding='utf-8') as f:
+                for slow in self.slow:
+                    f.write(json.dumps(slow, ensure_ascii=False, default=str) + '\n')
+
+
+def read_log(log_file):
+    """
+    Entries of a query log or slow-query log, oldest first.
+    """
+    if not os.path.exists(log_file):
+        return []
+    with open(log_file, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of sorted values, e.g. fraction=0.95 for the p95.
+    """
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)] if sorted_values else 0
+
+
+def summarize_query_log(log_file=DEFAULT_LOG_FILE):
+    """
+    Summarize the query log by template.
+
+    Returns:
+        tuple: The templates, hottest (most total time) first, as dicts with the number
+            of calls, total, mean, p50, p95 and max latency in ms, mean rows and bytes,
+            slow, cached and failed calls; and the slow calls of the slow-query log, slowest first.
+    """
+    templates = {}
+    for entry in read_log(log_file):
+        templates.setdefault(entry['template'], []).append(entry)
+
+    summaries = []
+    for template, entries in templates.items():
+        latencies = sorted(entry['latency_ms'] for entry in entries)
+        sizes = [entry['bytes'] for entry in entries if entry.get('bytes') is not None]
+        summaries.append({
+            'template': template,
+            'calls': len(entries),
+            'total_ms': sum(latencies),
+            'mean_ms': sum(latencies) / len(latencies),
+            'p50_ms': percentile(latencies, 0.5),
+            'p95_ms': percentile(latencies, 0.95),
+            'max_ms': latencies[-1],
+            'rows': sum(entry['rows'] for entry in entries) / len(entries),
+            'bytes': sum(sizes) / len(sizes) if sizes else None,
+            'slow': sum(1 for entry in entries if entry['slow']),
+            'cached': sum(1 for entry in entries if entry.get('cached')),
+            'errors': sum(1 for entry in entries if entry.get('error')),
+        })
+    summaries.sort(key=lambda summary: summary['total_ms'], reverse=True)
+    slow = sorted(read_log(slow_log_file(log_file)), key=lambda entry: entry['latency_ms'], reverse=True)
+    return summaries, slow
@@ -1,5 +1,10 @@
+import time
+import queue
+import threading
+from collections import namedtuple
 import requests
-from rdflib import Graph
+from rdflib import Graph, BNode
+from instrumentation import timed, span, count
 
 class RDFHandler:
     def __init__(self, fuseki_base_url):
@@ -7,59 +12,404 @@ class RDFHandler:
         self.query_endpoint = f"{fuseki_base_url}/webproject/query"
         self.update_endpoint = f"{fuseki_base_url}/webproject/update"
         self.graph_store_endpoint = f"{fuseki_base_url}/webproject/data"
+        # Keep-alive connections shared by all the calls to the server
+        self.session = requests.Session()
 
+    @timed("rdf_handler.query")
     def query_data_from_server(self, query):
         """
         Execute a SPARQL query against the Apache Jena Fuseki server.
         """
-        response = requests.post(self.query_endpoint,
-                                 data={"query": query},
-                                 headers={"Accept": "application/sparql-results+json"})
+        response = self.session.post(self.query_endpoint,
+                                     data={"query": query},
+                                     headers={"Accept": "application/sparql-results+json"})
         if response.ok:
             return response.json()
         else:
             response.raise_for_status()
 
+    @timed("rdf_handler.upload")
     def upload_data_to_server(self, data, graph_uri):
         """
         Upload RDF data to the Apache Jena Fuseki server.
         """
         post_url = f"{self.graph_store_endpoint}?graph={graph_uri}"
         headers = {"Content-Type": "text/turtle"}
-        response = requests.post(post_url, data=data, headers=headers)
+        response = self.session.post(post_url, data=data, headers=headers)
         if response.status_code not in [200, 201]:
             response.raise_for_status()
 
+    @timed("rdf_handler.download")
+    def download_graph_from_server(self, graph_uri):
+        """
+        Download a named graph from the Apache Jena Fuseki server.
+
+        Returns:
+            Graph: The graph, empty if it does not exist on the server.
+        """
+        response = self.session.get(self.graph_store_endpoint, params={"graph": graph_uri},
+                                    headers={"Accept": "application/n-triples"})
+        if response.status_code == 404:
+            return Graph()
+        response.raise_for_status()
+        return self.deserialize_rdf(response.text, format="nt")
+
+    @timed("rdf_handler.replace")
+    def replace_graph_on_server(self, data, graph_uri):
+        """
+        Replace the content of a named graph on the Apache Jena Fuseki server (HTTP PUT).
+        """
+        put_url = f"{self.graph_store_endpoint}?graph={graph_uri}"
+        headers = {"Content-Type": "text/turtle"}
+        response = self.session.put(put_url, data=data, headers=headers)
+        if response.status_code not in [200, 201, 204]:
+            response.raise_for_status()
+
     def serialize_rdf(self, graph):
-        return graph.serialize(format="turtle")
+        with span("graph.serialize", format="turtle"):
+            return graph.serialize(format="turtle")
 
-    def deserialize_rdf(self, data):
+    def deserialize_rdf(self, data, format="turtle"):
         graph = Graph()
-        graph.parse(data=data, format="turtle")
+        with span("graph.parse", format=format):
+            graph.parse(data=data, format=format)
         return graph
 
+    @timed("rdf_handler.update")
     def update_data_on_server(self, update_query):
         """
         Execute a SPARQL UPDATE query against the Apache Jena Fuseki server.
         """
-        response = requests.post(self.update_endpoint,
-                                 data={"update": update_query},
-                                 headers={"Content-Type": "application/sparql-update"})
+        response = self.session.post(self.update_endpoint,
+                                     data=update_query.encode('utf-8'),
+                                     headers={"Content-Type": "application/sparql-update"})
         if response.ok:
-            return response.json()
+            # Fuseki answers an update with an HTML or plain text status page
+            return response.text
         else:
             response.raise_for_status()
 
+    def update_batcher(self, **kwargs):
+        """
+        Create an UpdateBatcher sending its batches through this handler.
+        """
+        return UpdateBatcher(self, **kwargs)
+
+    @timed("rdf_handler.delete_graph")
     def delete_graph(self, graph_uri):
         """
         Delete a specific graph from the Apache Jena Fuseki server.
         """
-        response = requests.delete(f"{self.graph_store_endpoint}?graph={graph_uri}")
+        response = self.session.delete(f"{self.graph_store_endpoint}?graph={graph_uri}")
         if response.ok:
             return "Graph deleted successfully."
         else:
             response.raise_for_status()
 
+BatchResult = namedtuple('BatchResult', ['batch', 'triples', 'bytes', 'ok', 'error', 'duration'])
+
+
+class UpdateBatcher:
+    """
+    Buffer INSERT DATA / DELETE DATA operations and send them to the server as
+    combined SPARQL UPDATE requests.
+
+    A batch is sent once it holds max_triples triples or max_bytes bytes, or when
+    its oldest operation has waited max_delay seconds. Every batch is a single update
+    request, which Fuseki applies in one transaction, and operations keep their order
+    inside and across batches. At most max_pending batches wait to be sent: adding
+    operations blocks beyond that, so a fast producer cannot outrun the server.
+
+    Usage:
+        with handler.update_batcher(max_triples=5000) as batcher:
+            batcher.delete(old_items, graph_uri)
+            batcher.insert(new_items, graph_uri)
+        failed = [result for result in batcher.results if not result.ok]
+    """
+
+    def __init__(self, handler, max_triples=5000, max_bytes=2_000_000, max_delay=2.0,
+                 max_pending=4, on_error=None):
+        self.handler = handler
+        self.max_triples = max_triples
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.on_error = on_error
+        self.results = []
+
+        # Buffered operations: (kind, graph_uri, N-Triples lines, number of triples)
+        self._buffer = []
+        self._buffer_triples = 0
+        self._buffer_bytes = 0
+        self._buffer_since = None
+        self._batches = 0
+        self._lock = threading.Lock()
+        # Batches taken by the sending thread when max_delay expires, not yet sent
+        self._in_flight = 0
+        self._sent = threading.Condition(self._lock)
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._worker = threading.Thread(target=self._send_batches, daemon=True)
+        self._worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def insert(self, triples, graph_uri=None, atomic=False):
+        """
+        Buffer an INSERT DATA of triples (an rdflib Graph or an iterable of triples)
+        into the given graph, or the default graph. The triples connected by blank nodes
+        (e.g. a menu with its sections, items and offers) are always sent in the same
+        operation, since every operation mints new blank nodes on the server. With
+        atomic=True all the triples are sent in the same operation.
+        """
+        self._add('INSERT DATA', triples, graph_uri, atomic)
+
+    def delete(self, triples, graph_uri=None):
+        """
+        Buffer a DELETE DATA of triples from the given graph, or the default graph.
+        DELETE DATA cannot match blank nodes, so triples with blank nodes are rejected.
+        """
+        self._add('DELETE DATA', triples, graph_uri)
+
+    def delete_matching(self, triples, graph_uri=None):
+        """
+        Buffer a DELETE WHERE removing the triples, their blank nodes being matched
+        as variables, e.g. to delete a menu section with its items and offers.
+        """
+        variables = {}
+        lines = []
+        for triple in triples:
+            terms = [f"?b{variables.setdefault(term, len(variables))}" if isinstance(term, BNode) else term.n3()
+                     for term in triple]
+            lines.append(" ".join(terms) + " .")
+        if lines:
+            self._append('DELETE WHERE', graph_uri, "\n".join(lines), len(lines))
+
+    def clear(self, graph_uri):
+        """
+        Buffer a CLEAR of a named graph, e.g. before inserting its new content.
+        """
+        self._append('CLEAR', graph_uri, "", 0)
+
+    def replace(self, triples, graph_uri):
+        """
+        Buffer a CLEAR of a named graph followed by an INSERT DATA of all its new triples.
+        Both operations are buffered together, so that they are always sent in the same
+        request and the graph is never left empty between two requests.
+        """
+        lines = [" ".join(term.n3() for term in triple) + " ." for triple in triples]
+        operations = [('CLEAR', graph_uri, "", 0)]
+        if lines:
+            operations.append(('INSERT DATA', graph_uri, "\n".join(lines), len(lines)))
+        self._append_operations(operations)
+
+    def _add(self, kind, triples, graph_uri, atomic=False):
+        triples = list(triples)
+        # Checked before buffering anything, so that a rejected delete removes nothing
+        if kind == 'DELETE DATA':
+            for triple in triples:
+                if any(isinstance(term, BNode) for term in triple):
+                    raise ValueError(f"DELETE DATA cannot contain blank nodes: {triple}")
+        lines = []
+        # Triples with blank nodes, grouped by the blank nodes connecting them
+        closures = BlankNodeClosures()
+        for triple in triples:
+            bnodes = [term for term in triple if isinstance(term, BNode)]
+            line = " ".join(term.n3() for term in triple) + " ."
+            if atomic:
+                lines.append(line)
+            elif bnodes:
+                closures.add(bnodes, line)
+            else:
+                self._append(kind, graph_uri, line, 1)
+        for closure in closures.groups():
+            self._append(kind, graph_uri, "\n".join(closure), len(closure))
+        if lines:
+            self._append(kind, graph_uri, "\n".join(lines), len(lines))
+
+    def _append(self, kind, graph_uri, text, triples):
+        self._append_operations([(kind, graph_uri, text, triples)])
+
+    def _append_operations(self, operations):
+        # The operations are buffered under one lock, so that no batch separates them
+        with self._lock:
+            if self._buffer_since is None:
+                self._buffer_since = time.monotonic()
+            for kind, graph_uri, text, triples in operations:
+                self._buffer.append((kind, graph_uri, text, triples))
+                self._buffer_triples += triples
+                self._buffer_bytes += len(text)
+            full = self._buffer_triples >= self.max_triples or self._buffer_bytes >= self.max_bytes
+            batch = self._take_batch() if full else None
+        if batch:
+            # Blocks while max_pending batches are waiting for the server
+            self._queue.put(batch)
+
+    def _take_batch(self):
+        """
+        Detach the buffered operations as a new batch. Must be called with the lock held.
+        """
+        if not self._buffer:
+            return None
+        self._batches += 1
+        batch = (self._batches, self._buffer)
+        self._buffer = []
+        self._buffer_triples = 0
+        self._buffer_bytes = 0
+        self._buffer_since = None
+        return batch
+
+    def flush(self):
+        """
+        Send the buffered operations and wait until every batch has been sent.
+        """
+        with self._lock:
+            batch = self._take_batch()
+        if batch:
+            self._queue.put(batch)
+        self._queue.join()
+        with self._lock:
+            while self._in_flight:
+                self._sent.wait()
+
+    def close(self):
+        """
+        Flush the remaining operations and stop the sending thread.
+        """
+        self.flush()
+        self._queue.put(None)
+        self._worker.join()
+
+    def discard(self):
+        """
+        Drop the buffered operations and stop the sending thread, e.g. when the
+        operations of a bulk update could not all be buffered. The batches already
+        handed to the sending thread are still sent.
+        """
+        with self._lock:
+            dropped = self._buffer_triples
+            self._buffer = []
+            self._buffer_triples = 0
+            self._buffer_bytes = 0
+            self._buffer_since = None
+        count("rdf_handler.discarded_triples", dropped)
+        self._queue.put(None)
+        self._worker.join()
+
+    def _send_batches(self):
+        while True:
+            try:
+                batch = self._queue.get(timeout=self.max_delay)
+            except queue.Empty:
+                # Send operations that waited too long for a batch to fill up
+                with self._lock:
+                    expired = self._buffer_since is not None and time.monotonic() - self._buffer_since >= self.max_delay
+                    batch = self._take_batch() if expired else None
+                    if batch:
+                        self._in_flight += 1
+                if batch:
+                    try:
+                        self._send(batch)
+                    finally:
+                        with self._lock:
+                            self._in_flight -= 1
+                            self._sent.notify_all()
+                continue
+
+            if batch is None:
+                self._queue.task_done()
+                return
+            try:
+                self._send(batch)
+            finally:
+                self._queue.task_done()
+
+    def _send(self, batch):
+        number, operations = batch
+        update_query = build_update_request(operations)
+        start = time.perf_counter()
+        try:
+            self.handler.update_data_on_server(update_query)
+            error = None
+        except Exception as e:
+            # Any failure is recorded, the sending thread must survive it
+            error = str(e) or type(e).__name__
+        triples = sum(operation[3] for operation in operations)
+        result = BatchResult(number, triples, len(update_query), error is None, error,
+                             time.perf_counter() - start)
+        self.results.append(result)
+        count("rdf_handler.batches")
+        count("rdf_handler.batched_triples", triples)
+        if error:
+            count("rdf_handler.batch_errors")
+            if self.on_error:
+                try:
+                    self.on_error(result)
+                except Exception as e:
+                    print(f"Error handler of batch {number} failed: {e}")
+
+
+class BlankNodeClosures:
+    """
+    Union-find of blank nodes, grouping the lines of the triples they connect.
+    """
+
+    def __init__(self):
+        self.parents = {}
+        self.lines = {}
+
+    def find(self, bnode):
+        root = self.parents.setdefault(bnode, bnode)
+        while root != self.parents[root]:
+            root = self.parents[root]
+        # Path compression
+        while bnode != root:
+            self.parents[bnode], bnode = root, self.parents[bnode]
+        return root
+
+    def add(self, bnodes, line):
+        root = self.find(bnodes[0])
+        for bnode in bnodes[1:]:
+            other = self.find(bnode)
+            if other != root:
+                self.parents[other] = root
+                self.lines.setdefault(root, []).extend(self.lines.pop(other, []))
+        self.lines.setdefault(root, []).append(line)
+
+    def groups(self):
+        return list(self.lines.values())
+
+
+def build_update_request(operations):
+    """
+    Build a single SPARQL UPDATE request from buffered operations, merging consecutive
+    INSERT DATA or DELETE DATA operations on the same graph into one block. Each
+    DELETE WHERE stays a separate operation, since its variables are scoped to it.
+    """
+    blocks = []
+    for kind, graph_uri, text, _ in operations:
+        if kind.endswith('DATA') and blocks and blocks[-1][0] == kind and blocks[-1][1] == graph_uri:
+            blocks[-1][2].append(text)
+        else:
+            blocks.append((kind, graph_uri, [text]))
+
+    parts = []
+    for kind, graph_uri, texts in blocks:
+        if kind == 'CLEAR':
+            parts.append(f"CLEAR SILENT GRAPH <{graph_uri}>")
+            continue
+        data = "\n".join(texts)
+        if graph_uri:
+            data = f"GRAPH <{graph_uri}> {{\n{data}\n}}"
+        parts.append(f"{kind} {{\n{data}\n}}")
+    return " ;\n".join(parts)
+
+
 # Example Usage
 # if __name__ == "__main__":
 #     handler = RDFHandler("http://localhost:3030")
@@ -0,0 +1,250 @@
+"""
+restaurant_summary.py
+
+Build one compact summary record per restaurant at ingest time, from the Turtle files
+of data/ttl: name, description, first image, address, telephone, coordinates,
+delivery service, minimum and maximum menu price and weekly opening intervals.
+
+The summaries are stored both as a dedicated named graph, queried by
+SPARQLQueries.get_restaurant_summaries, and as a local columnar JSON file, so that
+listing restaurants reads one precomputed row per restaurant instead of joining
+restaurants, images and addresses on every call.
+"""
+
+import os
+import json
+from urllib.parse import urlsplit
+from rdflib import Graph, Literal, URIRef, Namespace
+from rdflib.namespace import RDF, XSD
+from instrumentation import timed, span, count
+from literal_normalization import parse_price_amount
+
+SCHEMA = Namespace("http://schema.org/")
+SUMMARY = Namespace("https://coopcycle.org/summary#")
+
+SUMMARY_GRAPH = "urn:coopcycle:summaries"
+
+SUMMARY_FIELDS = ['restaurant', 'name', 'description', 'image', 'address', 'telephone',
+                  'latitude', 'longitude', 'service', 'service_name', 'min_price', 'max_price',
+                  'open_intervals']
+
+WEEK = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+
+def minutes(time_text):
+    """
+    Convert "HH:MM" (or "HH:MM:SS") to minutes since midnight.
+    """
+    hours, mins = str(time_text).split(':')[:2]
+    return int(hours) * 60 + int(mins)
+
+
+def weekly_intervals(graph, restaurant):
+    """
+    List the weekly opening intervals of a restaurant as [start, end] minutes since
+    Monday 00:00, sorted. An interval closing after midnight ends on the next day.
+    """
+    intervals = []
+    for ohs in graph.objects(restaurant, SCHEMA.openingHoursSpecification):
+        opens, closes = graph.value(ohs, SCHEMA.opens), graph.value(ohs, SCHEMA.closes)
+        if opens is None or closes is None:
+            continue
+        start, end = minutes(opens), minutes(closes)
+        if end <= start:
+            end += 24 * 60
+        for day in graph.objects(ohs, SCHEMA.dayOfWeek):
+            day_name = str(day).split('/')[-1]
+            if day_name in WEEK:
+                offset = WEEK.index(day_name) * 24 * 60
+                intervals.append([offset + start, offset + end])
+    return sorted(intervals)
+
+
+def format_interval(interval):
+    """
+    Format a weekly interval as "Monday 11:30-14:00".
+    """
+    start, end = interval
+    day = WEEK[start // (24 * 60)]
+    start, end = start % (24 * 60), end - (start - start % (24 * 60))
+    return f"{day} {start // 60:02d}:{start % 60:02d}-{(end // 60) % 24:02d}:{end % 60:02d}"
+
+
+def first_value(graph, subject, predicate):
+    """
+    Return the smallest value of a property, so that the choice is stable across runs.
+    """
+    values = sorted(graph.objects(subject, predicate), key=str)
+    return values[0] if values else None
+
+
+def load_services(service_folder):
+    """
+    Map each service IRI to its name from the service Turtle files.
+    """
+    services = {}
+    for file in sorted(os.listdir(service_folder)) if os.path.isdir(service_folder) else []:
+        if file.endswith('.ttl'):
+            g = Graph().parse(os.path.join(service_folder, file), format='turtle')
+            for service in g.subjects(RDF.type, SCHEMA.Service):
+                services[str(service).rstrip('/')] = str(g.value(service, SCHEMA.name) or "")
+    return services
+
+
+def iter_restaurant_graphs(ttl_folder='data/ttl'):
+    """
+    Generator over the restaurants of data/ttl, one small graph at a time.
+
+    The restaurant file data/ttl/restaurant/{i}-{service}/{file}.ttl is read with the
+    offer file of the same name.
+
+    Yields:
+        Graph: The graph of the restaurant and its menu.
+    """
+    restaurant_folder = os.path.join(ttl_folder, 'restaurant')
+    for root, dirs, files in os.walk(restaurant_folder):
+        dirs.sort()
+        for file in sorted(files):
+            if not file.endswith('.ttl'):
+                continue
+            g = Graph()
+            with span("graph.parse"):
+                g.parse(os.path.join(root, file), format='turtle')
+                offer_file = os.path.join(root.replace(restaurant_folder, os.path.join(ttl_folder, 'offer'), 1), file)
+                if os.path.exists(offer_file):
+                    g.parse(offer_file, format='turtle')
+            yield g
+
+
+def restaurant_service(restaurant, services):
+    """
+    Delivery service of a restaurant: the instance serving its IRI, e.g.
+    https://khora.berlin for https://khora.berlin/api/restaurants/1. The folder
+    names of data/ttl are not used, as they are not host names for every instance.
+
+    Args:
+        restaurant (URIRef): The restaurant IRI.
+        services (dict): Service IRI -> name, see load_services.
+
+    Returns:
+        tuple: The service URL, and its name, or its host when it has no service file.
+    """
+    parts = urlsplit(str(restaurant))
+    service_url = f"{parts.scheme}://{parts.netloc}"
+    return service_url, services.get(service_url) or parts.netloc
+
+
+@timed("build_restaurant_summaries")
+def build_restaurant_summaries(ttl_folder='data/ttl'):
+    """
+    Build the summary record of every restaurant of data/ttl, read with its menu and
+    the service serving it (see restaurant_service).
+
+    Returns:
+        list: One dict per restaurant, with the keys of SUMMARY_FIELDS.
+    """
+    services = load_services(os.path.join(ttl_folder, 'service'))
+    summaries = []
+    for g in iter_restaurant_graphs(ttl_folder):
+        for restaurant in sorted(g.subjects(RDF.type, SCHEMA.Restaurant)):
+            summaries.append(summarize_restaurant(g, restaurant, *restaurant_service(restaurant, services)))
+    count("summaries.built", len(summaries))
+    return summaries
+
+
+def summarize_restaurant(graph, restaurant, service_url, service_name):
+    """
+    Build the summary record of a restaurant from its restaurant and offer graph.
+    """
+    address = graph.value(restaurant, SCHEMA.address)
+    geo = graph.value(restaurant, SCHEMA.geo)
+    # Only the prices of the menu item offers, not the delivery charges
+    item_prices = [parse_price_amount(price)
+                   for offer in graph.objects(None, SCHEMA.offers)
+                   for price in graph.objects(offer, SCHEMA.price)]
+    item_prices = [price for price in item_prices if price is not None]
+
+    def value(subject, predicate):
+        found = first_value(graph, subject, predicate) if subject is not None else None
+        return str(found) if found is not None else None
+
+    return {
+        'restaurant': str(restaurant),
+        'name': value(restaurant, SCHEMA.name),
+        'description': value(restaurant, SCHEMA.description),
+        'image': value(restaurant, SCHEMA.image),
+        'address': value(address, SCHEMA.streetAddress),
+        'telephone': value(address, SCHEMA.telephone),
+        'latitude': float(graph.value(geo, SCHEMA.latitude)) if geo is not None else None,
+        'longitude': float(graph.value(geo, SCHEMA.longitude)) if geo is not None else None,
+        'service': service_url,
+        'service_name': service_name,
+        'min_price': min(item_prices) if item_prices else None,
+        'max_price': max(item_prices) if item_prices else None,
+        'open_intervals': weekly_intervals(graph, restaurant),
+    }
+
+
+"""
+FUNCTIONS TO STORE AND READ THE SUMMARIES
+"""
+def save_summaries(summaries, output_file='data/summary/restaurants.columns.json'):
+    """
+    Save the summaries as a columnar JSON file: one list of values per field.
+    """
+    columns = {field: [summary[field] for summary in summaries] for field in SUMMARY_FIELDS}
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump({'fields': SUMMARY_FIELDS, 'rows': len(summaries), 'columns': columns}, f, ensure_ascii=False)
+
+
+def load_summaries(input_file='data/summary/restaurants.columns.json'):
+    """
+    Load the summaries saved by save_summaries.
+
+    Returns:
+        list: One dict per restaurant.
+    """
+    with open(input_file, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    columns = data['columns']
+    return [{field: columns[field][i] for field in data['fields']} for i in range(data['rows'])]
+
+
+def summaries_to_graph(summaries):
+    """
+    Build the summary named graph: one sum:RestaurantSummary resource per restaurant,
+    using the restaurant IRI.
+    """
+    g = Graph()
+    g.bind('ns1', SCHEMA)
+    g.bind('sum', SUMMARY)
+    for summary in summaries:
+        restaurant = URIRef(summary['restaurant'])
+        g.add((restaurant, RDF.type, SUMMARY.RestaurantSummary))
+        for field, predicate in [('name', SCHEMA.name), ('description', SCHEMA.description),
+                                 ('address', SCHEMA.streetAddress), ('telephone', SCHEMA.telephone),
+                                 ('service_name', SUMMARY.serviceName)]:
+            if summary[field] is not None:
+                g.add((restaurant, predicate, Literal(summary[field])))
+        if summary['image']:
+            g.add((restaurant, SCHEMA.image, URIRef(summary['image'])))
+        g.add((restaurant, SCHEMA.provider, URIRef(summary['service'])))
+        for field, predicate in [('latitude', SCHEMA.latitude), ('longitude', SCHEMA.longitude)]:
+            if summary[field] is not None:
+                g.add((restaurant, predicate, Literal(summary[field], datatype=XSD.double)))
+        for field, predicate in [('min_price', SUMMARY.minPrice), ('max_price', SUMMARY.maxPrice)]:
+            if summary[field] is not None:
+                g.add((restaurant, predicate, Literal(f"{summary[field]:.2f}", datatype=XSD.decimal)))
+        for interval in summary['open_intervals']:
+            g.add((restaurant, SUMMARY.openInterval, Literal(format_interval(interval))))
+    return g
+
+
+def publish_summaries(handler, summaries, graph_uri=SUMMARY_GRAPH):
+    """
+    Replace the summary named graph on the Fuseki server.
+    """
+    g = summaries_to_graph(summaries)
+    handler.replace_graph_on_server(handler.serialize_rdf(g), graph_uri)
+    return len(g)
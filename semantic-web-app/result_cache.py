@@ -0,0 +1,190 @@
+"""
+result_cache.py
+
+Local cache of the results of the query methods of SPARQLQueries.
+
+The cache is a SQLite database (data/cache/results.sqlite), so that it is shared by
+the successive commands of the CLI. A result is keyed by the backend (client class,
+endpoint or Turtle folder, locality and coverage index file), the method and its parameters, and expires
+after a TTL. The results of the server are removed by every command writing to its
+data (see invalidate). The hits and misses of every method are counted from the last
+warm-up (see warmup.py), which clears the results of its backend, so that the hit rate
+following a warm-up can be reported.
+
+The cache is off until a ResultCache is set with set_result_cache. It is consulted by
+the observed_query decorator of query_log.py, around every get_* method.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from instrumentation import count
+
+DEFAULT_CACHE_FILE = 'data/cache/results.sqlite'
+
+# Lifetime of a cached result, in seconds
+TTL = 24 * 3600
+
+RESULT_CACHE = None
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    template TEXT NOT NULL,
+    created REAL NOT NULL,
+    result TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS lookups (
+    template TEXT PRIMARY KEY,
+    hits INTEGER NOT NULL DEFAULT 0,
+    misses INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS warmups (
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    queries INTEGER NOT NULL,
+    errors INTEGER NOT NULL
+);
+"""
+
+
+def set_result_cache(result_cache):
+    """
+    Set the ResultCache used by the query methods, or None to disable caching.
+    """
+    global RESULT_CACHE
+    RESULT_CACHE = result_cache
+
+
+def backend(client):
+    """
+    Backend of the results of a client: the Turtle folder of an in-process graph, or
+    the endpoint.
+    """
+    source = getattr(client, 'source', None)
+    return f"file:{os.path.abspath(source)}" if source else client.sparql_endpoint
+
+
+def coverage(client):
+    """
+    Coverage index pre-filtering the queries of a client, as the path and modification
+    time of its file, since its results may differ from those of the full queries.
+    """
+    coverage_index = getattr(client, 'coverage_index', None)
+    if coverage_index is None:
+        return None
+    return coverage_index.source or 'unsaved'
+
+
+def invalidate(sparql_endpoint, db_file=DEFAULT_CACHE_FILE):
+    """
+    Remove the cached results of an endpoint after a write to its data, if there is a cache.
+    """
+    if not os.path.exists(db_file):
+        return
+    result_cache = ResultCache(db_file)
+    try:
+        result_cache.clear(sparql_endpoint)
+    finally:
+        result_cache.close()
+
+
+def normalize_param(value):
+    # 20 (from a workload file) and 20.0 (from the command line) are the same query
+    if isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+
+class ResultCache:
+    """
+    Cache of the results of the query methods, stored in SQLite.
+
+    Args:
+        db_file (str): Database file, created if missing.
+        ttl (float): Lifetime of a result in seconds.
+    """
+
+    def __init__(self, db_file=DEFAULT_CACHE_FILE, ttl=TTL):
+        os.makedirs(os.path.dirname(db_file) or '.', exist_ok=True)
+        self.ttl = ttl
+        # The query methods can be called from several threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def key(client, template, params):
+        return json.dumps([type(client).__name__, backend(client), getattr(client, 'locality', None), template,
+                           {name: normalize_param(value) for name, value in params.items()},
+                           coverage(client)],
+                          sort_keys=True, ensure_ascii=False, default=str)
+
+    def get(self, client, template, params, now=None):
+        """
+        Cached result of a call, or None, counting the hit or miss of its method.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            row = self.db.execute("SELECT result FROM results WHERE key = ? AND created > ?",
+                                  (self.key(client, template, params), now - self.ttl)).fetchone()
+            column = 'hits' if row else 'misses'
+            self.db.execute(f"INSERT INTO lookups (template, {column}) VALUES (?, 1) "
+                            f"ON CONFLICT (template) DO UPDATE SET {column} = {column} + 1", (template,))
+            self.db.commit()
+        count("result_cache.hits" if row else "result_cache.misses")
+        return json.loads(row['result']) if row else None
+
+    def put(self, client, template, params, result, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                            (self.key(client, template, params), template, now,
+                             json.dumps(result, ensure_ascii=False, default=str)))
+            self.db.commit()
+
+    def clear(self, backend=None):
+        """
+        Remove every cached result, or those of one backend (see backend).
+        """
+        with self.lock:
+            if backend is None:
+                self.db.execute("DELETE FROM results")
+            else:
+                # The backend is the second item of the key
+                self.db.execute("DELETE FROM results WHERE json_extract(key, '$[1]') = ?", (backend,))
+            self.db.commit()
+
+    def record_warmup(self, started, duration, queries, errors):
+        """
+        Record a warm-up, from which the hits and misses are counted again.
+        """
+        with self.lock:
+            self.db.execute("INSERT INTO warmups VALUES (?, ?, ?, ?)", (started, duration, queries, errors))
+            self.db.execute("DELETE FROM lookups")
+            self.db.commit()
+
+    def status(self, now=None):
+        """
+        Summary of the cache: results, the last warm-up, and the hits and misses of
+        every method since then.
+
+        Returns:
+            dict: 'results' and 'expired' results, 'warmup' (started, duration, queries,
+                errors, or None) and 'lookups', a list of (template, hits, misses).
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            results, expired = self.db.execute("SELECT COUNT(*), SUM(created <= ?) FROM results",
+                                               (now - self.ttl,)).fetchone()
+            warmup = self.db.execute("SELECT * FROM warmups ORDER BY started DESC LIMIT 1").fetchone()
+            lookups = self.db.execute("SELECT template, hits, misses FROM lookups "
+                                      "ORDER BY hits + misses DESC").fetchall()
+        return {'results': results, 'expired': expired or 0, 'warmup': dict(warmup) if warmup else None,
+                'lookups': [tuple(lookup) for lookup in lookups]}
@@ -0,0 +1,282 @@
+"""
+search_index.py
+
+Inverted full-text index over the restaurant names and descriptions of data/ttl/restaurant
+and the menu sections, item names and item descriptions of data/ttl/offer.
+
+Text is folded to lowercase ASCII (accents, ligatures and case removed), so that
+"Pâtes à l'œuf" matches "pates a l'oeuf". A query matches restaurants containing every
+query word, either exactly, as a prefix (the last word, while typing) or within one
+typo, and returns them ranked with their matching menu items.
+"""
+
+import os
+import re
+import math
+import json
+import time
+import bisect
+import unicodedata
+from rdflib import Graph, Namespace
+from rdflib.namespace import RDF
+from instrumentation import timed, span, count
+
+SCHEMA = Namespace("http://schema.org/")
+
+# Weight of a word depending on where it appears
+FIELD_WEIGHTS = {'name': 3.0, 'item': 2.0, 'section': 1.0, 'description': 1.0, 'item_description': 0.5}
+
+STOPWORDS = {
+    # French
+    "le", "la", "les", "de", "des", "du", "un", "une", "et", "en", "au", "aux", "a", "l", "d", "avec",
+    "pour", "sur", "par", "ou", "est", "vos", "nos", "votre", "notre",
+    # Italian
+    "il", "lo", "gli", "di", "da", "con", "per", "e", "al", "alla", "della", "del",
+    # English
+    "the", "and", "of", "with", "in", "to", "for", "on", "or",
+}
+
+LIGATURES = {"œ": "oe", "æ": "ae", "ß": "ss", "ø": "o", "đ": "d", "ł": "l"}
+
+
+def fold(text):
+    """
+    Fold a text to lowercase ASCII, e.g. "Crème brûlée" -> "creme brulee".
+    """
+    text = str(text).casefold()
+    text = "".join(LIGATURES.get(c, c) for c in text)
+    return unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('ascii')
+
+
+def tokenize(text):
+    """
+    Split a text into folded words, without stopwords.
+    """
+    return [word for word in re.findall(r'[a-z0-9]+', fold(text)) if word not in STOPWORDS]
+
+
+def deletes(word):
+    """
+    Every word obtained by deleting one character, used to find words within one typo.
+    """
+    return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+
+def within_one_edit(a, b):
+    """
+    Tell whether two words differ by at most one insertion, deletion, substitution or
+    transposition of adjacent characters.
+    """
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) == len(b):
+        diff = [i for i in range(len(a)) if a[i] != b[i]]
+        return len(diff) == 1 or (len(diff) == 2 and diff[1] == diff[0] + 1
+                                  and a[diff[0]] == b[diff[1]] and a[diff[1]] == b[diff[0]])
+    shorter, longer = (a, b) if len(a) < len(b) else (b, a)
+    return any(longer[:i] + longer[i + 1:] == shorter for i in range(len(longer)))
+
+
+class SearchIndex:
+    """
+    Inverted index of restaurants and menu items.
+
+    Attributes:
+        restaurants (list): Indexed restaurants as [IRI, name].
+        items (list): Indexed menu items as [restaurant number, item name, price].
+        postings (dict): Word -> {restaurant number: weight}.
+        item_postings (dict): Word -> list of item numbers.
+    """
+
+    def __init__(self, restaurants=None, items=None, postings=None, item_postings=None):
+        self.restaurants = restaurants or []
+        self.items = items or []
+        self.postings = postings or {}
+        self.item_postings = item_postings or {}
+        self._prepare()
+
+    def _prepare(self):
+        # Sorted vocabulary for prefix lookups and one-delete neighbourhoods for typos
+        self.vocabulary = sorted(self.postings)
+        self.typo_index = {}
+        for word in self.vocabulary:
+            if len(word) >= 4:
+                for variant in deletes(word) | {word}:
+                    self.typo_index.setdefault(variant, []).append(word)
+
+    def add_restaurant(self, iri, name):
+        self.restaurants.append([iri, name])
+        return len(self.restaurants) - 1
+
+    def add_text(self, restaurant, text, field, item=None):
+        """
+        Index a text of a restaurant, and of one of its menu items if given.
+        """
+        weight = FIELD_WEIGHTS[field]
+        for word in tokenize(text):
+            postings = self.postings.setdefault(word, {})
+            postings[restaurant] = postings.get(restaurant, 0.0) + weight
+            if item is not None:
+                item_postings = self.item_postings.setdefault(word, [])
+                if not item_postings or item_postings[-1] != item:
+                    item_postings.append(item)
+
+    def expand(self, word, prefix=False, fuzzy=True):
+        """
+        List the indexed words matching a query word: the word itself, the words it
+        prefixes when prefix is set, and words within one typo when it has no exact match.
+        """
+        matches = {word} if word in self.postings else set()
+        if prefix:
+            start = bisect.bisect_left(self.vocabulary, word)
+            while start < len(self.vocabulary) and self.vocabulary[start].startswith(word):
+                matches.add(self.vocabulary[start])
+                start += 1
+        if not matches and fuzzy and len(word) >= 4:
+            for variant in deletes(word) | {word}:
+                for candidate in self.typo_index.get(variant, []):
+                    if within_one_edit(word, candidate):
+                        matches.add(candidate)
+        return matches
+
+    @timed("search_index.search")
+    def search(self, text, limit=20, prefix=True, fuzzy=True):
+        """
+        Search restaurants containing every word of a text.
+
+        Args:
+            text (str): The query, e.g. "falafel" or "pizza marg".
+            limit (int): Maximum number of restaurants returned.
+            prefix (bool): Match the last word as a prefix.
+            fuzzy (bool): Match words with one typo when they have no exact match.
+
+        Returns:
+            list: Ranked dicts with the restaurant IRI, name, score and matching items.
+        """
+        words = tokenize(text)
+        if not words:
+            return []
+
+        scores = None
+        matching_items = None
+        for position, word in enumerate(words):
+            expansions = self.expand(word, prefix and position == len(words) - 1, fuzzy)
+            word_scores = {}
+            word_items = set()
+            for expansion in expansions:
+                postings = self.postings[expansion]
+                idf = math.log(1 + len(self.restaurants) / len(postings))
+                for restaurant, weight in postings.items():
+                    # Repeated words count, with diminishing returns for long menus
+                    word_scores[restaurant] = max(word_scores.get(restaurant, 0.0), idf * math.log1p(weight))
+                word_items.update(self.item_postings.get(expansion, []))
+
+            # Every word must match
+            if scores is None:
+                scores = word_scores
+            else:
+                scores = {restaurant: score + word_scores[restaurant]
+                          for restaurant, score in scores.items() if restaurant in word_scores}
+            matching_items = word_items if matching_items is None else matching_items & word_items
+
+        ranked = sorted(scores.items(), key=lambda entry: (-entry[1], self.restaurants[entry[0]][1]))[:limit]
+        items_by_restaurant = {}
+        for item in sorted(matching_items):
+            restaurant, name, price = self.items[item]
+            items_by_restaurant.setdefault(restaurant, []).append({'name': name, 'price': price})
+
+        count("search_index.queries")
+        return [{
+            'restaurant': self.restaurants[restaurant][0],
+            'name': self.restaurants[restaurant][1],
+            'score': round(score, 3),
+            'items': items_by_restaurant.get(restaurant, [])
+        } for restaurant, score in ranked]
+
+    def save(self, output_file):
+        os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump({'restaurants': self.restaurants, 'items': self.items,
+                       'postings': self.postings, 'item_postings': self.item_postings}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, input_file):
+        with open(input_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        # JSON object keys are strings, restaurant numbers are integers
+        postings = {word: {int(restaurant): weight for restaurant, weight in entries.items()}
+                    for word, entries in data['postings'].items()}
+        return cls(data['restaurants'], data['items'], postings, data['item_postings'])
+
+
+@timed("build_search_index")
+def build_search_index(ttl_folder='data/ttl'):
+    """
+    Build the search index from the restaurant and offer Turtle files.
+
+    Returns:
+        SearchIndex: The index of every restaurant and menu item.
+    """
+    index = SearchIndex()
+    numbers = {}
+
+    def restaurant_number(iri, name=None):
+        if iri not in numbers:
+            numbers[iri] = index.add_restaurant(iri, name or iri)
+        elif name:
+            index.restaurants[numbers[iri]][1] = name
+        return numbers[iri]
+
+    for kind in ['restaurant', 'offer']:
+        for root, dirs, files in os.walk(os.path.join(ttl_folder, kind)):
+            dirs.sort()
+            for file in sorted(files):
+                if not file.endswith('.ttl'):
+                    continue
+                g = Graph()
+                with span("graph.parse"):
+                    g.parse(os.path.join(root, file), format='turtle')
+
+                for restaurant in g.subjects(RDF.type, SCHEMA.Restaurant):
+                    name = g.value(restaurant, SCHEMA.name)
+                    number = restaurant_number(str(restaurant), str(name) if name else None)
+                    index.add_text(number, name or "", 'name')
+                    for description in g.objects(restaurant, SCHEMA.description):
+                        index.add_text(number, description, 'description')
+
+                for restaurant, menu in g.subject_objects(SCHEMA.hasMenu):
+                    number = restaurant_number(str(restaurant))
+                    for section in g.objects(menu, SCHEMA.hasMenuSection):
+                        index.add_text(number, g.value(section, SCHEMA.name) or "", 'section')
+                        for menu_item in g.objects(section, SCHEMA.hasMenuItem):
+                            item_name = str(g.value(menu_item, SCHEMA.name) or "")
+                            price = g.value(g.value(menu_item, SCHEMA.offers), SCHEMA.price)
+                            index.items.append([number, item_name, str(price) if price is not None else None])
+                            item = len(index.items) - 1
+                            index.add_text(number, item_name, 'item', item)
+                            for description in g.objects(menu_item, SCHEMA.description):
+                                index.add_text(number, description, 'item_description', item)
+
+    index._prepare()
+    count("search_index.words", len(index.postings))
+    return index
+
+
+def search_restaurants(text, index_file='data/index/search.json', ttl_folder='data/ttl', limit=20):
+    """
+    Search restaurants and menu items, building the index first if it does not exist.
+
+    Returns:
+        tuple: The ranked results and the search time in milliseconds.
+    """
+    if os.path.exists(index_file):
+        index = SearchIndex.load(index_file)
+    else:
+        index = build_search_index(ttl_folder)
+        index.save(index_file)
+
+    start = time.perf_counter()
+    results = index.search(text, limit)
+    return results, (time.perf_counter() - start) * 1000
@@ -0,0 +1,351 @@
+"""
+service_shards.py
+
+Sharded storage of the data by delivery cooperative (service).
+
+The crawl is partitioned by service: data/ttl/restaurant/{i}-{service}/ and
+data/ttl/offer/{i}-{service}/ hold the restaurants and menus of
+https://{service}.coopcycle.org. In sharded mode each service gets its own named
+graph, urn:coopcycle:service:{service}, and a shard catalog records the
+localities and the bounding box of the restaurants of every shard.
+
+Queries scoped by locality or by a geographical box are then sent only to the
+shards that can match, with the shard graph as the default graph of the query;
+global queries are fanned out to every shard in parallel and their rows merged,
+applying the ORDER BY, DISTINCT and LIMIT of the query again on the merged rows.
+The graphs that are not sharded, the user profiles and the summaries, are queried
+once on the whole dataset.
+"""
+
+import os
+import re
+import json
+from concurrent.futures import ThreadPoolExecutor
+from rdflib import Graph, Namespace
+from rdflib.plugins.sparql import prepareQuery
+from SPARQLWrapper import SPARQLWrapper, JSON
+from instrumentation import timed, span, count
+from sparql_queries import SPARQLQueries, LocalSPARQLQueries
+from query_log import observed_query, note_query
+from interned_store import InternedStore
+from search_index import fold
+
+SCHEMA = Namespace("http://schema.org/")
+
+SHARD_GRAPH_BASE = "urn:coopcycle:service:"
+
+NUMERIC_DATATYPES = {"http://www.w3.org/2001/XMLSchema#" + name
+                     for name in ["decimal", "double", "float", "integer", "int", "long"]}
+
+
+def shard_graph_uri(service):
+    """
+    URI of the named graph of a service, e.g. "urn:coopcycle:service:a2roo".
+    """
+    return SHARD_GRAPH_BASE + service
+
+
+def service_files(ttl_folder='data/ttl'):
+    """
+    List the Turtle files of each service: its service file, restaurants and offers.
+
+    Returns:
+        dict: Service name -> list of file paths.
+    """
+    files = {}
+    for kind in ['restaurant', 'offer']:
+        kind_folder = os.path.join(ttl_folder, kind)
+        for folder in sorted(os.listdir(kind_folder)) if os.path.isdir(kind_folder) else []:
+            service = folder.split('-', 1)[-1]
+            for file in sorted(os.listdir(os.path.join(kind_folder, folder))):
+                if file.endswith('.ttl'):
+                    files.setdefault(service, []).append(os.path.join(kind_folder, folder, file))
+
+    # The folder numbers of data/ttl/service differ from the other ones, match by name
+    service_folder = os.path.join(ttl_folder, 'service')
+    for file in sorted(os.listdir(service_folder)) if os.path.isdir(service_folder) else []:
+        service = file[:-len('.ttl')].split('-', 1)[-1]
+        if file.endswith('.ttl'):
+            files.setdefault(service, []).insert(0, os.path.join(service_folder, file))
+    return files
+
+
+def load_shard_graph(files, store='default'):
+    g = Graph(store=store)
+    for file in files:
+        with span("graph.parse"):
+            g.parse(file, format='turtle')
+    if isinstance(g.store, InternedStore):
+        g.store.compact()
+    return g
+
+
+class ShardCatalog:
+    """
+    Catalog of the service shards.
+
+    Attributes:
+        shards (dict): Service name -> {'graph', 'files', 'triples', 'restaurants',
+            'localities', 'bbox'}, the bbox being [min latitude, max latitude,
+            min longitude, max longitude] of its restaurants and service area, or None.
+    """
+
+    def __init__(self, shards=None):
+        self.shards = shards or {}
+
+    def add_shard(self, service, files, graph):
+        coordinates = [(float(graph.value(geo, SCHEMA.latitude)), float(graph.value(geo, SCHEMA.longitude)))
+                       for geo in graph.subjects(SCHEMA.latitude, None)
+                       if graph.value(geo, SCHEMA.longitude) is not None]
+        latitudes = [latitude for latitude, _ in coordinates]
+        longitudes = [longitude for _, longitude in coordinates]
+        self.shards[service] = {
+            'graph': shard_graph_uri(service),
+            'files': files,
+            'triples': len(graph),
+            'restaurants': len(set(graph.subjects(None, SCHEMA.Restaurant))),
+            'localities': sorted({fold(locality) for locality in graph.objects(None, SCHEMA.addressLocality)}),
+            'bbox': [min(latitudes), max(latitudes), min(longitudes), max(longitudes)] if coordinates else None,
+        }
+
+    def services_for_locality(self, locality):
+        """
+        Services whose restaurants or service area are in a locality, e.g. "Dijon".
+        """
+        locality = fold(locality)
+        return [service for service, shard in self.shards.items() if locality in shard['localities']]
+
+    def services_in_box(self, min_lat, max_lat, min_long, max_long):
+        """
+        Services whose bounding box intersects a geographical box.
+        """
+        return [service for service, shard in self.shards.items()
+                if shard['bbox'] and shard['bbox'][0] <= max_lat and shard['bbox'][1] >= min_lat
+                and shard['bbox'][2] <= max_long and shard['bbox'][3] >= min_long]
+
+    def save(self, output_file):
+        os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump(self.shards, f, ensure_ascii=False, indent=1)
+
+    @classmethod
+    def load(cls, input_file):
+        with open(input_file, 'r', encoding='utf-8') as f:
+            return cls(json.load(f))
+
+
+@timed("build_shards")
+def build_shards(ttl_folder='data/ttl', handler=None, store='default'):
+    """
+    Build the shard catalog of the Turtle files and, if a handler is given, replace
+    the named graph of every shard on the server.
+
+    Args:
+        ttl_folder (str): Folder of Turtle files, e.g. data/ttl.
+        handler (RDFHandler): Handler of the Fuseki server, or None to only build the catalog.
+        store (str): rdflib store of the shard graphs.
+
+    Returns:
+        tuple: The ShardCatalog, and the shard graphs by service.
+    """
+    catalog = ShardCatalog()
+    graphs = {}
+    for service, files in service_files(ttl_folder).items():
+        graphs[service] = load_shard_graph(files, store)
+        catalog.add_shard(service, files, graphs[service])
+        if handler:
+            handler.replace_graph_on_server(handler.serialize_rdf(graphs[service]), shard_graph_uri(service))
+        count("shards.built")
+    return catalog, graphs
+
+
+def merge_bindings(query, results):
+    """
+    Merge the rows returned by several shards for the same query, applying its
+    DISTINCT, ORDER BY and LIMIT to the merged rows.
+
+    Args:
+        query (str): The SPARQL query.
+        results (list): One list of bindings per shard.
+
+    Returns:
+        list: The merged bindings.
+    """
+    rows = [row for bindings in results for row in bindings]
+    if re.search(r'SELECT\s+DISTINCT', query, re.IGNORECASE):
+        seen = set()
+        unique = []
+        for row in rows:
+            key = tuple(sorted((variable, value['value']) for variable, value in row.items()))
+            if key not in seen:
+                seen.add(key)
+                unique.append(row)
+        rows = unique
+
+    order = re.search(r'ORDER\s+BY\s+((?:\?\w+\s*)+)', query, re.IGNORECASE)
+    if order:
+        variables = re.findall(r'\?(\w+)', order.group(1))
+
+        def sort_key(row):
+            key = []
+            for variable in variables:
+                value = row.get(variable)
+                if value is None:
+                    key.append((0, 0, ""))
+                elif value.get('datatype') in NUMERIC_DATATYPES:
+                    key.append((1, float(value['value']), ""))
+                else:
+                    key.append((2, 0, value['value']))
+            return key
+        rows.sort(key=sort_key)
+
+    limit = re.search(r'LIMIT\s+(\d+)\s*$', query.strip(), re.IGNORECASE)
+    if limit:
+        rows = rows[:int(limit.group(1))]
+    return rows
+
+
+class ShardedSPARQLQueries(SPARQLQueries):
+    """
+    SPARQLQueries sent to the service shards selected for each query, in parallel.
+
+    Queries are scoped to the shards of a locality if one is given, the area query to
+    the shards whose bounding box intersects the area, and the other queries are fanned
+    out to every shard. The shards are the named graphs of the server, or in-process
+    graphs (loaded from the Turtle folder source) when shard_graphs is given, queried
+    one after the other.
+    """
+
+    def __init__(self, sparql_endpoint, catalog, locality=None, shard_graphs=None, max_workers=8, source=None):
+        super().__init__(sparql_endpoint)
+        self.source = source
+        self.catalog = catalog
+        self.locality = locality
+        self.shard_graphs = shard_graphs
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def default_services(self):
+        if self.locality:
+            return self.catalog.services_for_locality(self.locality)
+        return list(self.catalog.shards)
+
+    @timed("sparql.execute_sharded_query")
+    def execute_query(self, query, services=None):
+        """
+        Execute a query on the given shards (the default ones if omitted) and merge the
+        results. The errors of the shards are noted for the observed call, from this
+        thread, so that a partial result is logged as failed and not cached.
+
+        Args:
+            query (str): The SPARQL query.
+            services (list): Services whose shard is queried.
+        """
+        services = self.default_services() if services is None else services
+        count("sparql.shards_queried", len(services))
+        note_query(query)
+        if self.shard_graphs is not None:
+            # Neither the rdflib SPARQL parser nor the evaluation of a parsed query (which
+            # stores the current bindings on its expressions) is thread safe: in-process
+            # shards share one parsed query and are evaluated one after the other
+            try:
+                shard_query = prepareQuery(query)
+            except Exception as e:
+                count("sparql.errors")
+                note_query(query, error=str(e))
+                print(f"An error occurred: {e}")
+                return []
+            results = [self.execute_shard_query(shard_query, service) for service in services]
+        else:
+            results = list(self.executor.map(lambda service: self.execute_shard_query(query, service), services))
+        errors = [error for _, error in results if error]
+        if errors:
+            note_query(query, error="; ".join(errors))
+        return merge_bindings(query, [bindings for bindings, _ in results])
+
+    def execute_unsharded_query(self, query):
+        """
+        Execute a query on the whole dataset of the server instead of the shards, for
+        the graphs that are not sharded: the user profiles (in the default graph or in
+        the graph of each user) and the summaries. In-process shards are the whole
+        dataset, the query is then run on every shard.
+        """
+        if self.shard_graphs is not None:
+            return self.execute_query(query)
+        return super().execute_query(query)
+
+    def execute_shard_query(self, query, service):
+        """
+        Execute a query with the shard graph of a service as its default graph. It may
+        run in a worker thread, its error is returned rather than noted.
+
+        Returns:
+            tuple: The bindings, and the error of the shard or None.
+        """
+        try:
+            with span("sparql.shard_query", service=service):
+                if self.shard_graphs is not None:
+                    bindings = [{str(variable): LocalSPARQLQueries.to_json_binding(term)
+                                 for variable, term in row.asdict().items()}
+                                for row in self.shard_graphs[service].query(query)]
+                else:
+                    sparql = SPARQLWrapper(self.sparql_endpoint)
+                    sparql.setQuery(query)
+                    sparql.setReturnFormat(JSON)
+                    sparql.addDefaultGraph(shard_graph_uri(service))
+                    bindings = sparql.query().convert()["results"]["bindings"]
+            count("sparql.rows", len(bindings))
+            return bindings, None
+        except Exception as e:
+            count("sparql.errors")
+            print(f"An error occurred on shard {service}: {e}")
+            return [], f"shard {service}: {e}"
+
+    def covered_services(self, restaurants):
+        """
+        Services of the shards holding the given restaurants, from the coverage index.
+        """
+        services = {self.coverage_index.restaurant_services[restaurant] for restaurant in restaurants}
+        return [service for service in self.default_services() if service in services]
+
+    @observed_query
+    def get_restaurants_in_area(self, central_lat, central_long, lat_range, long_range):
+        """
+        Fetches restaurants within a specific geographical area, from the shards of that
+        area only: those of the restaurants in the area with a coverage index, else those
+        whose bounding box intersects it.
+        """
+        if self.coverage_index is not None:
+            services = self.covered_services(self.coverage_index.restaurants_in_box(
+                central_lat - lat_range, central_lat + lat_range, central_long - long_range, central_long + long_range))
+        else:
+            services = self.catalog.services_in_box(central_lat - lat_range, central_lat + lat_range,
+                                                    central_long - long_range, central_long + long_range)
+        results = self.execute_query(self.build_restaurants_in_area_query(central_lat, central_long, lat_range, long_range),
+                                     services)
+        return self.format_geographical_data(results)
+
+    @observed_query
+    def get_restaurant_summaries(self, summary_graph="urn:coopcycle:summaries"):
+        """
+        Fetches the precomputed restaurant summaries, from the summary graph of the
+        whole dataset as it is not sharded.
+        """
+        results = self.execute_unsharded_query(self.build_restaurant_summaries_query(summary_graph))
+        return self.format_restaurant_summary_data(results)
+
+    @observed_query
+    def query_restaurants_based_on_combined_preferences(self, user_prefs_uri, user_graph=None):
+        """
+        Fetches restaurants based on combined user preferences. The location and
+        maximum price of the user are queried once from the whole dataset, then bound
+        in the query of every shard. With a coverage index, only the shards of the
+        services delivering to the user are queried.
+        """
+        user_rows = self.execute_unsharded_query(self.build_user_location_query(user_prefs_uri, user_graph))
+        if not user_rows:
+            return []
+        restaurants = self.covered_restaurants(user_prefs_uri, user_graph, locations=self.user_locations(user_rows))
+        services = self.covered_services(restaurants) if restaurants is not None else None
+        results = self.execute_query(self.build_combined_preferences_query(user_prefs_uri, user_graph, restaurants,
+                                                                           user_rows), services)
+        return self.format_combined_preferences_data(results)
@@ -1,6 +1,20 @@
+import csv
+import json
+import uuid
 import requests
 from rdflib import Graph, Literal, URIRef
 from rdflib.namespace import RDF, Namespace
+from jsonld_to_rdf_converter import slugify
+from instrumentation import timed, count
+from literal_normalization import normalize_graph, decimal_literal, double_literal
+
+SCHEMA = Namespace("http://schema.org/")
+
+# Base of the IRIs minted for the users ingested in bulk
+USER_BASE = "https://coopcycle.org/users/"
+
+# Columns of the CSV files, and keys of the JSON-lines records
+USER_FIELDS = ['id', 'name', 'postal_code', 'locality', 'max_price', 'currency', 'latitude', 'longitude', 'radius']
 
 
 def publish_to_fuseki(graph, fuseki_endpoint):
@@ -59,6 +73,9 @@ def set_user_preferences():
     graph.add((geo_midpoint, SCHEMA.latitude, Literal(latitude, datatype=SCHEMA.Float)))
     graph.add((seeks, SCHEMA.availableAtOrFrom, geo_midpoint))
 
+    # Typed price and coordinates, as in the converted restaurant data
+    normalize_graph(graph)
+
     # Print out the RDF graph in Turtle format
     print(graph.serialize(format="turtle"))
 
@@ -69,13 +86,186 @@ def set_user_preferences():
     # Publish to a Linked Data Platform
     fuseki_endpoint = "http://localhost:3030/webproject/data"  
     publish_to_fuseki(graph, fuseki_endpoint)
-    
 
-    
-    
-    
-    
-    
 
+"""
+FUNCTIONS TO INGEST USER PROFILES IN BULK
+"""
+def user_iri(user_id):
+    """
+    IRI of a user, e.g. "https://coopcycle.org/users/alice#me".
+    """
+    return URIRef(f"{USER_BASE}{slugify(str(user_id))}#me")
+
+
+def user_graph_uri(user_id):
+    """
+    URI of the named graph holding the profile of a user, e.g. "urn:coopcycle:user:alice".
+    """
+    return f"urn:coopcycle:user:{slugify(str(user_id))}"
+
+
+def read_user_profiles(file_path):
+    """
+    Read user profiles from a CSV file (with a header row) or a JSON-lines file.
+
+    Yields:
+        tuple: The line number, the profile as a dict (None if the line is not a JSON
+            object) and the error reading the line, or None.
+    """
+    with open(file_path, 'r', encoding='utf-8', newline='') as f:
+        if file_path.endswith('.csv'):
+            # Line 1 is the header
+            for line, row in enumerate(csv.DictReader(f), start=2):
+                yield line, row, None
+        else:
+            for line, text in enumerate(f, start=1):
+                if not text.strip():
+                    continue
+                try:
+                    record = json.loads(text)
+                except ValueError as e:
+                    yield line, None, f"invalid JSON: {e}"
+                    continue
+                if isinstance(record, dict):
+                    yield line, record, None
+                else:
+                    yield line, None, f"not a JSON object: {type(record).__name__}"
+
+
+def validate_user_profile(profile):
+    """
+    Check and normalize a user profile.
+
+    A profile without an id gets one derived from its name, postal code and
+    coordinates, so that ingesting the same file twice updates the same users.
+
+    Returns:
+        tuple: The normalized profile, and the list of errors (empty if it is valid).
+    """
+    errors = []
+    values = {field: profile.get(field) for field in USER_FIELDS}
+    values = {field: value.strip() if isinstance(value, str) else value for field, value in values.items()}
+
+    if not values['name']:
+        errors.append("missing name")
+
+    def number(field, low, high, required=True):
+        value = values[field]
+        if value in (None, ""):
+            if required:
+                errors.append(f"missing {field}")
+            return None
+        try:
+            value = float(str(value).replace(',', '.'))
+        except ValueError:
+            errors.append(f"{field} is not a number: {value!r}")
+            return None
+        if not low <= value <= high:
+            errors.append(f"{field} out of range: {value}")
+        return value
+
+    values['latitude'] = number('latitude', -90, 90)
+    values['longitude'] = number('longitude', -180, 180)
+    values['max_price'] = number('max_price', 0, 10000)
+    values['radius'] = number('radius', 0, 1000000, required=False)
+    if values['radius'] is None:
+        values['radius'] = 2000
+    values['currency'] = (values['currency'] or "EUR").upper()
+    if len(values['currency']) != 3:
+        errors.append(f"invalid currency: {values['currency']}")
+
+    if not values['id']:
+        key = f"{values['name']}|{values['postal_code']}|{values['latitude']}|{values['longitude']}"
+        values['id'] = str(uuid.uuid5(uuid.NAMESPACE_URL, USER_BASE + key))
+    elif not slugify(str(values['id'])):
+        errors.append(f"invalid id: {values['id']!r}")
+    return values, errors
+
+
+def user_profile_graph(profile):
+    """
+    Build the RDF graph of a validated user profile, with the same shape as
+    pref-charpenay.ttl. Every node gets an IRI under the user IRI, so that the
+    profiles of different users never share a node.
+    """
+    graph = Graph()
+    graph.bind('ns1', SCHEMA)
+    user = user_iri(profile['id'])
+    base = str(user).split('#')[0]
+    address, seeks = URIRef(f"{base}#address"), URIRef(f"{base}#seeks")
+    price, area, midpoint = URIRef(f"{base}#price"), URIRef(f"{base}#area"), URIRef(f"{base}#geoMidpoint")
+
+    graph.add((user, RDF.type, SCHEMA.Person))
+    graph.add((user, SCHEMA.name, Literal(profile['name'])))
+    if profile['postal_code'] or profile['locality']:
+        graph.add((user, SCHEMA.address, address))
+        graph.add((address, RDF.type, SCHEMA.PostalAddress))
+        if profile['postal_code']:
+            graph.add((address, SCHEMA.postalCode, Literal(str(profile['postal_code']))))
+        if profile['locality']:
+            graph.add((address, SCHEMA.addressLocality, Literal(profile['locality'])))
+
+    graph.add((user, SCHEMA.seeks, seeks))
+    graph.add((seeks, RDF.type, SCHEMA.Demand))
+    graph.add((seeks, SCHEMA.priceSpecification, price))
+    graph.add((price, SCHEMA.maxPrice, decimal_literal(profile['max_price'])))
+    graph.add((price, SCHEMA.priceCurrency, Literal(profile['currency'])))
+    graph.add((seeks, SCHEMA.availableAtOrFrom, area))
+    graph.add((area, SCHEMA.geoWithin, URIRef(f"{base}#geoCircle")))
+    graph.add((URIRef(f"{base}#geoCircle"), RDF.type, SCHEMA.GeoCircle))
+    graph.add((URIRef(f"{base}#geoCircle"), SCHEMA.geoMidpoint, midpoint))
+    graph.add((URIRef(f"{base}#geoCircle"), SCHEMA.geoRadius, double_literal(profile['radius'])))
+    graph.add((midpoint, SCHEMA.latitude, double_literal(profile['latitude'])))
+    graph.add((midpoint, SCHEMA.longitude, double_literal(profile['longitude'])))
+    return graph
+
+
+@timed("ingest_user_profiles")
+def ingest_user_profiles(handler, file_path, batch_size=5000, dry_run=False):
+    """
+    Ingest user profiles in bulk: each valid profile replaces the named graph of its
+    user, and the updates are sent in batched requests.
+
+    Args:
+        handler (RDFHandler): Handler of the Fuseki server.
+        file_path (str): CSV or JSON-lines file of profiles, with the columns of USER_FIELDS.
+        batch_size (int): Maximum number of triples per update request.
+        dry_run (bool): Only validate the profiles.
+
+    Returns:
+        dict: Number of users and triples ingested, invalid profiles and failed batches.
+    """
+    summary = {'users': 0, 'triples': 0, 'invalid': [], 'errors': []}
+    seen = {}
+    batcher = handler.update_batcher(max_triples=batch_size) if not dry_run else None
+    try:
+        for line, record, error in read_user_profiles(file_path):
+            if error:
+                summary['invalid'].append({'line': line, 'id': None, 'errors': [error]})
+                continue
+            profile, errors = validate_user_profile(record)
+            # Ids are compared as they appear in the IRIs, e.g. "Alice" and "alice" collide
+            key = slugify(str(profile['id']))
+            if key in seen:
+                errors.append(f"duplicate id {profile['id']!r} (line {seen[key]})")
+            if errors:
+                summary['invalid'].append({'line': line, 'id': profile['id'], 'errors': errors})
+                continue
+            seen[key] = line
 
+            graph = user_profile_graph(profile)
+            if batcher:
+                graph_uri = user_graph_uri(profile['id'])
+                batcher.replace(graph, graph_uri)
+            summary['users'] += 1
+            summary['triples'] += len(graph)
+    finally:
+        if batcher:
+            batcher.close()
 
+    if batcher:
+        summary['errors'] = [result.error for result in batcher.results if not result.ok]
+    count("users.ingested", summary['users'])
+    count("users.invalid", len(summary['invalid']))
+    return summary
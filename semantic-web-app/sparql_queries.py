@@ -1,26 +1,64 @@
+import json
 from SPARQLWrapper import SPARQLWrapper, JSON
+from rdflib import URIRef, BNode, Literal, Variable
+from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.sparql.parserutils import CompValue
+from instrumentation import timed, count
+from literal_normalization import time_literal
+from query_log import observed_query, note_query
+from restaurant_summary import WEEK
 
 class SPARQLQueries:
     def __init__(self, sparql_endpoint):
-        self.sparql = SPARQLWrapper(sparql_endpoint)
+        self.sparql_endpoint = sparql_endpoint
+        # Turtle folder of the queried data when it is not the endpoint, keying the result cache
+        self.source = None
+        # CoverageIndex pre-filtering the area and combined-preferences queries (see coverage_index.py)
+        self.coverage_index = None
 
+    @timed("sparql.execute_query")
     def execute_query(self, query):
         """
         Execute a given SPARQL query and return the results.
         """
-        self.sparql.setQuery(query)
-        self.sparql.setReturnFormat(JSON)
+        # A wrapper per query, so that queries can run from several threads
+        sparql = SPARQLWrapper(self.sparql_endpoint)
+        sparql.setQuery(query)
+        sparql.setReturnFormat(JSON)
         try:
-            results = self.sparql.query().convert()
+            # The body is decoded as convert() does, its size is logged
+            body = sparql.query().response.read()
+            note_query(query, len(body))
+            results = json.loads(body.decode('utf-8'))
+            count("sparql.rows", len(results["results"]["bindings"]))
             return results["results"]["bindings"]
         except Exception as e:
+            count("sparql.errors")
+            note_query(query, error=str(e))
             print(f"An error occurred: {e}")
             return []
 
+    def build_query(self, method, *args):
+        """
+        Builds the SPARQL query of one of the get_* methods, e.g.
+        build_query('get_restaurants_by_price_range', 10.0).
+        """
+        # get_restaurant_data -> build_restaurant_data_query
+        base = method[4:] if method.startswith('get_') else 'combined_preferences'
+        return getattr(self, f"build_{base}_query")(*args)
+
+    @observed_query
     def get_restaurant_data(self):
         """
         Fetches restaurant data including name, images, address, description, and telephone.
         """
+        results = self.execute_query(self.build_restaurant_data_query())
+        return self.format_restaurant_data(results)
+
+    def build_restaurant_data_query(self):
+        """
+        Builds the SPARQL query of get_restaurant_data.
+        """
         query = """
         PREFIX ns1: <http://schema.org/>
 
@@ -41,10 +79,86 @@ class SPARQLQueries:
         ORDER BY ?restaurantName
         LIMIT 500
         """
-        results = self.execute_query(query)
-        return self.format_restaurant_data(results)
+        return query
+
+
+    @observed_query
+    def get_restaurant_summaries(self, summary_graph="urn:coopcycle:summaries"):
+        """
+        Fetches the precomputed restaurant summaries (see restaurant_summary.py), one row
+        per restaurant, without joining images and addresses at query time.
+
+        Args:
+            summary_graph (str): The URI of the summary named graph.
+
+        Returns:
+            list: Formatted summary of every restaurant.
+        """
+        results = self.execute_query(self.build_restaurant_summaries_query(summary_graph))
+        return self.format_restaurant_summary_data(results)
+
+    def build_restaurant_summaries_query(self, summary_graph="urn:coopcycle:summaries"):
+        """
+        Builds the SPARQL query of get_restaurant_summaries.
+        """
+        query = f"""
+        PREFIX ns1: <http://schema.org/>
+        PREFIX sum: <https://coopcycle.org/summary#>
+
+        SELECT ?restaurant ?restaurantName ?description ?image ?address ?telephone
+               ?latitude ?longitude ?service ?serviceName ?minPrice ?maxPrice
+               (GROUP_CONCAT(?openInterval; separator=", ") AS ?openIntervals)
+        WHERE {{
+            GRAPH <{summary_graph}> {{
+                ?restaurant a sum:RestaurantSummary ;
+                            ns1:name ?restaurantName ;
+                            ns1:provider ?service .
+                OPTIONAL {{ ?restaurant ns1:description ?description }}
+                OPTIONAL {{ ?restaurant ns1:image ?image }}
+                OPTIONAL {{ ?restaurant ns1:streetAddress ?address }}
+                OPTIONAL {{ ?restaurant ns1:telephone ?telephone }}
+                OPTIONAL {{ ?restaurant ns1:latitude ?latitude ; ns1:longitude ?longitude }}
+                OPTIONAL {{ ?restaurant sum:serviceName ?serviceName }}
+                OPTIONAL {{ ?restaurant sum:minPrice ?minPrice ; sum:maxPrice ?maxPrice }}
+                OPTIONAL {{ ?restaurant sum:openInterval ?openInterval }}
+            }}
+        }}
+        GROUP BY ?restaurant ?restaurantName ?description ?image ?address ?telephone
+                 ?latitude ?longitude ?service ?serviceName ?minPrice ?maxPrice
+        ORDER BY ?restaurantName
+        """
+        return query
+
+    @staticmethod
+    def format_restaurant_summary_data(query_results):
+        """
+        Formats the raw results from the restaurant summaries query.
+        """
+        fields = {'restaurant': 'restaurant', 'name': 'restaurantName', 'description': 'description',
+                  'image': 'image', 'address': 'address', 'telephone': 'telephone',
+                  'latitude': 'latitude', 'longitude': 'longitude', 'service': 'service',
+                  'service_name': 'serviceName', 'min_price': 'minPrice', 'max_price': 'maxPrice',
+                  'open_intervals': 'openIntervals'}
+        summaries = [{field: result.get(variable, {}).get('value') for field, variable in fields.items()}
+                     for result in query_results]
+        for summary in summaries:
+            summary['open_intervals'] = SPARQLQueries.split_open_intervals(summary['open_intervals'])
+        return summaries
+
+    @staticmethod
+    def split_open_intervals(open_intervals):
+        """
+        Split the concatenated opening intervals of a summary, e.g. "Monday 11:30-14:00",
+        into a list in weekly order.
+        """
+        def weekly_order(interval):
+            day = interval.split(' ')[0]
+            return WEEK.index(day) if day in WEEK else len(WEEK), interval
+
+        return sorted(open_intervals.split(", "), key=weekly_order) if open_intervals else []
 
 
+    @observed_query
     def get_restaurant_data_by_name(self, restaurant_name):
         """
         Fetches data for a specific restaurant by name.
@@ -55,6 +169,13 @@ class SPARQLQueries:
         Returns:
             list: Formatted data of the specified restaurant.
         """
+        results = self.execute_query(self.build_restaurant_data_by_name_query(restaurant_name))
+        return self.format_restaurant_data(results)
+
+    def build_restaurant_data_by_name_query(self, restaurant_name):
+        """
+        Builds the SPARQL query of get_restaurant_data_by_name.
+        """
         query = """
         PREFIX ns1: <http://schema.org/>
 
@@ -77,8 +198,7 @@ class SPARQLQueries:
         LIMIT 500
         """ % restaurant_name.replace('"', '\\"')  # Safeguard against quote characters in names
 
-        results = self.execute_query(query)
-        return self.format_restaurant_data(results)
+        return query
 
 
     @staticmethod
@@ -102,6 +222,7 @@ class SPARQLQueries:
         return formatted_results
 
 
+    @observed_query
     def get_restaurants_by_day_and_time(self, day, open_time, close_time):
         """
         Fetches restaurants open on a specific day within a specified time range.
@@ -114,6 +235,13 @@ class SPARQLQueries:
         Returns:
             list: Formatted data of restaurants open at the given day and time range.
         """
+        results = self.execute_query(self.build_restaurants_by_day_and_time_query(day, open_time, close_time))
+        return self.format_open_hours_data(results)
+
+    def build_restaurants_by_day_and_time_query(self, day, open_time, close_time):
+        """
+        Builds the SPARQL query of get_restaurants_by_day_and_time.
+        """
         query = f"""
         PREFIX ns1: <http://schema.org/>
         PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
@@ -129,13 +257,49 @@ class SPARQLQueries:
                  ns1:closes ?closes.
 
             FILTER (CONTAINS(STR(?openDay), "{day}"))
-            FILTER (STR(?opens) <= "{open_time}" && STR(?closes) >= "{close_time}")
+            # The canonical xsd:time lexical forms "HH:MM:SS" sort like the times
+            FILTER (STR(?opens) <= "{time_literal(open_time)}" && STR(?closes) >= "{time_literal(close_time)}")
         }}
         ORDER BY ?restaurantName
         """
-        results = self.execute_query(query)
+        return query
+
+    @observed_query
+    def get_restaurant_opening_hours(self, restaurant_name):
+        """
+        Fetches the opening hours of a specific restaurant, identified by name.
+
+        Args:
+            restaurant_name (str): The name of the restaurant.
+
+        Returns:
+            list: Formatted opening days and hours of the restaurant.
+        """
+        results = self.execute_query(self.build_restaurant_opening_hours_query(restaurant_name))
         return self.format_open_hours_data(results)
 
+    def build_restaurant_opening_hours_query(self, restaurant_name):
+        """
+        Builds the SPARQL query of get_restaurant_opening_hours.
+        """
+        query = """
+        PREFIX ns1: <http://schema.org/>
+
+        SELECT ?restaurantName ?openDay ?opens ?closes
+        WHERE {
+            ?restaurant a ns1:Restaurant ;
+                        ns1:name ?restaurantName ;
+                        ns1:openingHoursSpecification ?ohs.
+            FILTER (STR(?restaurantName) = "%s")
+
+            ?ohs ns1:dayOfWeek ?openDay ;
+                 ns1:opens ?opens ;
+                 ns1:closes ?closes.
+        }
+        ORDER BY ?openDay ?opens
+        """ % restaurant_name.replace('"', '\\"')
+        return query
+
     @staticmethod
     def format_open_hours_data(query_results):
         """
@@ -153,6 +317,7 @@ class SPARQLQueries:
         return formatted_results
     
 
+    @observed_query
     def get_restaurants_in_area(self, central_lat, central_long, lat_range, long_range):
         """
         Fetches restaurants within a specific geographical area.
@@ -166,35 +331,43 @@ class SPARQLQueries:
         Returns:
             list: Formatted data of restaurants within the specified area.
         """
+        results = self.execute_query(self.build_restaurants_in_area_query(central_lat, central_long, lat_range, long_range))
+        return self.format_geographical_data(results)
+
+    def build_restaurants_in_area_query(self, central_lat, central_long, lat_range, long_range):
+        """
+        Builds the SPARQL query of get_restaurants_in_area, restricted to the restaurants
+        of the area in the coverage index if one is set.
+        """
+        candidates = ""
+        if self.coverage_index is not None:
+            candidates = self.restaurant_values(self.coverage_index.restaurants_in_box(
+                float(central_lat) - float(lat_range), float(central_lat) + float(lat_range),
+                float(central_long) - float(long_range), float(central_long) + float(long_range)))
         query = f"""
         PREFIX ns1: <http://schema.org/>
         PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
 
         SELECT ?restaurant ?restaurantName ?latitude ?longitude WHERE {{
+          {candidates}
           ?restaurant a ns1:Restaurant ;
                       ns1:name ?restaurantName ;
-                      ns1:address ?address.
+                      ns1:geo ?geo.
 
-          ?address ns1:geo ?geo.
-
-          ?geo ns1:latitude ?lat ;
-               ns1:longitude ?long.
-
-          # Convert latitude and longitude to decimal
-          BIND(xsd:decimal(?lat) AS ?latitude)
-          BIND(xsd:decimal(?long) AS ?longitude)
+          ?geo ns1:latitude ?latitude ;
+               ns1:longitude ?longitude.
 
+          # The coordinates are xsd:double, the bounds are computed once here
           FILTER (
-            ?latitude <= (xsd:decimal("{central_lat}") + xsd:decimal("{lat_range}")) &&
-            ?latitude >= (xsd:decimal("{central_lat}") - xsd:decimal("{lat_range}")) &&
-            ?longitude <= (xsd:decimal("{central_long}") + xsd:decimal("{long_range}")) &&
-            ?longitude >= (xsd:decimal("{central_long}") - xsd:decimal("{long_range}"))
+            ?latitude <= {float(central_lat) + float(lat_range)} &&
+            ?latitude >= {float(central_lat) - float(lat_range)} &&
+            ?longitude <= {float(central_long) + float(long_range)} &&
+            ?longitude >= {float(central_long) - float(long_range)}
           )
         }}
         LIMIT 10
         """
-        results = self.execute_query(query)
-        return self.format_geographical_data(results)
+        return query
 
     @staticmethod
     def format_geographical_data(query_results):
@@ -212,6 +385,7 @@ class SPARQLQueries:
             formatted_results.append(data)
         return formatted_results
     
+    @observed_query
     def get_restaurants_by_price_range(self, max_price):
         """
         Fetches restaurants offering menu items below a specified price.
@@ -222,6 +396,13 @@ class SPARQLQueries:
         Returns:
             list: Formatted data of restaurants with menu items within the specified price range.
         """
+        results = self.execute_query(self.build_restaurants_by_price_range_query(max_price))
+        return self.format_price_range_data(results)
+
+    def build_restaurants_by_price_range_query(self, max_price):
+        """
+        Builds the SPARQL query of get_restaurants_by_price_range.
+        """
         query = f"""
         PREFIX ns1: <http://schema.org/>
         PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
@@ -239,17 +420,48 @@ class SPARQLQueries:
             ?menuItem ns1:name ?menuItemName ;
                       ns1:offers/ns1:price ?priceLiteral.
 
-            # Extract the numeric part of the price
-            BIND(REPLACE(?priceLiteral, "€", "") AS ?priceNumeric)
-            BIND(xsd:decimal(?priceNumeric) AS ?price)
-
-            FILTER (?price <= {max_price})
+            # Prices are xsd:decimal
+            FILTER (?priceLiteral <= {float(max_price)})
         }}
-        ORDER BY ?restaurantName ?price
+        ORDER BY ?restaurantName ?priceLiteral
+        """
+        return query
+
+    @observed_query
+    def get_restaurant_menu(self, restaurant_name):
+        """
+        Fetches the menu items and prices of a specific restaurant, identified by name.
+
+        Args:
+            restaurant_name (str): The name of the restaurant.
+
+        Returns:
+            list: Formatted menu items of the restaurant.
         """
-        results = self.execute_query(query)
+        results = self.execute_query(self.build_restaurant_menu_query(restaurant_name))
         return self.format_price_range_data(results)
 
+    def build_restaurant_menu_query(self, restaurant_name):
+        """
+        Builds the SPARQL query of get_restaurant_menu.
+        """
+        query = """
+        PREFIX ns1: <http://schema.org/>
+
+        SELECT DISTINCT ?restaurantName ?menuItemName ?priceLiteral
+        WHERE {
+            ?restaurant a ns1:Restaurant ;
+                        ns1:name ?restaurantName ;
+                        ns1:hasMenu/ns1:hasMenuSection/ns1:hasMenuItem ?menuItem.
+            FILTER (STR(?restaurantName) = "%s")
+
+            ?menuItem ns1:name ?menuItemName ;
+                      ns1:offers/ns1:price ?priceLiteral.
+        }
+        ORDER BY ?menuItemName
+        """ % restaurant_name.replace('"', '\\"')
+        return query
+
     @staticmethod
     def format_price_range_data(query_results):
         """
@@ -265,8 +477,16 @@ class SPARQLQueries:
             formatted_results.append(data)
         return formatted_results
     
+    @observed_query
     def get_delivery_services(self):
         """Fetch delivery services with their location details."""
+        results = self.execute_query(self.build_delivery_services_query())
+        return self.format_delivery_service_data(results)
+
+    def build_delivery_services_query(self):
+        """
+        Builds the SPARQL query of get_delivery_services.
+        """
         query = """
         PREFIX ns1: <http://schema.org/>
 
@@ -279,8 +499,7 @@ class SPARQLQueries:
                                                 ns1:addressLocality ?addressLocality ] .
         }
         """
-        results = self.execute_query(query)
-        return self.format_delivery_service_data(results)
+        return query
     
     
     @staticmethod
@@ -300,16 +519,137 @@ class SPARQLQueries:
             })
         return formatted_results
     
-    def query_restaurants_based_on_combined_preferences(self, user_prefs_uri):
+    @observed_query
+    def query_restaurants_based_on_combined_preferences(self, user_prefs_uri, user_graph=None):
         """
         Fetches restaurants based on combined user preferences including location, time, and price range.
 
         Args:
-            user_prefs_uri (str): The URI of the user preference RDF graph.
+            user_prefs_uri (str): The URI of the user preference RDF graph, or the IRI of
+                the user when user_graph is given.
+            user_graph (str): The named graph of the user, as minted by the bulk ingestion.
+                The preferences are then looked up by graph and subject instead of
+                matching every Person of the store.
 
         Returns:
             list: Formatted data of restaurants matching the user preferences.
         """
+        restaurants = self.covered_restaurants(user_prefs_uri, user_graph)
+        results = self.execute_query(self.build_combined_preferences_query(user_prefs_uri, user_graph, restaurants))
+        return self.format_combined_preferences_data(results)
+
+    @staticmethod
+    def build_user_pattern(user_prefs_uri, user_graph=None):
+        """
+        Builds the graph pattern of the location and price preferences of the user.
+        """
+        user_pattern = """?user a ns1:Person ;
+                  ns1:seeks/ns1:availableAtOrFrom/ns1:geoWithin/ns1:geoMidpoint [ 
+                      ns1:latitude ?userLat ;
+                      ns1:longitude ?userLong
+                  ] ;
+                  ns1:seeks/ns1:priceSpecification/ns1:maxPrice ?maxPrice."""
+        if user_graph:
+            user_pattern = (f"GRAPH <{user_graph}> {{\n                "
+                            + user_pattern.replace("?user", f"<{user_prefs_uri}>", 1)
+                            + "\n            }")
+        return user_pattern
+
+    def build_user_location_query(self, user_prefs_uri, user_graph=None):
+        """
+        Builds the SPARQL query of the location and maximum price of the user, see
+        covered_restaurants.
+        """
+        query = f"""
+        PREFIX ns1: <http://schema.org/>
+
+        SELECT DISTINCT ?userLat ?userLong ?maxPrice
+        WHERE {{
+            {self.build_user_pattern(user_prefs_uri, user_graph)}
+        }}
+        """
+        return query
+
+    def covered_restaurants(self, user_prefs_uri, user_graph=None, locations=None):
+        """
+        IRIs of the restaurants of the services delivering to the user, from the
+        coverage index. The location of the user is queried first, unless given, so
+        that it is never older than the profile on the server.
+
+        Args:
+            locations (list): (latitude, longitude) of the user, when already known.
+
+        Returns:
+            list: The restaurant IRIs, or None without a coverage index.
+        """
+        if self.coverage_index is None:
+            return None
+        if locations is None:
+            count("coverage.location_queries")
+            locations = self.user_locations(
+                self.execute_query(self.build_user_location_query(user_prefs_uri, user_graph)))
+        restaurants = sorted({restaurant for lat, long in locations
+                              for restaurant in self.coverage_index.restaurants_delivering_to(lat, long)})
+        count("coverage.candidate_restaurants", len(restaurants))
+        return restaurants
+
+    @staticmethod
+    def user_locations(rows):
+        """
+        (latitude, longitude) of the rows of the user location query.
+        """
+        locations = []
+        for row in rows:
+            try:
+                locations.append((float(row['userLat']['value']), float(row['userLong']['value'])))
+            except (KeyError, ValueError):
+                continue
+        return locations
+
+    @staticmethod
+    def binding_n3(binding):
+        """
+        SPARQL syntax of a binding of the SPARQL JSON results format.
+        """
+        if binding['type'] == 'uri':
+            return URIRef(binding['value']).n3()
+        if binding['type'] == 'bnode':
+            return BNode(binding['value']).n3()
+        return Literal(binding['value'], lang=binding.get('xml:lang'), datatype=binding.get('datatype')).n3()
+
+    @classmethod
+    def user_values(cls, rows):
+        """
+        VALUES clause binding the location and maximum price of the user to the rows
+        of the user location query, in place of the user pattern.
+        """
+        values = [f"({cls.binding_n3(row['userLat'])} {cls.binding_n3(row['userLong'])} {cls.binding_n3(row['maxPrice'])})"
+                  for row in rows if {'userLat', 'userLong', 'maxPrice'} <= row.keys()]
+        return "VALUES (?userLat ?userLong ?maxPrice) { " + " ".join(values) + " }"
+
+    @staticmethod
+    def restaurant_values(restaurants):
+        """
+        VALUES clause restricting ?restaurant to the given IRIs (none matches if empty).
+        """
+        return "VALUES ?restaurant { " + " ".join(f"<{restaurant}>" for restaurant in restaurants) + " }"
+
+    def build_combined_preferences_query(self, user_prefs_uri, user_graph=None, restaurants=None, user_rows=None):
+        """
+        Builds the SPARQL query of query_restaurants_based_on_combined_preferences.
+
+        Args:
+            restaurants (list): IRIs of the only restaurants considered, e.g. those
+                delivering to the user (see covered_restaurants), or None for all of them.
+            user_rows (list): Rows of the user location query, bound with VALUES instead
+                of matching the user in the queried graph, or None.
+        """
+        if user_rows is not None:
+            user_pattern = self.user_values(user_rows)
+        else:
+            user_pattern = self.build_user_pattern(user_prefs_uri, user_graph)
+        candidates = self.restaurant_values(restaurants) if restaurants is not None else ""
+
         query = f"""
         PREFIX ns1: <http://schema.org/>
         PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
@@ -317,12 +657,10 @@ class SPARQLQueries:
         SELECT DISTINCT ?restaurant ?restaurantName ?distance ?openDay ?opens ?closes ?price
         WHERE {{
             # Fetch user's location and price preferences
-            ?user a ns1:Person ;
-                  ns1:seeks/ns1:availableAtOrFrom/ns1:geoWithin/ns1:geoMidpoint [ 
-                      ns1:latitude ?userLat ;
-                      ns1:longitude ?userLong
-                  ] ;
-                  ns1:seeks/ns1:priceSpecification/ns1:maxPrice ?maxPrice.
+            {user_pattern}
+
+            # Restaurants delivering to the user
+            {candidates}
 
             # Fetch restaurant details
             ?restaurant a ns1:Restaurant ;
@@ -335,9 +673,7 @@ class SPARQLQueries:
                  ns1:closes ?closes.
 
             OPTIONAL {{
-                ?restaurant ns1:hasMenu/ns1:hasMenuSection/ns1:hasMenuItem/ns1:offers/ns1:price ?priceLiteral.
-                BIND(REPLACE(?priceLiteral, "€", "") AS ?priceNumeric)
-                BIND(xsd:decimal(?priceNumeric) AS ?price)
+                ?restaurant ns1:hasMenu/ns1:hasMenuSection/ns1:hasMenuItem/ns1:offers/ns1:price ?price.
             }}
 
             # Calculate approximate distance (in degrees)
@@ -348,8 +684,7 @@ class SPARQLQueries:
         ORDER BY ?distance ?price
         LIMIT 10
         """
-        results = self.execute_query(query)
-        return self.format_combined_preferences_data(results)
+        return query
 
     @staticmethod
     def format_combined_preferences_data(query_results):
@@ -368,4 +703,82 @@ class SPARQLQueries:
                 'price': result.get('price', {}).get('value', 'Unknown')
             }
             formatted_results.append(data)
-        return formatted_results
\ No newline at end of file
+        return formatted_results
+
+
+class LocalSPARQLQueries(SPARQLQueries):
+    """
+    SPARQLQueries evaluated by rdflib on an in-process graph, e.g. data/ttl loaded
+    into an InternedStore, instead of a SPARQL endpoint.
+    """
+
+    def __init__(self, graph, source=None):
+        super().__init__(None)
+        self.graph = graph
+        self.source = source
+
+    @timed("sparql.execute_local_query")
+    def execute_query(self, query):
+        """
+        Execute a given SPARQL query on the graph and return the results, in the
+        same form as the JSON results of an endpoint.
+        """
+        note_query(query)
+        try:
+            bindings = [{str(variable): self.to_json_binding(term) for variable, term in row.asdict().items()}
+                        for row in self.graph.query(query)]
+            count("sparql.rows", len(bindings))
+            return bindings
+        except Exception as e:
+            count("sparql.errors")
+            note_query(query, error=str(e))
+            print(f"An error occurred: {e}")
+            return []
+
+    def explain(self, query):
+        """
+        Plan of a query: the operators of its algebra, and the number of triples of
+        the graph matching each triple pattern on its own.
+
+        Returns:
+            dict: 'plan', the lines of the plan, and 'patterns', the triple patterns
+                with their cardinality.
+        """
+        prepared = prepareQuery(query) if isinstance(query, str) else query
+        plan, patterns = [], []
+        self.explain_node(prepared.algebra, 0, plan, patterns)
+        return {'plan': plan, 'patterns': patterns}
+
+    def explain_node(self, node, depth, plan, patterns):
+        if not isinstance(node, CompValue):
+            return
+        if node.name == 'BGP':
+            plan.append("  " * depth + "BGP")
+            for triple in node.triples:
+                pattern = " ".join(term.n3(self.graph.namespace_manager) for term in triple)
+                # Variables match any term
+                cardinality = sum(1 for _ in self.graph.triples(
+                    tuple(None if isinstance(term, Variable) else term for term in triple)))
+                plan.append("  " * (depth + 1) + f"{pattern}  [{cardinality}]")
+                patterns.append({'pattern': pattern, 'cardinality': cardinality})
+            return
+        details = " ".join(f"?{variable}" for variable in node.get('PV') or []) if node.name == 'Project' else ""
+        plan.append("  " * depth + f"{node.name} {details}".rstrip())
+        for key in ('p', 'p1', 'p2'):
+            self.explain_node(node.get(key), depth + 1, plan, patterns)
+
+    @staticmethod
+    def to_json_binding(term):
+        """
+        Convert an rdflib term to a binding of the SPARQL JSON results format.
+        """
+        if isinstance(term, URIRef):
+            return {'type': 'uri', 'value': str(term)}
+        if isinstance(term, BNode):
+            return {'type': 'bnode', 'value': str(term)}
+        binding = {'type': 'literal', 'value': str(term)}
+        if term.datatype:
+            binding['datatype'] = str(term.datatype)
+        if term.language:
+            binding['xml:lang'] = term.language
+        return binding
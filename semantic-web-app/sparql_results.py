@@ -0,0 +1,437 @@
+"""
+sparql_results.py
+
+Compact SPARQL result formats for the query client.
+
+SPARQLQueries asks the endpoint for application/sparql-results+json, decodes the
+whole document into nested dicts, and every format_* method then walks them again.
+For wide results, e.g. the price range query which returns one row per menu item,
+decoding dominates the CPU time of the client.
+
+TabularSPARQLQueries negotiates the SPARQL 1.1 TSV (or CSV) results format with a
+gzip-compressed transfer instead, and decodes each row straight into the records
+returned by the get_* methods: one split per line, and one slice per term. TSV keeps
+the type, datatype and language of every term; CSV only keeps their lexical value.
+When the endpoint answers with another format, the response is decoded according to
+its Content-Type, JSON included.
+"""
+
+import io
+import re
+import csv
+import json
+import gzip
+import time
+import requests
+from rdflib import URIRef, BNode
+from instrumentation import timed, span, count
+from sparql_queries import SPARQLQueries
+from query_log import observed_query, note_query
+
+XSD = "http://www.w3.org/2001/XMLSchema#"
+
+CONTENT_TYPES = {
+    'tsv': 'text/tab-separated-values',
+    'csv': 'text/csv',
+    'json': 'application/sparql-results+json',
+}
+
+# Accept header of each preferred format, JSON being the fallback of the other ones
+ACCEPT = {
+    'tsv': 'text/tab-separated-values, application/sparql-results+json;q=0.5',
+    'csv': 'text/csv, application/sparql-results+json;q=0.5',
+    'json': 'application/sparql-results+json',
+}
+
+# Fields of the records of the get_* methods: (record field, query variable, value if unbound)
+PRICE_RANGE_FIELDS = [('name', 'restaurantName', None), ('menuItem', 'menuItemName', None),
+                      ('price', 'priceLiteral', None)]
+OPEN_HOURS_FIELDS = [('name', 'restaurantName', None), ('open_day', 'openDay', None),
+                     ('opens', 'opens', None), ('closes', 'closes', None)]
+GEOGRAPHICAL_FIELDS = [('restaurant', 'restaurant', None), ('name', 'restaurantName', None),
+                       ('latitude', 'latitude', None), ('longitude', 'longitude', None)]
+DELIVERY_SERVICE_FIELDS = [('service_name', 'serviceName', 'Unknown'), ('country', 'addressCountry', 'Not available'),
+                           ('locality', 'addressLocality', 'Not available')]
+COMBINED_PREFERENCES_FIELDS = [(field, variable, 'Unknown') for field, variable in [
+    ('restaurant', 'restaurant'), ('name', 'restaurantName'), ('distance', 'distance'), ('open_day', 'openDay'),
+    ('opens', 'opens'), ('closes', 'closes'), ('price', 'price')]]
+SUMMARY_FIELDS = [(field, variable, None) for field, variable in [
+    ('restaurant', 'restaurant'), ('name', 'restaurantName'), ('description', 'description'), ('image', 'image'),
+    ('address', 'address'), ('telephone', 'telephone'), ('latitude', 'latitude'), ('longitude', 'longitude'),
+    ('service', 'service'), ('service_name', 'serviceName'), ('min_price', 'minPrice'), ('max_price', 'maxPrice'),
+    ('open_intervals', 'openIntervals')]]
+
+ESCAPE = re.compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)')
+ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', 'b': '\b', 'f': '\f', '"': '"', "'": "'", '\\': '\\'}
+INTEGER = re.compile(r'[+-]?\d+$')
+
+
+def unescape(value):
+    """
+    Decode the string escapes of a TSV literal, e.g. "a\\tb" -> "a<TAB>b".
+    """
+    def replace(match):
+        escape = match.group(1)
+        if len(escape) > 1:
+            return chr(int(escape[1:], 16))
+        return ESCAPES.get(escape, escape)
+    return ESCAPE.sub(replace, value)
+
+
+def escape(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+"""
+FUNCTIONS TO DECODE THE RESULTS
+"""
+def tsv_value(term):
+    """
+    Lexical value of a TSV term, e.g. '"8.50"^^<http://www.w3.org/2001/XMLSchema#decimal>'
+    -> "8.50", "<https://a2roo.coopcycle.org/>" -> "https://a2roo.coopcycle.org/".
+    """
+    first = term[0]
+    if first == '"':
+        value = term[1:term.rindex('"')]
+        return unescape(value) if '\\' in value else value
+    if first == '<':
+        return term[1:-1]
+    if first == '_' and term[1:2] == ':':
+        return term[2:]
+    # Abbreviated numbers and booleans
+    return term
+
+
+def tsv_binding(term):
+    """
+    Binding of the SPARQL JSON results format of a TSV term.
+    """
+    first = term[0]
+    if first == '"':
+        end = term.rindex('"')
+        value = term[1:end]
+        binding = {'type': 'literal', 'value': unescape(value) if '\\' in value else value}
+        suffix = term[end + 1:]
+        if suffix.startswith('@'):
+            binding['xml:lang'] = suffix[1:]
+        elif suffix.startswith('^^'):
+            binding['datatype'] = suffix[3:-1]
+        return binding
+    if first == '<':
+        return {'type': 'uri', 'value': term[1:-1]}
+    if first == '_' and term[1:2] == ':':
+        return {'type': 'bnode', 'value': term[2:]}
+    if term in ('true', 'false'):
+        datatype = 'boolean'
+    elif INTEGER.match(term):
+        datatype = 'integer'
+    elif 'e' in term or 'E' in term:
+        datatype = 'double'
+    else:
+        datatype = 'decimal'
+    return {'type': 'literal', 'value': term, 'datatype': XSD + datatype}
+
+
+def split_tsv(text):
+    """
+    Split a TSV document into its variables and the terms of each row, '' for an
+    unbound variable. Tabs and newlines inside literals are escaped, so rows and
+    terms are split on the raw characters.
+    """
+    if '\r' in text:
+        text = text.replace('\r\n', '\n')
+    lines = text.split('\n')
+    if lines and lines[-1] == '':
+        lines.pop()
+    if not lines:
+        return [], []
+    variables = [variable.strip().lstrip('?$') for variable in lines[0].split('\t')]
+    return variables, [line.split('\t') for line in lines[1:]]
+
+
+def read_csv(text):
+    rows = list(csv.reader(io.StringIO(text, newline='')))
+    if not rows:
+        return [], []
+    return rows[0], rows[1:]
+
+
+def decode_bindings(content_type, text):
+    """
+    Decode a result document into the bindings of the SPARQL JSON results format.
+
+    Args:
+        content_type (str): Media type of the document, e.g. text/tab-separated-values.
+        text (str): The document.
+
+    Returns:
+        list: One dict per row, variable -> {'type', 'value', 'datatype' or 'xml:lang'}.
+    """
+    if content_type == CONTENT_TYPES['tsv']:
+        variables, rows = split_tsv(text)
+        return [{variable: tsv_binding(term) for variable, term in zip(variables, row) if term}
+                for row in rows]
+    if content_type == CONTENT_TYPES['csv']:
+        # CSV does not keep the type of the terms, every value is a plain literal
+        variables, rows = read_csv(text)
+        return [{variable: {'type': 'literal', 'value': value} for variable, value in zip(variables, row) if value}
+                for row in rows]
+    return json.loads(text)["results"]["bindings"]
+
+
+def decode_records(content_type, text, fields):
+    """
+    Decode a result document straight into records, without building the bindings.
+
+    Args:
+        content_type (str): Media type of the document.
+        text (str): The document.
+        fields (list): (record field, query variable, value if unbound) of the records,
+            e.g. PRICE_RANGE_FIELDS.
+
+    Returns:
+        list: One dict per row, record field -> lexical value.
+    """
+    if content_type == CONTENT_TYPES['json']:
+        return [{field: result.get(variable, {}).get('value', default) for field, variable, default in fields}
+                for result in json.loads(text)["results"]["bindings"]]
+
+    tsv = content_type == CONTENT_TYPES['tsv']
+    variables, rows = split_tsv(text) if tsv else read_csv(text)
+    # Columns resolved once per document, variables missing from the results are past the last column
+    columns = [(field, variables.index(variable) if variable in variables else len(variables), default)
+               for field, variable, default in fields]
+    records = []
+    for row in rows:
+        record = {}
+        for field, column, default in columns:
+            term = row[column] if column < len(row) else ''
+            if not term:
+                record[field] = default
+            elif not tsv:
+                record[field] = term
+            elif term[0] == '"':
+                # Most terms are literals, decoded inline
+                value = term[1:term.rindex('"')]
+                record[field] = unescape(value) if '\\' in value else value
+            else:
+                record[field] = tsv_value(term)
+        records.append(record)
+    return records
+
+
+"""
+FUNCTIONS TO SERIALIZE LOCAL RESULTS
+"""
+def tsv_term(term):
+    if isinstance(term, URIRef):
+        return f"<{term}>"
+    if isinstance(term, BNode):
+        return f"_:{term}"
+    text = f'"{escape(str(term))}"'
+    if term.language:
+        return f"{text}@{term.language}"
+    if term.datatype:
+        return f"{text}^^<{term.datatype}>"
+    return text
+
+
+def serialize_tsv(result):
+    """
+    Serialize an rdflib SELECT result in the SPARQL 1.1 TSV results format, which
+    rdflib does not provide.
+    """
+    lines = ['\t'.join(f"?{variable}" for variable in result.vars)]
+    for row in result:
+        lines.append('\t'.join(tsv_term(term) if term is not None else '' for term in row))
+    return '\n'.join(lines) + '\n'
+
+
+class TabularSPARQLQueries(SPARQLQueries):
+    """
+    SPARQLQueries negotiating a TSV or CSV result format, with gzip transfer, from the
+    endpoint, and decoding the rows straight into records.
+
+    Args:
+        sparql_endpoint (str): URL of the query endpoint.
+        result_format (str): Preferred format, 'tsv', 'csv' or 'json'.
+        timeout (float): Timeout of a query in seconds.
+    """
+
+    def __init__(self, sparql_endpoint, result_format='tsv', timeout=60.0):
+        super().__init__(sparql_endpoint)
+        if result_format not in ACCEPT:
+            raise ValueError(f"Unsupported result format: {result_format}")
+        self.result_format = result_format
+        self.timeout = timeout
+        # Keep-alive connections to the endpoint, shared by the queries
+        self.session = requests.Session()
+
+    def fetch_results(self, query, result_format=None):
+        """
+        Send a query and return the result document.
+
+        Returns:
+            tuple: The media type of the document and its text.
+        """
+        result_format = result_format or self.result_format
+        with span("sparql.fetch_results", format=result_format):
+            response = self.session.post(self.sparql_endpoint, data={'query': query},
+                                         headers={'Accept': ACCEPT[result_format], 'Accept-Encoding': 'gzip'},
+                                         timeout=self.timeout)
+            response.raise_for_status()
+            # requests decompresses the body, Content-Length is the size transferred
+            if 'Content-Length' in response.headers:
+                count("sparql.transfer_bytes", int(response.headers['Content-Length']))
+            note_query(query, len(response.content))
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+            return content_type, response.content.decode('utf-8')
+
+    @timed("sparql.execute_tabular_query")
+    def execute_query(self, query):
+        """
+        Execute a given SPARQL query and return the results, in the same form as the
+        JSON results of an endpoint.
+        """
+        try:
+            content_type, text = self.fetch_results(query)
+            with span("sparql.decode_results", format=content_type):
+                bindings = decode_bindings(content_type, text)
+            count("sparql.rows", len(bindings))
+            return bindings
+        except Exception as e:
+            count("sparql.errors")
+            note_query(query, error=str(e))
+            print(f"An error occurred: {e}")
+            return []
+
+    @timed("sparql.execute_records_query")
+    def execute_records(self, query, fields):
+        """
+        Execute a given SPARQL query and decode its rows into records.
+
+        Args:
+            query (str): The SPARQL query.
+            fields (list): (record field, query variable, value if unbound) of the records.
+        """
+        try:
+            content_type, text = self.fetch_results(query)
+            with span("sparql.decode_records", format=content_type):
+                records = decode_records(content_type, text, fields)
+            count("sparql.rows", len(records))
+            return records
+        except Exception as e:
+            count("sparql.errors")
+            note_query(query, error=str(e))
+            print(f"An error occurred: {e}")
+            return []
+
+    @observed_query
+    def get_restaurant_summaries(self, summary_graph="urn:coopcycle:summaries"):
+        summaries = self.execute_records(self.build_restaurant_summaries_query(summary_graph), SUMMARY_FIELDS)
+        for summary in summaries:
+            summary['open_intervals'] = self.split_open_intervals(summary['open_intervals'])
+        return summaries
+
+    @observed_query
+    def get_restaurants_by_day_and_time(self, day, open_time, close_time):
+        return self.execute_records(self.build_restaurants_by_day_and_time_query(day, open_time, close_time),
+                                    OPEN_HOURS_FIELDS)
+
+    @observed_query
+    def get_restaurant_opening_hours(self, restaurant_name):
+        return self.execute_records(self.build_restaurant_opening_hours_query(restaurant_name), OPEN_HOURS_FIELDS)
+
+    @observed_query
+    def get_restaurants_in_area(self, central_lat, central_long, lat_range, long_range):
+        return self.execute_records(self.build_restaurants_in_area_query(central_lat, central_long, lat_range, long_range),
+                                    GEOGRAPHICAL_FIELDS)
+
+    @observed_query
+    def get_restaurants_by_price_range(self, max_price):
+        return self.execute_records(self.build_restaurants_by_price_range_query(max_price), PRICE_RANGE_FIELDS)
+
+    @observed_query
+    def get_restaurant_menu(self, restaurant_name):
+        return self.execute_records(self.build_restaurant_menu_query(restaurant_name), PRICE_RANGE_FIELDS)
+
+    @observed_query
+    def get_delivery_services(self):
+        return self.execute_records(self.build_delivery_services_query(), DELIVERY_SERVICE_FIELDS)
+
+    @observed_query
+    def query_restaurants_based_on_combined_preferences(self, user_prefs_uri, user_graph=None):
+        restaurants = self.covered_restaurants(user_prefs_uri, user_graph)
+        return self.execute_records(self.build_combined_preferences_query(user_prefs_uri, user_graph, restaurants),
+                                    COMBINED_PREFERENCES_FIELDS)
+
+
+"""
+FUNCTIONS TO BENCHMARK THE RESULT FORMATS
+"""
+def local_result_documents(graph, query):
+    """
+    Result documents of a query evaluated on an in-process graph, in every format,
+    as an endpoint would send them.
+
+    Returns:
+        dict: Format -> (media type, text).
+    """
+    result = graph.query(query)
+    return {
+        'json': (CONTENT_TYPES['json'], result.serialize(format='json').decode('utf-8')),
+        'csv': (CONTENT_TYPES['csv'], result.serialize(format='csv').decode('utf-8')),
+        'tsv': (CONTENT_TYPES['tsv'], serialize_tsv(result)),
+    }
+
+
+def remote_result_documents(sparql_endpoint, query):
+    """
+    Result documents of a query fetched from the endpoint in every format.
+    """
+    client = TabularSPARQLQueries(sparql_endpoint)
+    return {result_format: client.fetch_results(query, result_format) for result_format in CONTENT_TYPES}
+
+
+@timed("benchmark_result_formats")
+def benchmark_result_formats(documents, fields, formatter, repeat=5):
+    """
+    Compare the decoding of the same results in every format: the JSON path of
+    SPARQLQueries (json.loads, as SPARQLWrapper's convert(), then the format_* method)
+    and the row decoder of each format.
+
+    Args:
+        documents (dict): Format -> (media type, text), e.g. from local_result_documents.
+        fields (list): Fields of the records, e.g. PRICE_RANGE_FIELDS.
+        formatter (function): The format_* method matching the fields.
+        repeat (int): Number of runs, the best one is kept.
+
+    Returns:
+        dict: Format -> {'rows', 'bytes', 'gzip_bytes', 'decode_ms', 'identical'}, the
+            'json' entry being the JSON path, and the other ones the row decoder.
+    """
+    def best_time(decode):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            records = decode()
+            timings.append(time.perf_counter() - start)
+        return records, min(timings) * 1000
+
+    reference, json_ms = best_time(lambda: formatter(json.loads(documents['json'][1])["results"]["bindings"]))
+    report = {}
+    for result_format, (content_type, text) in documents.items():
+        if result_format == 'json':
+            records, decode_ms = reference, json_ms
+        else:
+            records, decode_ms = best_time(lambda: decode_records(content_type, text, fields))
+        data = text.encode('utf-8')
+        report[result_format] = {
+            'rows': len(records),
+            'bytes': len(data),
+            'gzip_bytes': len(gzip.compress(data, compresslevel=6)),
+            'decode_ms': decode_ms,
+            'identical': records == reference,
+        }
+    return report
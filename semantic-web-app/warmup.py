@@ -0,0 +1,146 @@
+"""
+warmup.py
+
+Warm-up of the query path after a load of the Fuseki dataset.
+
+After an upload, the first requests for the restaurant lists, the delivery services
+or the popular city areas hit a cold server (dataset pages and query plans not in
+memory) and an empty local result cache. The warm-up replays a workload of the most
+common SPARQLQueries calls once, so that the server pages are read and the results
+are stored in the result cache (see result_cache.py) before the users come.
+
+The workload is a YAML (or JSON) file listing the calls, by default warmup.yaml next
+to this module:
+
+    queries:
+      - method: get_delivery_services
+      - method: get_restaurants_by_price_range
+        params: {max_price: 20}
+
+or the most frequent calls of a query log (see query_log.py).
+
+YAML workloads require the PyYAML package.
+"""
+
+import os
+import json
+import time
+from collections import Counter
+from instrumentation import timed, span, count
+from query_log import read_log, last_error
+from result_cache import set_result_cache, backend
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+DEFAULT_WORKLOAD = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'warmup.yaml')
+
+# Number of calls taken from a query log
+TOP_CALLS = 20
+
+
+"""
+FUNCTIONS TO READ THE WORKLOAD
+"""
+
+def load_workload(workload_file=DEFAULT_WORKLOAD):
+    """
+    Read a workload file.
+
+    Args:
+        workload_file (str): YAML or JSON file with a 'queries' list of calls, each with
+            a 'method' and optional 'params' by name.
+
+    Returns:
+        list: The calls, as (method, params) tuples.
+    """
+    with open(workload_file, 'r', encoding='utf-8') as f:
+        if workload_file.endswith('.json'):
+            workload = json.load(f)
+        elif yaml is None:
+            raise ValueError(f"Reading {workload_file} requires the PyYAML package (pip install pyyaml)")
+        else:
+            workload = yaml.safe_load(f)
+
+    calls = []
+    for position, call in enumerate((workload or {}).get('queries') or []):
+        if not isinstance(call, dict) or not isinstance(call.get('method'), str):
+            raise ValueError(f"Call {position + 1} of {workload_file} has no method")
+        params = call.get('params') or {}
+        if not isinstance(params, dict):
+            raise ValueError(f"The params of call {position + 1} of {workload_file} are not a mapping")
+        calls.append((call['method'], params))
+    return calls
+
+
+def workload_from_log(log_file, top=TOP_CALLS):
+    """
+    Most frequent successful calls of a query log.
+
+    Args:
+        log_file (str): The query log, e.g. data/log/queries.jsonl.
+        top (int): Number of calls kept.
+
+    Returns:
+        list: The calls, as (method, params) tuples, most frequent first.
+    """
+    calls = Counter(
+        (entry['template'], json.dumps(entry['params'], sort_keys=True, ensure_ascii=False))
+        for entry in read_log(log_file) if not entry.get('error')
+    )
+    return [(template, json.loads(params)) for (template, params), _ in calls.most_common(top)]
+
+
+"""
+FUNCTIONS TO WARM UP
+"""
+
+@timed("warmup.run")
+def warm_up(sparql_queries, calls, result_cache=None):
+    """
+    Replay a workload once, to prime the server and the result cache. The cached
+    results of the same backend are cleared first, so that they only hold results of
+    the loaded data, and the hits and misses are counted from the end of the warm-up.
+
+    Args:
+        sparql_queries (SPARQLQueries): The client replaying the calls.
+        calls (list): (method, params) tuples, see load_workload.
+        result_cache (ResultCache): The cache to fill, or None to only prime the server.
+
+    Returns:
+        dict: 'duration' in seconds, 'errors', and 'calls', a list of dicts with the
+            method, params, latency in ms, rows and error of each call.
+    """
+    started = time.time()
+    start = time.perf_counter()
+    if result_cache is not None:
+        result_cache.clear(backend(sparql_queries))
+    set_result_cache(result_cache)
+    report = []
+    try:
+        for method, params in calls:
+            entry = {'method': method, 'params': params, 'rows': 0, 'error': None}
+            call_start = time.perf_counter()
+            query_method = getattr(sparql_queries, method, None)
+            if method.startswith('_') or not callable(query_method):
+                entry['error'] = f"Unknown method {method}"
+            else:
+                try:
+                    with span(f"warmup.{method}"):
+                        entry['rows'] = len(query_method(**params))
+                    entry['error'] = last_error()
+                except TypeError as e:
+                    # Wrong parameters in the workload
+                    entry['error'] = str(e)
+            entry['latency_ms'] = (time.perf_counter() - call_start) * 1000
+            count("warmup.calls")
+            report.append(entry)
+    finally:
+        set_result_cache(None)
+    duration = time.perf_counter() - start
+    errors = sum(1 for entry in report if entry['error'])
+    if result_cache is not None:
+        result_cache.record_warmup(started, duration, len(report), errors)
+    return {'duration': duration, 'errors': errors, 'calls': report}